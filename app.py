@@ -1,16 +1,285 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
-from sklearn.decomposition import PCA
 import plotly.express as px
 import plotly.graph_objects as go
-from scipy.cluster.hierarchy import dendrogram, linkage
+
+from artifacts import default_cache, shared_cache
+import engine
+import pipeline
+from charts import (LARGE_NETWORK_STORES, POINT_BUDGET, TABLE_PAGE_ROWS, TRUNCATE_MODES,
+                    dendrogram_figure, pca_scatter_figure, table_page)
+from distances import SILHOUETTE_SAMPLE_SIZE, matrix_fits, pairwise_matrix
+from jobs import JOB_POLL_SECONDS, JOB_WAIT_SECONDS, default_manager
+from forecast import DEFAULT_HORIZON, FREQS, has_dates
+from parallel import default_n_jobs
+from projection import PROJECTION_LABELS
+from profiling import PROFILE_LOG, Profiler, activate, peak_rss_mb, profiled_cache
+from hierarchy import LINKAGE_METHODS, LINKAGE_METRICS, linkage_tree
+from incremental import warm_recluster
+from model import ClusterModel
+from loaders import ParquetCache, content_hash, load_excel_cached
+from sheets import SHEETS_TTL_SECONDS, load_sheets, parse_gids, parse_sheets_url
+from stability import DEFAULT_RESAMPLES, DISSOLVED_JACCARD, STABLE_JACCARD
 
 st.set_page_config(page_title="Кластеризация магазинов", layout="wide")
 
+
+# Мемоизация этапов расчета. Аргументы с префиксом "_" не хэшируются:
+# ключом служат хэш данных (data_key) и параметры, которые этап действительно
+# читает, поэтому смена виджета пересчитывает только зависимые этапы.
+# Результаты, одинаковые для всех аналитиков (pivot, перебор k, кластеры,
+# деревья, отчеты), хранятся в общем кэше процесса (artifacts.shared_cache)
+# с бюджетом памяти и необязательным дисковым уровнем.
+@profiled_cache(shared_cache())
+def cached_pivot(data_key, float_dtype, _df):
+    return pipeline.build_pivot(_df, np.dtype(float_dtype))
+
+
+@profiled_cache(shared_cache())
+def cached_features(data_key, feature_axis, svd_components, _df, _pivot_pct):
+    return engine.compute_features(_df, _pivot_pct, feature_axis, svd_components)
+
+
+# Матрицы расстояний — через cache_resource: cache_data копировал бы n×n
+# при каждом обращении, а матрица только читается
+@profiled_cache(st.cache_resource(show_spinner="Расчет матрицы расстояний...", max_entries=6))
+def cached_distances(data_key, metric, _X):
+    return pairwise_matrix(_X, metric)
+
+
+@profiled_cache(shared_cache())
+def cached_sweep(data_key, min_k, max_k, init_method, silhouette_sample, mode, reuse_k, _X_scaled, _D=None,
+                 _n_jobs=1, _tree=None, _progress=None):
+    # Число процессов не влияет на результат, поэтому не входит в ключ кэша;
+    # _progress(done, k, metrics) — метрики каждого готового k для фонового задания.
+    # reuse_k=False — перебор без метрик других переборов (время для сравнения режимов)
+    k_range = engine.k_range_for(min_k, max_k, len(_X_scaled))
+    if not reuse_k or mode not in engine.K_CACHE_MODES:
+        return engine.compute_sweep(_X_scaled, k_range, init_method, mode, _D, silhouette_sample, _tree,
+                                    _n_jobs, progress=_progress)
+    shared = cached_k_metrics(data_key, init_method, silhouette_sample)
+    # Перебор работает со своей копией: параллельные задания не меняют словарь
+    # у него на глазах; посчитанные k (и при отмене тоже) добавляются после
+    with K_METRICS_LOCK:
+        k_cache = dict(shared)
+    try:
+        return engine.compute_sweep(_X_scaled, k_range, init_method, mode, _D, silhouette_sample,
+                                    n_jobs=_n_jobs, k_cache=k_cache, progress=_progress)
+    finally:
+        with K_METRICS_LOCK:
+            shared.update(k_cache)
+
+
+# Метрики отдельных k полного и адаптивного перебора: уточнение или другой
+# диапазон k не пересчитывают уже посчитанные k. Словарь общий для заданий
+# всех сессий, читается и дополняется под K_METRICS_LOCK
+K_METRICS_LOCK = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def cached_k_metrics(data_key, init_method, silhouette_sample):
+    return {}
+
+
+@profiled_cache(shared_cache())
+def cached_fit(data_key, n_clusters, distance_metric, fit_params, silhouette_sample, _X_scaled,
+               _D=None, _tree=None):
+    return engine.compute_fit(_X_scaled, n_clusters, distance_metric, fit_params, _D, silhouette_sample, _tree)
+
+
+@profiled_cache(shared_cache())
+def cached_stability(data_key, fit_key, n_resamples, mode, _X_scaled, _clusters, _stores, _n_jobs=1,
+                     _progress=None):
+    n_clusters, distance_metric, fit_params = fit_key
+    result = engine.compute_stability(_X_scaled, _clusters, n_clusters, distance_metric, fit_params, _stores,
+                                      n_resamples, mode, n_jobs=_n_jobs, progress=_progress)
+    # Консенсусная матрица n×n нужна только для таблиц выше, в общем кэше ее не держим
+    return {**result, 'consensus': None}
+
+
+@profiled_cache(shared_cache())
+def cached_forecast(data_key, fit_key, freq, horizon, by_segment, _df, _stores, _clusters, _n_jobs=1,
+                    _progress=None):
+    return engine.compute_forecast(_df, _stores, _clusters, freq, horizon, by_segment, _n_jobs, _progress)
+
+
+@profiled_cache(shared_cache())
+def cached_pca(data_key, _X_scaled, _svd_explained=None):
+    # Проекция обучается один раз на набор признаков; ее компоненты
+    # сохраняются в модели и проецируют магазины, назначаемые позже
+    return pipeline.project_2d(_X_scaled, svd_explained=_svd_explained)
+
+
+@profiled_cache(shared_cache())
+def cached_profiles(data_key, fit_key, _pivot_pct, _clusters):
+    return pipeline.cluster_profiles(_pivot_pct, _clusters)
+
+
+# Одно дерево на (данные, метод связи, метрику): его используют дендрограмма,
+# иерархическая кластеризация и иерархический перебор k
+@profiled_cache(shared_cache())
+def cached_linkage(data_key, method, metric, _X_scaled, _D=None):
+    return linkage_tree(_X_scaled, method, metric, _D)
+
+
+@profiled_cache(st.cache_resource(show_spinner=False, max_entries=4))
+def cached_neighbor_index(data_key, fit_key, _pivot_pct, _clusters, _similarity_features=None):
+    # Индекс строится один раз на прогон кластеризации
+    return engine.compute_neighbors(_pivot_pct, _clusters, _similarity_features)
+
+
+@profiled_cache(shared_cache())
+def cached_neighbor_pairs(data_key, fit_key, top_n, same_cluster, _index):
+    with st.spinner("Поиск соседей для всех магазинов..."):
+        return _index.batch(top_n, same_cluster).to_csv(index=False, encoding='utf-8-sig')
+
+
+@profiled_cache(shared_cache())
+def cached_model_bytes(data_key, fit_key, distance_metric, _pivot_pct, _clusters, quality, _projection=None):
+    return engine.model_from_fit(_pivot_pct, _clusters, distance_metric, fit_key[2], quality, _projection,
+                                 data_key=data_key).to_bytes()
+
+
+@profiled_cache(shared_cache())
+def cached_warm_recluster(data_key, model_hash, _df, _model):
+    return warm_recluster(_df, _model)
+
+
+@profiled_cache(shared_cache())
+def cached_report(data_key, fit_key, _result_df, _profiles, quality, forecast_args=None, _forecast=None):
+    # forecast_args — параметры прогноза, лист "Прогноз" которого входит в отчет
+    return engine.excel_report(_result_df, _profiles, quality, _forecast)
+
+
+# Тяжелые этапы (перебор k, кластеризация, linkage) считаются в фоновых заданиях
+# (jobs.py): задание переживает перезапуски скрипта, при смене параметров этапа
+# прежнее задание сессии отменяется. Функция задания получает Job первым аргументом.
+def run_sweep(job, *args):
+    return cached_sweep(*args, _progress=lambda done, k, metrics: job.report((k, metrics)))
+
+
+def run_fit(job, *args):
+    return cached_fit(*args)
+
+
+def run_linkage(job, *args):
+    return cached_linkage(*args)
+
+
+def background(stage, key, func, *args):
+    """Фоновое задание этапа для текущей сессии; None — пользователь отменил задание с этим ключом.
+
+    Короткие расчеты и попадания в кэш успевают завершиться за
+    JOB_WAIT_SECONDS и показываются в этом же прогоне без опроса.
+    """
+    slot = (session_id, stage)
+    if st.session_state.get(f'job_cancelled_{stage}') == key:
+        default_manager().cancel(slot)
+        return None
+    job = default_manager().submit(slot, key, func, *args)
+    job.wait(JOB_WAIT_SECONDS)
+    return job
+
+
+@contextmanager
+def progress_bar(label, unit):
+    """Полоса хода расчета в сессии; отдает callback progress(done, total).
+
+    Создается вне функций общего кэша: в кэше не должно быть элементов
+    интерфейса конкретной сессии.
+    """
+    bar = st.progress(0)
+    try:
+        yield lambda done, total: bar.progress(done / total, text=f"{label}: {done} из {total} {unit}...")
+    finally:
+        bar.empty()
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_status(stage, job, label, total=None, partial_chart=None):
+    """Ход фонового задания; по завершении перезапускает весь скрипт, чтобы забрать результат."""
+    if job.done:
+        st.rerun()
+    done = len(job.partial)
+    if total:
+        st.progress(done / total, text=f"⏳ {label}: готово {done} из {total} ({job.seconds:.0f} с)...")
+    elif done:
+        st.info(f"⏳ {label}: готово {done} ({job.seconds:.0f} с)...")
+    else:
+        st.info(f"⏳ {label} ({job.seconds:.0f} с)...")
+    if partial_chart is not None and job.partial:
+        st.plotly_chart(partial_chart(job.partial), use_container_width=True)
+    if st.button("⏹️ Отменить", key=f'job_cancel_{stage}'):
+        st.session_state[f'job_cancelled_{stage}'] = job.key
+        default_manager().cancel((session_id, stage))
+        st.rerun()
+
+
+def wait_for(stage, job, label, total=None, partial_chart=None, block=True):
+    """Результат фонового задания или None, пока оно идет (block=True — остановить скрипт)."""
+    if job is None:
+        st.warning(f"⏹️ {label}: расчет отменен")
+        if st.button("▶️ Запустить снова", key=f'job_restart_{stage}'):
+            del st.session_state[f'job_cancelled_{stage}']
+            st.rerun()
+    elif job.done:
+        result = job.result()
+        # Этапы задания — в панель профилирования сессии, когда она впервые забирает результат
+        job_id = (job.key, job.started)
+        picked = st.session_state.setdefault('picked_jobs', {})
+        if picked.get(stage) != job_id:
+            picked[stage] = job_id
+            profiler.merge(job.profiler, f"фоновое задание: {label}")
+        return result
+    else:
+        job_status(stage, job, label, total, partial_chart)
+    if block:
+        stop()
+    return None
+
+
+def stop():
+    """Завершает прогон: закрывает замеры профайлера, как в конце скрипта, и st.stop()."""
+    profiler.finish()
+    st.stop()
+
+
+def partial_sweep_figure(partial):
+    """Метрики уже посчитанных k (задание перебора еще идет)."""
+    partial = sorted(partial, key=lambda item: item[0])
+    ks = [k for k, _ in partial]
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=ks, y=[m['silhouette'] for _, m in partial], mode='lines+markers',
+                             name='Silhouette (↑ лучше)', line=dict(color='green', width=3)))
+    fig.add_trace(go.Scatter(x=ks, y=[m['inertia'] for _, m in partial], mode='lines+markers',
+                             name='Inertia', line=dict(color='blue', width=2), yaxis='y2'))
+    fig.update_layout(title="Метрики посчитанных k", xaxis_title="Количество кластеров",
+                      yaxis_title="Silhouette Score",
+                      yaxis2=dict(title="Inertia", overlaying='y', side='right'), height=350)
+    return fig
+
+
+# Идентификатор сессии: слоты фоновых заданий и записи профайлера
+session_id = st.session_state.setdefault('session_id', uuid.uuid4().hex[:12])
+
+# Замеры прогона: нумерованные блоки, этапы внутри них и попадания в кэш
+# (панель "Профилирование этапов"; с KLASTER_PROFILE_LOG — еще и в JSON lines)
+# Прогон, прерванный Streamlit (перезапуск по виджету, st.rerun(), исключение),
+# не дошел до finish(): его замеры закрываются в начале следующего прогона
+previous_profiler = st.session_state.get('profiler')
+if previous_profiler is not None:
+    previous_profiler.finish()
+profiler = Profiler(trace_memory=st.session_state.get('profile_trace_memory', False), session=session_id)
+st.session_state['profiler'] = profiler
+activate(profiler)
+profiler.block("Загрузка данных")
+
 st.title("📊 Кластеризация магазинов по структуре ассортимента")
 st.markdown("**Метод:** Сегментация по долям товарных сегментов в обороте")
 
@@ -22,13 +291,28 @@ data_source = st.radio(
 )
 
 df = None
+load_meta = None  # статистика загрузчика: key, rows_raw, rows_dropped, ...
 
 if data_source == "📁 Excel файл":
     # Загрузка файла
     uploaded_file = st.file_uploader("Загрузите файл с продажами (Excel)", type=['xlsx', 'xls'])
+    streaming_excel = st.checkbox(
+        "Потоковая загрузка (.xlsx, только агрегаты магазин × сегмент)",
+        help="Файл читается блоками строк, память не зависит от размера файла. "
+             "Артикулы (Art) при этом не сохраняются"
+    )
     
     if uploaded_file:
-        df = pd.read_excel(uploaded_file)
+        # Очищенная таблица кэшируется по хэшу файла: повторные запуски не парсят Excel
+        try:
+            with st.spinner("Чтение файла..."), profiler.stage('load_excel_cached', cached=True):
+                df, load_meta = load_excel_cached(uploaded_file.getvalue(), ParquetCache(),
+                                                  streaming=streaming_excel)
+                if not load_meta['from_cache']:
+                    profiler.mark_miss()
+        except ValueError as e:
+            st.error(f"❌ {str(e)}")
+            stop()
 
 else:  # Google Sheets
     st.markdown("**Требования:** Таблица должна быть доступна по ссылке (настройки доступа)")
@@ -44,40 +328,56 @@ else:  # Google Sheets
     with col2:
         load_button = st.button("📥 Загрузить", type="primary")
     
-    if sheets_url and load_button:
+    col_g1, col_g2 = st.columns([4, 1])
+    with col_g1:
+        extra_gids = st.text_input(
+            "Дополнительные листы (gid через запятую)",
+            help="Например, листы по месяцам или регионам: строки всех листов объединяются. "
+                 "gid — число после 'gid=' в ссылке на лист"
+        )
+    with col_g2:
+        force_refresh = st.checkbox("Обновить", help=f"Не использовать кэш "
+                                    f"(по умолчанию листы перезапрашиваются не чаще раза в {SHEETS_TTL_SECONDS} с)")
+    
+    # Таблица остается загруженной и при следующих запусках скрипта (смена виджетов)
+    if sheets_url and (load_button or st.session_state.get('sheets_loaded') == sheets_url):
         try:
             # Извлекаем ID таблицы и листа из ссылки
-            import re
-            
-            spreadsheet_id_match = re.search(r'/d/([a-zA-Z0-9-_]+)', sheets_url)
-            sheet_id_match = re.search(r'gid=([0-9]+)', sheets_url)
-            
-            if not spreadsheet_id_match:
-                st.error("❌ Неправильная ссылка. Убедитесь, что это ссылка на Google Sheets")
-                st.stop()
-            
-            spreadsheet_id = spreadsheet_id_match.group(1)
-            sheet_id = sheet_id_match.group(1) if sheet_id_match else '0'
+            spreadsheet_id, sheet_id = parse_sheets_url(sheets_url)
+            gids = list(dict.fromkeys([sheet_id] + parse_gids(extra_gids)))
             
-            # Формируем ссылку для экспорта
-            export_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={sheet_id}"
-            
-            with st.spinner("Загрузка данных из Google Sheets..."):
-                # Загружаем с явным указанием разделителя и обработкой ошибок
-                df = pd.read_csv(export_url, on_bad_lines='skip')
+            with st.spinner(f"Загрузка данных из Google Sheets (листов: {len(gids)})..."):
+                # Листы качаются параллельно; свежие копии и ответы 304 берутся из кэша
+                with profiler.stage('load_sheets', cached=True):
+                    df, load_meta = load_sheets(spreadsheet_id, gids, force=force_refresh and load_button)
+                    if not load_meta['from_cache']:
+                        profiler.mark_miss()
                 
                 # Проверяем, что данные загрузились
-                if df.empty:
+                if load_meta['rows_raw'] == 0:
                     st.error("❌ Таблица пустая или не удалось загрузить данные")
                     st.info("💡 Проверьте настройки доступа к таблице")
-                    st.stop()
+                    stop()
+            st.session_state['sheets_loaded'] = sheets_url
             
-            st.success(f"✅ Данные загружены из Google Sheets ({len(df)} строк)")
+            statuses = {'fresh': 'из кэша', 'not_modified': 'не изменился', 'downloaded': 'загружен',
+                        'stale': 'сервер недоступен, старая копия'}
+            sheets_info = ", ".join(f"gid={sheet['gid']}: {statuses[sheet['status']]}"
+                                    for sheet in load_meta['sheets'])
+            st.success(f"✅ Данные загружены из Google Sheets ({load_meta['rows_raw']:,} строк; {sheets_info})")
+            stale = [f"gid={sheet['gid']} ({sheet['error']})" for sheet in load_meta['sheets']
+                     if sheet['status'] == 'stale']
+            if stale:
+                st.warning(f"⚠️ Не удалось обновить листы: {', '.join(stale)}. Показана ранее загруженная копия")
             
+        except ValueError as e:
+            # Неправильная ссылка или нет обязательных колонок
+            st.error(f"❌ {str(e)}")
+            stop()
         except pd.errors.ParserError as e:
             st.error(f"❌ Ошибка парсинга CSV: {str(e)}")
             st.info("💡 Проверьте формат данных в таблице")
-            st.stop()
+            stop()
         except Exception as e:
             st.error(f"❌ Ошибка загрузки: {str(e)}")
             st.info("""
@@ -86,38 +386,28 @@ else:  # Google Sheets
             2. Неправильная ссылка
             3. Проблемы с сетью
             """)
-            st.stop()
+            stop()
 
 if df is not None:
     
-    # Проверка колонок
-    required_cols = ['Magazin', 'Segment', 'Sum']
-    if not all(col in df.columns for col in required_cols):
-        st.error(f"❌ Таблица должна содержать колонки: {required_cols}")
-        st.info(f"📋 Найденные колонки: {', '.join(df.columns.tolist())}")
-        st.stop()
+    if load_meta['rows_dropped'] > 0:
+        st.warning(f"⚠️ Удалено {load_meta['rows_dropped']} строк с некорректными данными")
     
-    # КРИТИЧНО: Преобразуем типы данных (особенно важно для CSV из Google Sheets)
-    try:
-        # Очищаем и преобразуем числовые колонки
-        df['Sum'] = pd.to_numeric(df['Sum'].astype(str).str.replace(',', '.').str.replace(' ', ''), errors='coerce')
-        
-        # Удаляем строки с пустыми значениями
-        initial_rows = len(df)
-        df = df.dropna(subset=['Magazin', 'Segment', 'Sum'])
-        df = df[df['Sum'] > 0]  # Убираем нулевые и отрицательные суммы
-        
-        if len(df) < initial_rows:
-            st.warning(f"⚠️ Удалено {initial_rows - len(df)} строк с некорректными данными")
-        
-        if len(df) == 0:
-            st.error("❌ Не осталось валидных данных после очистки")
-            st.stop()
-            
-    except Exception as e:
-        st.error(f"❌ Ошибка обработки данных: {str(e)}")
-        st.info("💡 Проверьте, что колонка Sum содержит числовые значения")
-        st.stop()
+    if len(df) == 0:
+        st.error("❌ Не осталось валидных данных после очистки")
+        stop()
+    
+    # Ключ данных для кэша этапов: хэш файла (Excel) или содержимого таблицы
+    data_key = load_meta['key']
+    profiler.block("Подготовка: pivot и диагностика")
+    
+    # Матрица магазин × сегмент (этап pivot) нужна уже для анализа сегментов.
+    # Переключатель float32 находится в блоке 2, но читается здесь из session_state
+    use_float32 = st.session_state.get('use_float32', False)
+    float_dtype = 'float32' if use_float32 else 'float64'
+    matrix_key = f"{data_key}:float32" if use_float32 else data_key
+    pivot_table, pivot_pct = cached_pivot(data_key, float_dtype, df)
+    profiler.context.update(data_key=data_key, n_rows=len(df), n_stores=len(pivot_pct))
     
     # Формируем сообщение о загруженных данных
     info_msg = f"✅ Загружено: {len(df):,} строк, {df['Magazin'].nunique()} магазинов"
@@ -126,9 +416,10 @@ if df is not None:
     st.success(info_msg)
     
     # Диагностика (опционально)
-    with st.expander("🔍 Диагностика данных", expanded=False):
+    diagnostics = st.expander("🔍 Диагностика данных", expanded=False)
+    with diagnostics:
         st.write("**Типы данных:**")
-        st.write(df.dtypes)
+        st.write(df.dtypes.astype(str))
         st.write("**Первые строки:**")
         st.dataframe(df.head(3), use_container_width=True)
         st.write("**Статистика по Sum:**")
@@ -136,15 +427,33 @@ if df is not None:
         st.write(f"- Max: {df['Sum'].max():,.2f}")
         st.write(f"- Mean: {df['Sum'].mean():,.2f}")
         st.write(f"- Total: {df['Sum'].sum():,.2f}")
+        if 'from_cache' in load_meta:
+            st.write(f"**Кэш загрузки:** {'попадание' if load_meta['from_cache'] else 'промах (файл разобран и сохранен)'}")
+        rss = peak_rss_mb()
+        if rss is not None:
+            st.write(f"**Пиковая память процесса:** {rss:,.0f} МБ; матрица долей — {float_dtype}, "
+                     f"{pivot_pct.memory_usage(index=False).sum() / 1024 ** 2:,.1f} МБ")
+        if 'rows_per_second' in load_meta:
+            st.write(f"**Потоковое чтение:** прочитано {load_meta['rows_raw']:,} строк, "
+                     f"отброшено {load_meta['rows_dropped']:,}, {load_meta['seconds']:.1f} с "
+                     f"({load_meta['rows_per_second']:,.0f} строк/с)")
+    
+    # Заполняется в конце прогона, когда замеры всех блоков готовы
+    profile_panel = st.expander("⏱️ Профилирование этапов", expanded=False)
+    with profile_panel:
+        st.toggle("Трассировка выделений памяти (tracemalloc)", key='profile_trace_memory',
+                  help="Пик выделений по каждому этапу вместо роста пиковой памяти процесса. "
+                       "Замедляет код на чистом Python, включайте только для разбора")
     
     # --- БЛОК 1: АНАЛИЗ СЕГМЕНТОВ ---
+    profiler.block("Блок 1: анализ сегментов")
     st.header("1️⃣ Анализ товарных сегментов")
     
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("Структура оборота по сегментам")
-        segment_sales = df.groupby('Segment')['Sum'].sum().sort_values(ascending=False)
+        segment_sales = pivot_table.sum(axis=0).sort_values(ascending=False)
         
         # Безопасный расчет процентов
         total_sum = segment_sales.sum()
@@ -152,7 +461,7 @@ if df is not None:
             segment_pct = (segment_sales / total_sum * 100).round(2)
         else:
             st.error("❌ Сумма продаж равна 0")
-            st.stop()
+            stop()
         
         segment_df = pd.DataFrame({
             'Сегмент': segment_sales.index,
@@ -168,79 +477,152 @@ if df is not None:
         st.plotly_chart(fig_pie, use_container_width=True)
     
     # --- БЛОК 2: ПОСТРОЕНИЕ МАТРИЦЫ ---
+    profiler.block("Блок 2: матрица магазин × сегмент")
     st.header("2️⃣ Матрица магазин × сегмент")
     
-    # Агрегируем продажи по магазинам и сегментам
-    pivot = df.groupby(['Magazin', 'Segment'])['Sum'].sum().reset_index()
-    pivot_table = pivot.pivot(index='Magazin', columns='Segment', values='Sum').fillna(0)
-    
-    # Вычисляем доли сегментов для каждого магазина
-    pivot_pct = pivot_table.div(pivot_table.sum(axis=1), axis=0) * 100
-    
     # Проверка на достаточное количество магазинов
     n_stores = len(pivot_pct)
-    if n_stores < 3:
-        st.error(f"❌ Недостаточно магазинов для кластеризации: {n_stores}. Минимум: 3")
-        st.stop()
+    try:
+        engine.check_stores(pivot_pct)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        stop()
+    
+    # Режим большой сети: в браузер уходит одна страница матрицы и
+    # прореженный график PCA вместо всех магазинов
+    large_mode = st.toggle(
+        "Режим большой сети", value=n_stores > LARGE_NETWORK_STORES,
+        help=f"Постраничная матрица и агрегированный график PCA "
+             f"(по умолчанию включается при > {LARGE_NETWORK_STORES:,} магазинов)"
+    )
+    
+    st.toggle("float32 для долей и признаков", key='use_float32',
+              help="Вдвое меньше памяти под матрицы долей и стандартизованных признаков "
+                   "(обороты остаются в float64)")
     
     st.subheader("Доля сегментов в обороте каждого магазина (%)")
-    st.dataframe(pivot_pct.round(2).style.background_gradient(cmap='RdYlGn', axis=None), 
-                 use_container_width=True)
+    if large_mode:
+        col_p1, col_p2 = st.columns([1, 3])
+        with col_p1:
+            n_pages = -(-n_stores // TABLE_PAGE_ROWS)
+            page = st.number_input(f"Страница (из {n_pages:,})", min_value=1, max_value=n_pages, value=1)
+        page_df = table_page(pivot_pct, page)
+        # Шкала цвета общая для всех страниц, а раскрашивается только видимая
+        st.dataframe(page_df.round(2).style.background_gradient(
+                         cmap='RdYlGn', axis=None,
+                         vmin=float(pivot_pct.values.min()), vmax=float(pivot_pct.values.max())),
+                     use_container_width=True)
+        st.caption(f"Магазины {(page - 1) * TABLE_PAGE_ROWS + 1:,}–{min(page * TABLE_PAGE_ROWS, n_stores):,} "
+                   f"из {n_stores:,}")
+    else:
+        st.dataframe(pivot_pct.round(2).style.background_gradient(cmap='RdYlGn', axis=None), 
+                     use_container_width=True)
+    
+    # Ось признаков для кластеризации: сегменты (плотная матрица) или артикулы
+    # (разреженная матрица долей + TruncatedSVD)
+    feature_axis = 'Segment'
+    svd_components = None
+    if 'Art' in df.columns:
+        col_f1, col_f2 = st.columns([1, 1])
+        with col_f1:
+            feature_axes = {'Сегменты (Segment)': 'Segment', 'Артикулы (Art)': 'Art'}
+            feature_axis = feature_axes[st.radio("Признаки для кластеризации", list(feature_axes),
+                                                 horizontal=True)]
+        if feature_axis == 'Art':
+            with col_f2:
+                svd_components = st.number_input("Компонент SVD", min_value=2, max_value=300, value=50,
+                                                  help="Размерность сжатого представления артикульной матрицы")
+    
+    # Ключ кэша для всех этапов, зависящих от матрицы признаков
+    model_key = matrix_key if feature_axis == 'Segment' else f"{matrix_key}:Art:{svd_components}"
+    # Стандартизованные признаки (используются во всех последующих блоках)
+    with st.spinner("Подготовка признаков..."):
+        X_scaled, similarity_features, sparse_info = cached_features(model_key, feature_axis, svd_components,
+                                                                     df, pivot_pct)
+    if sparse_info is not None:
+        st.caption(
+            f"Матрица магазин × артикул: {len(pivot_pct)} × {sparse_info['n_features']:,}, "
+            f"заполненность {sparse_info['density']:.1%}. Кластеризация по {sparse_info['n_components']} "
+            f"компонентам SVD (объясненная дисперсия {sparse_info['explained_variance']:.1%}); "
+            f"профили кластеров ниже — в долях сегментов."
+        )
     
-    # Стандартизация данных (используется во всех последующих блоках)
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(pivot_pct)
+    # Матрицы расстояний (евклидова, манхэттенская) считаются один раз
+    # на набор данных, если помещаются в бюджет памяти
+    distance_matrices_fit = matrix_fits(n_stores, n_matrices=2)
     
     # --- БЛОК 3: ПОДБОР ОПТИМАЛЬНОГО КОЛИЧЕСТВА КЛАСТЕРОВ ---
+    profiler.block("Блок 3: подбор k")
     st.header("3️⃣ Подбор оптимального количества кластеров")
     
     with st.expander("⚙️ Настройки анализа", expanded=False):
-        col_s1, col_s2, col_s3 = st.columns(3)
+        col_s1, col_s2, col_s3, col_s4 = st.columns(4)
         with col_s1:
             min_k = st.number_input("Min кластеров", min_value=2, max_value=min(10, n_stores-1), value=2)
         with col_s2:
-            max_k = st.number_input("Max кластеров", min_value=2, max_value=min(15, n_stores-1), value=min(10, n_stores-1))
+            max_k = st.number_input("Max кластеров", min_value=2, max_value=min(pipeline.MAX_K_ADAPTIVE, n_stores-1),
+                                    value=min(10, n_stores-1),
+                                    help="Для больших k используйте адаптивный режим перебора")
         with col_s3:
             init_method = st.selectbox("Метод инициализации", ['k-means++', 'random'], index=0)
+        with col_s4:
+            n_jobs = st.number_input("Процессов", min_value=1, max_value=default_n_jobs(),
+                                     value=default_n_jobs(),
+                                     help="Параллельный перебор k; на малых данных считается последовательно")
+        sampled_silhouette = st.checkbox(
+            f"Силуэт по выборке ({SILHOUETTE_SAMPLE_SIZE:,} магазинов)",
+            value=not distance_matrices_fit and n_stores > SILHOUETTE_SAMPLE_SIZE,
+            help="Для очень больших сетей: оценка с 95% доверительным интервалом без матрицы n×n"
+        )
+        sweep_modes = {'Полный перебор': 'exhaustive', 'Адаптивный (сетка k + уточнение)': 'adaptive',
+                       'Инкрементальный (warm start)': 'warm',
+                       'Иерархический (Ward, разрезы дерева)': 'hierarchical'}
+        sweep_mode = sweep_modes[st.selectbox(
+            "Режим перебора", list(sweep_modes),
+            help="Адаптивный: KMeans только для грубой сетки k и уточнения вокруг пиков "
+                 "Silhouette, Calinski-Harabasz и локтя — для диапазонов до сотни k. "
+                 "Инкрементальный: решение для k+1 получается разбиением самого "
+                 "\"рыхлого\" кластера решения для k — заметно быстрее на больших данных. "
+                 "Иерархический: одно дерево Ward, метки для каждого k — его разрезы"
+        )]
+        compare_sweep = sweep_mode != 'exhaustive' and st.checkbox("Сравнить с полным перебором", value=False)
+    
+    silhouette_sample = SILHOUETTE_SAMPLE_SIZE if sampled_silhouette else None
+    D_euclidean = None
+    if distance_matrices_fit and not sampled_silhouette:
+        D_euclidean = cached_distances(model_key, 'euclidean', X_scaled)
     
     # Вычисляем метрики для разного количества кластеров
-    k_range = range(min_k, max_k + 1)
-    
-    silhouette_scores = []
-    davies_bouldin_scores = []
-    calinski_harabasz_scores = []
-    inertias = []
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i, k in enumerate(k_range):
-        status_text.text(f"Анализ {k} кластеров...")
-        kmeans_temp = KMeans(n_clusters=k, random_state=42, init=init_method, n_init=10)
-        labels_temp = kmeans_temp.fit_predict(X_scaled)
-        
-        silhouette_scores.append(silhouette_score(X_scaled, labels_temp))
-        davies_bouldin_scores.append(davies_bouldin_score(X_scaled, labels_temp))
-        calinski_harabasz_scores.append(calinski_harabasz_score(X_scaled, labels_temp))
-        inertias.append(kmeans_temp.inertia_)
-        
-        progress_bar.progress((i + 1) / len(k_range))
-    
-    progress_bar.empty()
-    status_text.empty()
-    
-    # Оптимальное количество кластеров
-    optimal_k_silhouette = k_range[np.argmax(silhouette_scores)]
-    optimal_k_davies = k_range[np.argmin(davies_bouldin_scores)]
-    optimal_k_calinski = k_range[np.argmax(calinski_harabasz_scores)]
-    
-    # Elbow method - находим точку максимального изгиба (максимальное абсолютное изменение)
-    if len(inertias) > 2:
-        inertia_diffs = np.abs(np.diff(inertias))
-        optimal_k_elbow_idx = np.argmax(inertia_diffs)
-        optimal_k_elbow = list(k_range)[optimal_k_elbow_idx]
-    else:
-        optimal_k_elbow = min_k + 1
+    k_range = engine.k_range_for(min_k, max_k, n_stores)
+    
+    sweep_tree = None
+    if sweep_mode == 'hierarchical':
+        sweep_tree = wait_for('sweep_tree', background(
+            'sweep_tree', ('linkage', model_key, *engine.SWEEP_LINKAGE),
+            run_linkage, model_key, *engine.SWEEP_LINKAGE, X_scaled, D_euclidean), "Построение дерева Ward")
+    
+    # Перебор k в фоне: пока он идет, на графике появляются уже посчитанные k.
+    # При сравнении с полным перебором адаптивный тоже считается с нуля
+    reuse_k = not (compare_sweep and sweep_mode == 'adaptive')
+    sweep_job = background(
+        'sweep', ('sweep', model_key, min_k, max_k, init_method, silhouette_sample, sweep_mode, reuse_k),
+        run_sweep, model_key, min_k, max_k, init_method, silhouette_sample, sweep_mode, reuse_k,
+        X_scaled, D_euclidean, n_jobs, sweep_tree)
+    sweep = wait_for('sweep', sweep_job, "Перебор k", None if sweep_mode == 'adaptive' else len(k_range),
+                     partial_sweep_figure)
+    # Посчитанные k (в адаптивном режиме — только часть диапазона)
+    k_values = sweep['k']
+    silhouette_scores = sweep['silhouette']
+    davies_bouldin_scores = sweep['davies_bouldin']
+    calinski_harabasz_scores = sweep['calinski_harabasz']
+    inertias = sweep['inertia']
+    
+    # Оптимальное количество кластеров (Elbow — точка максимального изменения inertia)
+    best_k = engine.optimal_k(sweep)
+    optimal_k_silhouette = best_k['silhouette']
+    optimal_k_davies = best_k['davies_bouldin']
+    optimal_k_calinski = best_k['calinski_harabasz']
+    optimal_k_elbow = best_k['elbow']
     
     col1, col2, col3, col4 = st.columns(4)
     with col1:
@@ -263,12 +645,12 @@ if df is not None:
         # Silhouette & Davies-Bouldin
         fig_metrics1 = go.Figure()
         fig_metrics1.add_trace(go.Scatter(
-            x=list(k_range), y=silhouette_scores, mode='lines+markers',
+            x=k_values, y=silhouette_scores, mode='lines+markers',
             name='Silhouette (↑ лучше)', line=dict(color='green', width=3),
             marker=dict(size=8)
         ))
         fig_metrics1.add_trace(go.Scatter(
-            x=list(k_range), y=davies_bouldin_scores, mode='lines+markers',
+            x=k_values, y=davies_bouldin_scores, mode='lines+markers',
             name='Davies-Bouldin (↓ лучше)', line=dict(color='red', width=3),
             marker=dict(size=8), yaxis='y2'
         ))
@@ -286,7 +668,7 @@ if df is not None:
         # Elbow method
         fig_elbow = go.Figure()
         fig_elbow.add_trace(go.Scatter(
-            x=list(k_range), y=inertias, mode='lines+markers',
+            x=k_values, y=inertias, mode='lines+markers',
             name='Inertia', line=dict(color='blue', width=3),
             marker=dict(size=10, color=inertias, colorscale='Viridis', showscale=True)
         ))
@@ -304,7 +686,7 @@ if df is not None:
     # Таблица всех метрик
     with st.expander("📊 Детальная таблица метрик"):
         metrics_df = pd.DataFrame({
-            'K': list(k_range),
+            'K': k_values,
             'Silhouette': [f"{x:.4f}" for x in silhouette_scores],
             'Davies-Bouldin': [f"{x:.4f}" for x in davies_bouldin_scores],
             'Calinski-Harabasz': [f"{x:.0f}" for x in calinski_harabasz_scores],
@@ -312,20 +694,54 @@ if df is not None:
         })
         st.dataframe(metrics_df, use_container_width=True, hide_index=True)
     
-    # ИСПРАВЛЕНО: правильная индексация
-    silhouette_optimal_idx = optimal_k_silhouette - min_k
+    sweep_full = None
+    if compare_sweep:
+        # Оба перебора сравнения считаются без метрик k других переборов, иначе
+        # время занижено. Полный перебор тоже кэшируется, поэтому сравнение
+        # платится один раз; пока он считается в фоне, страница уже доступна
+        sweep_full = wait_for('sweep_full', background(
+            'sweep_full', ('sweep', model_key, min_k, max_k, init_method, silhouette_sample, 'exhaustive', False),
+            run_sweep, model_key, min_k, max_k, init_method, silhouette_sample, 'exhaustive', False,
+            X_scaled, D_euclidean, n_jobs), "Полный перебор для сравнения", len(k_range), block=False)
+    if sweep_full is not None:
+        saving = sweep_full['elapsed'] - sweep['elapsed']
+        # Сравнение — на k, посчитанных обоими режимами
+        full_idx = [sweep_full['k'].index(k) for k in k_values]
+        max_diffs = {name: np.max(np.abs(np.subtract(sweep[name], np.take(sweep_full[name], full_idx))))
+                     for name in ['silhouette', 'davies_bouldin', 'calinski_harabasz']}
+        full_inertia = np.take(sweep_full['inertia'], full_idx)
+        inertia_diff = np.max(np.abs(np.subtract(sweep['inertia'], full_inertia)) / full_inertia)
+        st.caption(
+            f"⏱️ Выбранный режим: {sweep['elapsed']:.2f} с ({len(k_values)} из {len(k_range)} k), "
+            f"полный перебор: {sweep_full['elapsed']:.2f} с "
+            f"(экономия {saving:.2f} с, {saving / max(sweep_full['elapsed'], 1e-9):.0%}). "
+            f"Макс. расхождение: Silhouette {max_diffs['silhouette']:.4f}, "
+            f"Davies-Bouldin {max_diffs['davies_bouldin']:.4f}, "
+            f"Calinski-Harabasz {max_diffs['calinski_harabasz']:.1f}, Inertia {inertia_diff:.2%}"
+        )
+        if engine.optimal_k(sweep_full)['silhouette'] != optimal_k_silhouette:
+            st.warning(f"⚠️ Полный перебор рекомендует другое k по Silhouette: "
+                       f"{engine.optimal_k(sweep_full)['silhouette']}")
+    
+    if sweep_mode == 'adaptive':
+        st.caption(f"Адаптивный перебор: посчитано {len(k_values)} из {len(k_range)} значений k "
+                   f"({', '.join(map(str, k_values))})")
+    
+    silhouette_optimal_idx = k_values.index(optimal_k_silhouette)
     st.info(f"""
     **Рекомендация:** Оптимальное количество кластеров — **{optimal_k_silhouette}** 
     (по Silhouette Score: {silhouette_scores[silhouette_optimal_idx]:.3f})
     """)
     
     # --- БЛОК 4: КЛАСТЕРИЗАЦИЯ ---
+    profiler.block("Блок 4: кластеризация")
     st.header("4️⃣ Кластеризация магазинов")
     
     col1, col2, col3, col4 = st.columns([1, 1, 1, 1])
     
     with col1:
-        n_clusters = st.slider("Количество кластеров", min_value=2, max_value=min(10, n_stores-1), value=optimal_k_silhouette)
+        n_clusters = st.slider("Количество кластеров", min_value=2, max_value=min(max(10, max_k), n_stores-1),
+                               value=optimal_k_silhouette)
     
     with col2:
         random_state = st.number_input("Random state", value=42, min_value=0)
@@ -337,28 +753,57 @@ if df is not None:
         distance_metric = st.selectbox("Расстояние", ['euclidean', 'manhattan'], 
                                        help="Метрика расстояния между точками")
     
-    # Кластеризация
-    # ИСПРАВЛЕНО: раздельная обработка для разных алгоритмов
+    fit_engine = 'kmeans'
+    batch_size = 1024
     if distance_metric == 'euclidean':
-        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state, 
-                       init=init_method, n_init=10, max_iter=max_iter)
-        clusters = kmeans.fit_predict(X_scaled)
-        has_inertia = True
-    else:
-        # Для Manhattan используем иерархическую кластеризацию
-        from sklearn.cluster import AgglomerativeClustering
-        kmeans = AgglomerativeClustering(n_clusters=n_clusters, metric='manhattan', linkage='average')
-        clusters = kmeans.fit_predict(X_scaled)
-        has_inertia = False
+        col_e1, col_e2 = st.columns([1, 1])
+        with col_e1:
+            engines = {'KMeans': 'kmeans', 'MiniBatchKMeans': 'minibatch'}
+            fit_engine = engines[st.selectbox(
+                "Алгоритм", list(engines),
+                help="MiniBatchKMeans обучается блоками строк — для очень больших матриц"
+            )]
+        with col_e2:
+            if fit_engine == 'minibatch':
+                batch_size = st.number_input("Размер блока (batch size)", value=1024,
+                                             min_value=64, max_value=100_000, step=256)
+    
+    # Кластеризация
+    # Параметры KMeans не влияют на иерархическую кластеризацию (Manhattan)
+    # и не должны инвалидировать ее кэш
+    fit_params = engine.fit_params_for({
+        'distance_metric': distance_metric, 'engine': fit_engine, 'random_state': random_state,
+        'init_method': init_method, 'max_iter': max_iter, 'batch_size': batch_size,
+    })
+    fit_key = (n_clusters, distance_metric, fit_params)
+    
+    manhattan_tree = None
+    if distance_metric == 'manhattan':
+        # Дерево average/manhattan общее с дендрограммой при тех же параметрах
+        D_manhattan = cached_distances(model_key, 'manhattan', X_scaled) if distance_matrices_fit else None
+        manhattan_tree = wait_for('fit_tree', background(
+            'fit_tree', ('linkage', model_key, *engine.MANHATTAN_LINKAGE),
+            run_linkage, model_key, *engine.MANHATTAN_LINKAGE, X_scaled, D_manhattan), "Построение иерархии")
+    
+    clusters, inertia, quality = wait_for('fit', background(
+        'fit', ('fit', model_key, fit_key, silhouette_sample),
+        run_fit, model_key, n_clusters, distance_metric, fit_params, silhouette_sample,
+        X_scaled, D_euclidean, manhattan_tree), "Кластеризация")
+    has_inertia = inertia is not None
     
     # Метрики качества
-    silhouette = silhouette_score(X_scaled, clusters)
-    davies_bouldin = davies_bouldin_score(X_scaled, clusters)
-    calinski_harabasz = calinski_harabasz_score(X_scaled, clusters)
+    silhouette = quality['silhouette']
+    davies_bouldin = quality['davies_bouldin']
+    calinski_harabasz = quality['calinski_harabasz']
+    # Метрики, которые попадают в модель и Excel-отчет
+    quality_summary = {name: float(quality[name]) for name in engine.QUALITY_METRICS}
     
     col_m1, col_m2, col_m3, col_m4 = st.columns(4)
     with col_m1:
-        st.metric("Silhouette Score", f"{silhouette:.3f}", 
+        silhouette_label = f"{silhouette:.3f}"
+        if quality['silhouette_ci'] > 0:
+            silhouette_label += f" ± {quality['silhouette_ci']:.3f}"
+        st.metric("Silhouette Score", silhouette_label, 
                   help="0.5-0.7: хорошо, >0.7: отлично")
     with col_m2:
         st.metric("Davies-Bouldin", f"{davies_bouldin:.3f}",
@@ -369,64 +814,184 @@ if df is not None:
     with col_m4:
         # ИСПРАВЛЕНО: корректная проверка наличия inertia
         if has_inertia:
-            st.metric("Inertia", f"{kmeans.inertia_:.2f}",
+            st.metric("Inertia", f"{inertia:.2f}",
                       help="Сумма квадратов расстояний")
         else:
             st.metric("Метод", "Agglomerative", help="Иерархическая кластеризация")
     
-    # Добавляем кластеры в данные
-    # ИСПРАВЛЕНО: создаем копию для избежания проблем с индексацией
-    pivot_pct_clustered = pivot_pct.copy()
-    pivot_pct_clustered['Кластер'] = clusters
-    pivot_pct_clustered = pivot_pct_clustered.sort_values('Кластер')
+    # Сохраняемая модель: новые данные относятся к тем же кластерам без перекластеризации
+    with st.expander("💾 Модель кластеров: сохранение и назначение новых магазинов"):
+        if feature_axis != 'Segment':
+            st.info("Модель сохраняется только для кластеризации по сегментам")
+        else:
+            col_mdl1, col_mdl2 = st.columns(2)
+            with col_mdl1:
+                st.download_button(
+                    label="📥 Скачать модель (.npz)",
+                    data=cached_model_bytes(model_key, fit_key, distance_metric, pivot_pct, clusters,
+                                            quality_summary, cached_pca(model_key, X_scaled)[0]),
+                    file_name=f"store_clusters_model_k{n_clusters}.npz",
+                    mime="application/octet-stream"
+                )
+                st.caption(f"Центры {n_clusters} кластеров, статистики стандартизации и порядок "
+                           f"{pivot_pct.shape[1]} сегментов. Пакетно: `python cli.py <каталог> --assign <модель>`")
+            with col_mdl2:
+                model_file = st.file_uploader("Сохраненная модель", type=['npz'], key='model_file')
+            if model_file is not None:
+                try:
+                    saved_model = ClusterModel.load(model_file.getvalue())
+                except (ValueError, KeyError) as e:
+                    st.error(f"❌ Не удалось прочитать модель: {e}")
+                else:
+                    assigned = saved_model.assign(pivot_pct)
+                    drift = saved_model.drift(pivot_pct, assigned)
+                    col_dr1, col_dr2, col_dr3, col_dr4 = st.columns(4)
+                    col_dr1.metric("Дрейф расстояний", f"×{drift['distance_ratio']:.2f}",
+                                   help="Средняя дистанция до центра относительно обучающей выборки")
+                    col_dr2.metric("Вне модели", f"{drift['outlier_share']:.0%}",
+                                   help="Доля магазинов дальше 95-го перцентиля обучения")
+                    col_dr3.metric("Новые сегменты", f"{drift['unseen_share']:.1f}%",
+                                   help="Средняя доля оборота в сегментах, которых нет в модели")
+                    col_dr4.metric("Сдвиг структуры", f"{drift['cluster_share_shift']:.0%}",
+                                   help="Насколько изменились доли кластеров в сети")
+                    if drift['refit_recommended']:
+                        st.warning("⚠️ Данные заметно отличаются от обучающих — рекомендуется перекластеризация")
+                    else:
+                        st.success("✅ Модель актуальна: новые магазины можно назначать без перекластеризации")
+                    if drift['unseen_segments']:
+                        st.caption(f"Сегменты, которых нет в модели: {', '.join(drift['unseen_segments'])}")
+                    st.dataframe(assigned, use_container_width=True, hide_index=True)
+                    if saved_model.projection is not None:
+                        # Координаты в осях PC1–PC2 обучающей выборки модели (без нового PCA)
+                        fig_assigned, _ = pca_scatter_figure(
+                            assigned[['PC1', 'PC2']].to_numpy(), assigned['Кластер'], assigned['Магазин'],
+                            title="Назначенные магазины в осях главных компонент модели",
+                            point_budget=POINT_BUDGET if large_mode else None
+                        )
+                        st.plotly_chart(fig_assigned, use_container_width=True)
+                    st.download_button(
+                        label="📥 Скачать назначения (CSV)",
+                        data=assigned.to_csv(index=False, encoding='utf-8-sig'),
+                        file_name="store_assignments.csv",
+                        mime="text/csv"
+                    )
+                    
+                    # Теплый старт от центров модели: номера кластеров сохраняются
+                    if st.checkbox("🔄 Перекластеризовать с теплым стартом от модели",
+                                   help="KMeans стартует с центров сохраненной модели, новые кластеры "
+                                        "сопоставляются старым (венгерский алгоритм)"):
+                        warm = cached_warm_recluster(data_key, content_hash(model_file.getvalue()), df,
+                                                     saved_model)
+                        if warm['warm_start']:
+                            st.caption(f"Теплый старт: {warm['n_iter']} итераций KMeans, {warm['seconds']:.2f} с, "
+                                       f"inertia {warm['inertia']:.2f}")
+                        else:
+                            st.caption(f"Модель с метрикой {saved_model.metric}: кластеризация выполнена заново "
+                                       f"({warm['seconds']:.2f} с), номера сопоставлены по центрам")
+                        if warm['migration'] is not None:
+                            st.markdown("**Матрица миграции** (строки — кластер в модели, колонки — новый):")
+                            st.dataframe(warm['migration'], use_container_width=True)
+                            if len(warm['moved']):
+                                st.dataframe(warm['moved'], use_container_width=True, hide_index=True)
+                            else:
+                                st.success("✅ Ни один магазин не сменил кластер")
+                        st.download_button(
+                            label="📥 Скачать обновленную модель (.npz)",
+                            data=warm['model'].to_bytes(),
+                            file_name="store_clusters_model_warm.npz",
+                            mime="application/octet-stream"
+                        )
+    
+    # Устойчивость: та же конфигурация на повторных выборках магазинов (по кнопке — расчет долгий)
+    with st.expander("🧪 Устойчивость кластеров (повторные выборки)"):
+        col_st1, col_st2, col_st3 = st.columns([2, 2, 1])
+        with col_st1:
+            stability_resamples = st.slider("Максимум выборок", 20, 500, DEFAULT_RESAMPLES, step=10,
+                                            help="Расчет останавливается раньше, когда оценки сходятся")
+        with col_st2:
+            stability_mode = st.radio("Выборки", ['subsample', 'bootstrap'], horizontal=True,
+                                      format_func={'subsample': "Подвыборки 80%",
+                                                   'bootstrap': "Bootstrap"}.get)
+        with col_st3:
+            stability_requested = st.button("Рассчитать", key='stability_run')
+        
+        stability_args = (model_key, fit_key, stability_resamples, stability_mode)
+        if stability_requested:
+            st.session_state['stability_args'] = stability_args
+        if st.session_state.get('stability_args') == stability_args:
+            with progress_bar("Повторное обучение", "выборок") as progress:
+                stability = cached_stability(*stability_args, X_scaled, clusters, pivot_pct.index, n_jobs,
+                                             _progress=progress)
+            low, high = stability['ari_interval']
+            col_sr1, col_sr2, col_sr3 = st.columns(3)
+            col_sr1.metric("Средний ARI", f"{stability['ari_mean']:.3f}",
+                           help="Согласие исходного разбиения с повторными обучениями (1 — полное)")
+            col_sr2.metric("95% интервал ARI", f"{low:.2f} – {high:.2f}")
+            col_sr3.metric("Выборок", stability['n_resamples'],
+                           help="Сошлось досрочно" if stability['converged'] else "Лимит выборок исчерпан")
+            st.dataframe(stability['clusters'].round(3), use_container_width=True, hide_index=True)
+            st.caption(f"Жаккар — средний максимальный индекс Жаккара кластера с кластерами повторных обучений: "
+                       f"≥{STABLE_JACCARD} — устойчивый, <{DISSOLVED_JACCARD} — распадается")
+            fig_ari = px.histogram(x=stability['ari'], nbins=30, labels={'x': 'ARI'},
+                                   title="Распределение ARI по выборкам")
+            fig_ari.update_layout(height=300, showlegend=False)
+            st.plotly_chart(fig_ari, use_container_width=True)
+            st.markdown("**Наименее устойчивые магазины:**")
+            st.dataframe(stability['stores'].head(20).round(3), use_container_width=True, hide_index=True)
+            st.download_button(
+                label="📥 Устойчивость всех магазинов (CSV)",
+                data=stability['stores'].to_csv(index=False, encoding='utf-8-sig'),
+                file_name=f"store_stability_k{n_clusters}.csv",
+                mime="text/csv"
+            )
+    
+    # Добавляем кластеры и оборот магазинов в данные (как в пакетном запуске)
+    pivot_pct_clustered = engine.clustered_table(pivot_table, pivot_pct, clusters)
     
     # --- БЛОК 5: ВИЗУАЛИЗАЦИЯ КЛАСТЕРОВ В 2D (PCA) ---
+    profiler.block("Блок 5: PCA")
     st.subheader("Визуализация кластеров в 2D (PCA)")
     
     col_v1, col_v2 = st.columns([2, 1])
     
     with col_v1:
         # PCA для визуализации
-        pca = PCA(n_components=2)
-        X_pca = pca.fit_transform(X_scaled)
-        
-        pca_df = pd.DataFrame({
-            'PC1': X_pca[:, 0],
-            'PC2': X_pca[:, 1],
-            'Кластер': [f"Кластер {c}" for c in clusters],
-            'Магазин': pivot_pct.index
-        })
+        projection, X_pca = cached_pca(model_key, X_scaled,
+                                       sparse_info['explained_variance'] if feature_axis != 'Segment' else None)
+        explained_variance_ratio = projection.explained_variance_ratio
         
-        fig_pca = px.scatter(
-            pca_df, x='PC1', y='PC2', color='Кластер',
-            hover_data=['Магазин'],
-            title=f"Кластеры в пространстве главных компонент (объясненная дисперсия: {pca.explained_variance_ratio_.sum():.1%})",
-            color_discrete_sequence=px.colors.qualitative.Set2
+        fig_pca, pca_info = pca_scatter_figure(
+            X_pca, clusters, pivot_pct.index,
+            title=f"Кластеры в пространстве главных компонент (объясненная дисперсия: {explained_variance_ratio.sum():.1%})",
+            point_budget=POINT_BUDGET if large_mode else None
         )
-        fig_pca.update_traces(marker=dict(size=12, line=dict(width=2, color='white')))
-        fig_pca.update_layout(height=500)
         st.plotly_chart(fig_pca, use_container_width=True)
+        if pca_info['sampled']:
+            st.caption(f"Показано {pca_info['n_shown']:,} из {pca_info['n_points']:,} магазинов "
+                       f"(выборка по кластерам); серая подложка — плотность всех магазинов")
+        st.caption(f"Проекция: {PROJECTION_LABELS[projection.method]}")
     
     with col_v2:
         st.markdown("**Объясненная дисперсия:**")
         variance_df = pd.DataFrame({
             'Компонента': ['PC1', 'PC2'],
-            'Дисперсия, %': [f"{x*100:.1f}%" for x in pca.explained_variance_ratio_]
+            'Дисперсия, %': [f"{x*100:.1f}%" for x in explained_variance_ratio]
         })
         st.dataframe(variance_df, use_container_width=True, hide_index=True)
         
         st.markdown("**Интерпретация:**")
         st.markdown(f"""
-        - PC1: {pca.explained_variance_ratio_[0]*100:.1f}% вариации
-        - PC2: {pca.explained_variance_ratio_[1]*100:.1f}% вариации
+        - PC1: {explained_variance_ratio[0]*100:.1f}% вариации
+        - PC2: {explained_variance_ratio[1]*100:.1f}% вариации
         - Близкие точки = похожие магазины
         """)
     
     # --- БЛОК 6: ПРОФИЛИ КЛАСТЕРОВ ---
+    profiler.block("Блок 6: профили кластеров")
     st.subheader("Профили кластеров")
     
     # ИСПРАВЛЕНО: используем копию без колонки Оборот
-    cluster_profiles = pivot_pct_clustered.drop(columns=['Кластер'], errors='ignore').groupby(pivot_pct_clustered['Кластер']).mean()
+    cluster_profiles = cached_profiles(model_key, fit_key, pivot_pct, clusters)
     
     # Тепловая карта
     fig_heatmap = px.imshow(
@@ -441,12 +1006,9 @@ if df is not None:
     st.plotly_chart(fig_heatmap, use_container_width=True)
     
     # --- БЛОК 7: СТАТИСТИКА ПО КЛАСТЕРАМ ---
+    profiler.block("Блок 7: статистика кластеров")
     st.header("7️⃣ Характеристика кластеров")
     
-    # Добавляем оборот магазинов
-    store_totals = df.groupby('Magazin')['Sum'].sum()
-    pivot_pct_clustered['Оборот_магазина'] = pivot_pct_clustered.index.map(store_totals)
-    
     for cluster_id in range(n_clusters):
         with st.expander(f"**Кластер {cluster_id}** ({(clusters == cluster_id).sum()} магазинов)", expanded=True):
             cluster_data = pivot_pct_clustered[pivot_pct_clustered['Кластер'] == cluster_id]
@@ -486,46 +1048,79 @@ if df is not None:
             st.markdown("---")
     
     # --- БЛОК 8: ИЕРАРХИЧЕСКАЯ КЛАСТЕРИЗАЦИЯ (ДЕНДРОГРАММА) ---
+    profiler.block("Блок 8: дендрограмма")
     st.header("8️⃣ Дендрограмма (иерархическая кластеризация)")
     
     with st.expander("📊 Показать дендрограмму", expanded=False):
-        linkage_method = st.selectbox("Метод связи", ['ward', 'average', 'complete', 'single'])
-        
-        # Вычисляем linkage matrix
-        Z = linkage(X_scaled, method=linkage_method)
-        
-        # Создаем дендрограмму
-        fig_dendr = go.Figure()
-        
-        dendr = dendrogram(Z, labels=pivot_pct.index.tolist(), no_plot=True)
-        
-        icoord = np.array(dendr['icoord'])
-        dcoord = np.array(dendr['dcoord'])
-        
-        for i in range(len(icoord)):
-            fig_dendr.add_trace(go.Scatter(
-                x=icoord[i], y=dcoord[i],
-                mode='lines',
-                line=dict(color='rgb(100,100,100)', width=1),
-                hoverinfo='skip',
-                showlegend=False
-            ))
-        
-        # ИСПРАВЛЕНО: правильные позиции для меток
-        leaves_positions = dendr['leaves']
-        leaves_labels = [pivot_pct.index[i] for i in leaves_positions]
-        tick_positions = [5 + i*10 for i in range(len(leaves_labels))]
-        
-        fig_dendr.update_layout(
-            title="Дендрограмма: иерархия схожести магазинов",
-            xaxis=dict(title="Магазины", ticktext=leaves_labels, 
-                      tickvals=tick_positions),
-            yaxis_title="Расстояние",
-            height=600,
-            hovermode='closest'
-        )
+        col_d1, col_d2 = st.columns(2)
+        with col_d1:
+            linkage_method = st.selectbox("Метод связи", LINKAGE_METHODS)
+        with col_d2:
+            # Ward определен только для евклидова расстояния
+            linkage_metric = st.selectbox("Метрика", LINKAGE_METRICS if linkage_method != 'ward' else ['euclidean'])
+        
+        # Вычисляем linkage matrix (из кэша, если дерево уже строилось для перебора или кластеризации)
+        if linkage_metric == 'euclidean':
+            D_linkage = D_euclidean
+        else:
+            D_linkage = cached_distances(model_key, 'manhattan', X_scaled) if distance_matrices_fit else None
+        # Дерево строится в фоне: остальная страница не ждет его
+        Z = wait_for('dendrogram', background(
+            'dendrogram', ('linkage', model_key, linkage_method, linkage_metric),
+            run_linkage, model_key, linkage_method, linkage_metric, X_scaled, D_linkage),
+            "Построение иерархии", block=False)
+        if Z is not None:
+            # Большие деревья по умолчанию усекаются до последних p слияний
+            n_leaves_total = len(Z) + 1
+            col_d3, col_d4 = st.columns(2)
+            with col_d3:
+                truncate_mode = st.selectbox(
+                    "Усечение дерева", TRUNCATE_MODES,
+                    index=1 if n_leaves_total > 200 else 0,
+                    format_func=lambda m: {None: "Без усечения", 'lastp': "Последние p слияний",
+                                           'level': "p уровней от корня"}[m]
+                )
+            with col_d4:
+                truncate_p = st.number_input("p", min_value=2, max_value=500, value=30,
+                                             disabled=truncate_mode is None)
+        
+            # Корень раскрытого по клику поддерева; сбрасывается при смене дерева
+            tree_state = (model_key, linkage_method, linkage_metric)
+            if st.session_state.get('dendro_tree') != tree_state:
+                st.session_state['dendro_tree'] = tree_state
+                st.session_state['dendro_root'] = None
+            dendro_root = st.session_state['dendro_root']
         
-        st.plotly_chart(fig_dendr, use_container_width=True)
+            if dendro_root is not None:
+                if st.button("⬆️ Вернуться к полному дереву"):
+                    st.session_state['dendro_root'] = None
+                    st.rerun()
+        
+            fig_dendr, dendro_info = dendrogram_figure(
+                Z, pivot_pct.index, truncate_mode=truncate_mode, p=int(truncate_p), root=dendro_root
+            )
+            render_started = time.perf_counter()
+            dendro_event = st.plotly_chart(fig_dendr, use_container_width=True, key='dendrogram',
+                                           on_select="rerun", selection_mode="points")
+            dendro_info['render_seconds'] = time.perf_counter() - render_started
+            if dendro_info['n_groups']:
+                st.caption(f"🔴 Красные точки — свернутые группы ({dendro_info['n_groups']}): "
+                           "кликните, чтобы раскрыть поддерево")
+        
+            # Клик по свернутой группе раскрывает ее поддерево
+            clicked = [pt for pt in dendro_event.selection.points if pt.get('curve_number') == 1]
+            if clicked:
+                node = dendro_info['leaf_nodes'][clicked[0]['point_index']]
+                if node >= n_leaves_total and node != dendro_root:
+                    st.session_state['dendro_root'] = node
+                    st.rerun()
+        
+            with diagnostics:
+                st.write(f"**Дендрограмма:** {dendro_info['n_leaves']:,} листьев"
+                         f"{' (WebGL)' if dendro_info['webgl'] else ''}, "
+                         f"{dendro_info['payload_bytes'] / 1024:,.0f} КБ JSON, "
+                         f"построение {dendro_info['build_seconds']:.2f} с, "
+                         f"отправка {dendro_info['render_seconds']:.2f} с")
         
         st.info("""
         **Как читать:** Чем ниже точка слияния, тем более похожи магазины.
@@ -533,12 +1128,17 @@ if df is not None:
         """)
     
     # --- БЛОК 9: СРАВНЕНИЕ МАГАЗИНОВ ---
+    profiler.block("Блок 9: похожие магазины")
     st.header("9️⃣ Поиск похожих магазинов")
     
+    # Косинусный индекс по профилям: доли сегментов или разреженные доли артикулов
+    neighbor_index = cached_neighbor_index(model_key, fit_key, pivot_pct, clusters, similarity_features)
+    
     col_c1, col_c2 = st.columns([1, 2])
     
     with col_c1:
         selected_store = st.selectbox("Выберите магазин:", pivot_pct.index.tolist())
+        same_cluster_only = st.checkbox("Только из того же кластера", value=False)
     
     if selected_store:
         store_cluster = pivot_pct_clustered.loc[selected_store, 'Кластер']
@@ -546,24 +1146,8 @@ if df is not None:
         # Извлекаем профиль магазина
         store_profile = pivot_pct.loc[selected_store]
         
-        # Находим самые похожие магазины (по косинусному расстоянию)
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        # Вычисляем схожесть со всеми магазинами
-        similarities = cosine_similarity([store_profile], pivot_pct)[0]
-        
-        # Создаем DataFrame для удобной работы
-        similarity_df = pd.DataFrame({
-            'Магазин': pivot_pct.index,
-            'Схожесть': similarities,
-            'Кластер': pivot_pct_clustered['Кластер'].values
-        })
-        
-        # КРИТИЧНО: Явно исключаем выбранный магазин
-        similarity_df = similarity_df[similarity_df['Магазин'] != selected_store]
-        
-        # Сортируем по схожести и берем топ-5
-        similarity_df = similarity_df.sort_values('Схожесть', ascending=False).head(5)
+        # Находим самые похожие магазины (по косинусному расстоянию), топ-5
+        similarity_df = neighbor_index.query(selected_store, top_n=5, same_cluster=same_cluster_only)
         
         similar_stores = similarity_df['Магазин'].values
         similar_scores = similarity_df['Схожесть'].values
@@ -602,7 +1186,25 @@ if df is not None:
         fig_compare.update_layout(height=400)
         st.plotly_chart(fig_compare, use_container_width=True)
     
+    with st.expander("🔀 Похожие магазины для всей сети (пары для A/B тестов)"):
+        col_n1, col_n2 = st.columns([1, 2])
+        with col_n1:
+            pairs_top_n = st.number_input("Соседей на магазин", min_value=1,
+                                          max_value=min(50, n_stores - 1), value=min(5, n_stores - 1))
+        with col_n2:
+            pairs_same_cluster = st.checkbox("Только внутри кластера", value=True)
+        
+        if st.button("Рассчитать соседей для всех магазинов"):
+            pairs_csv = cached_neighbor_pairs(model_key, fit_key, pairs_top_n, pairs_same_cluster, neighbor_index)
+            st.download_button(
+                label="📥 Скачать пары магазинов (CSV)",
+                data=pairs_csv,
+                file_name=f"store_neighbors_top{pairs_top_n}.csv",
+                mime="text/csv"
+            )
+    
     # --- БЛОК 10: РЕКОМЕНДАЦИИ ---
+    profiler.block("Блок 10: рекомендации")
     st.header("🎯 Рекомендации по оптимизации")
     
     rec_col1, rec_col2 = st.columns(2)
@@ -638,12 +1240,74 @@ if df is not None:
         - Calinski-Harabasz: {calinski_harabasz:.0f}
         """)
     
+    # Прогноз оборота кластеров по датам продаж (по кнопке — обучение Prophet долгое)
+    forecast = None
+    forecast_args = None
+    with st.expander("📈 Прогноз оборота кластеров (Prophet)"):
+        if not has_dates(df):
+            st.info("Для прогноза нужна колонка **Date** с датой продажи "
+                    "(при потоковой загрузке CSV даты не сохраняются)")
+        else:
+            col_fc1, col_fc2, col_fc3, col_fc4 = st.columns([2, 2, 2, 1])
+            with col_fc1:
+                forecast_freq = st.radio("Период", list(FREQS), horizontal=True, format_func=FREQS.get,
+                                         key='forecast_freq')
+            with col_fc2:
+                forecast_horizon = st.number_input("Горизонт, периодов", 1, 365, DEFAULT_HORIZON[forecast_freq],
+                                                   key=f'forecast_horizon_{forecast_freq}')
+            with col_fc3:
+                forecast_by_segment = st.checkbox("По кластеру × сегменту", value=False, key='forecast_by_segment',
+                                                  help="Отдельный ряд для каждого сегмента кластера")
+            with col_fc4:
+                forecast_requested = st.button("Построить", key='forecast_run')
+            
+            current_forecast_args = (model_key, fit_key, forecast_freq, int(forecast_horizon), forecast_by_segment)
+            if forecast_requested:
+                st.session_state['forecast_args'] = current_forecast_args
+            if st.session_state.get('forecast_args') == current_forecast_args:
+                forecast_args = current_forecast_args
+                with progress_bar("Обучение Prophet", "рядов") as progress:
+                    forecast = cached_forecast(*forecast_args, df, pivot_pct.index, clusters, n_jobs,
+                                               _progress=progress)
+                summary = forecast['summary']
+                if (summary['Модель'] == 'short').any():
+                    st.warning(f"Рядов с недостаточной историей (без прогноза): {(summary['Модель'] == 'short').sum()}")
+                st.dataframe(summary.round(1), use_container_width=True, hide_index=True)
+                
+                # График — по кластерам (при разбивке по сегментам ряды суммируются)
+                history = forecast['history'].groupby(['Кластер', 'ds'], as_index=False)['y'].sum()
+                future = forecast['forecast'].groupby(['Кластер', 'ds'], as_index=False)[
+                    ['yhat', 'yhat_lower', 'yhat_upper']].sum()
+                fig_fc = go.Figure()
+                colors = px.colors.qualitative.Plotly
+                for cluster_id in sorted(history['Кластер'].unique()):
+                    color = colors[int(cluster_id) % len(colors)]
+                    hist = history[history['Кластер'] == cluster_id]
+                    fut = future[future['Кластер'] == cluster_id]
+                    fig_fc.add_trace(go.Scatter(x=hist['ds'], y=hist['y'], name=f"Кластер {cluster_id}",
+                                                line=dict(color=color), legendgroup=str(cluster_id)))
+                    if fut.empty:
+                        continue
+                    fig_fc.add_trace(go.Scatter(
+                        x=pd.concat([fut['ds'], fut['ds'][::-1]]),
+                        y=pd.concat([fut['yhat_upper'], fut['yhat_lower'][::-1]]),
+                        fill='toself', fillcolor=color, opacity=0.2, line=dict(width=0),
+                        legendgroup=str(cluster_id), showlegend=False, hoverinfo='skip'))
+                    fig_fc.add_trace(go.Scatter(x=fut['ds'], y=fut['yhat'], name=f"Прогноз {cluster_id}",
+                                                line=dict(color=color, dash='dash'), legendgroup=str(cluster_id),
+                                                showlegend=False))
+                fig_fc.update_layout(title="Оборот кластеров: факт и прогноз", xaxis_title="Период",
+                                     yaxis_title="Оборот", height=450)
+                st.plotly_chart(fig_fc, use_container_width=True)
+                st.caption("Пунктир — прогноз, заливка — 80% интервал. Прогноз добавлен листом "
+                           "\"Прогноз\" в Excel-отчет ниже.")
+    
     # --- БЛОК 11: EXPORT ---
+    profiler.block("Блок 11: экспорт")
     st.header("📥 Экспорт результатов")
     
     # Подготовка итоговой таблицы
-    result_df = pivot_pct_clustered.reset_index()
-    result_df = result_df.rename(columns={'index': 'Магазин'})
+    result_df = engine.result_frame(pivot_pct_clustered)
     
     # Добавляем метрики качества в экспорт
     export_col1, export_col2 = st.columns(2)
@@ -660,30 +1324,12 @@ if df is not None:
     
     with export_col2:
         # Excel экспорт с несколькими листами
-        from io import BytesIO
-        
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            result_df.to_excel(writer, sheet_name='Кластеры', index=False)
-            
-            # Профили кластеров
-            cluster_profiles.to_excel(writer, sheet_name='Профили_кластеров')
-            
-            # Метрики
-            metrics_summary = pd.DataFrame({
-                'Метрика': ['Silhouette Score', 'Davies-Bouldin Index', 'Calinski-Harabasz Score'],
-                'Значение': [silhouette, davies_bouldin, calinski_harabasz],
-                'Интерпретация': [
-                    '>0.5: хорошо, >0.7: отлично',
-                    '<1.0: отлично',
-                    'Чем больше, тем лучше'
-                ]
-            })
-            metrics_summary.to_excel(writer, sheet_name='Метрики', index=False)
+        report_bytes = cached_report(model_key, fit_key, result_df, cluster_profiles, quality_summary,
+                                     forecast_args, forecast)
         
         st.download_button(
             label="📥 Скачать полный отчет (Excel)",
-            data=output.getvalue(),
+            data=report_bytes,
             file_name=f"store_clustering_report_k{n_clusters}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
@@ -743,6 +1389,34 @@ if df is not None:
     - Используйте дендрограмму для понимания иерархии
     - Проверяйте похожие магазины для cross-selling идей
     """)
+    
+    profiler.finish()
+    with profile_panel:
+        rows = profiler.rows()
+        traced = profiler.trace_memory
+        st.caption(f"Прогон скрипта: {profiler.total_seconds:.2f} с; "
+                   f"пиковая память процесса: {peak_rss_mb() or 0:,.0f} МБ. "
+                   "Кэш — попадания / промахи; CPU включает потоки BLAS и другие сессии")
+        st.dataframe(pd.DataFrame({
+            'Этап': ['\u2003' * row['depth'] + row['name'] for row in rows],
+            'Вызовов': [row['calls'] for row in rows],
+            'Время, с': [row['seconds'] for row in rows],
+            'CPU, с': [row['cpu_seconds'] for row in rows],
+            'Пик выделений, МБ' if traced else 'Рост пика RSS, МБ':
+                [row.get('peak_alloc_mb' if traced else 'rss_growth_mb') for row in rows],
+            'Кэш': [f"{row['hits']} / {row['misses']}" if row['hits'] + row['misses'] else ''
+                    for row in rows],
+        }).round(3), hide_index=True, use_container_width=True)
+        artifact_cache = default_cache()
+        artifact_stats = artifact_cache.stats
+        disk_note = f", диск: {artifact_cache.disk_dir}" if artifact_cache.disk_dir else ""
+        st.caption(f"Общий кэш результатов (все сессии): {len(artifact_cache)} записей, "
+                   f"{artifact_cache.size_bytes / 1024 ** 2:,.1f} из {artifact_cache.max_bytes / 1024 ** 2:,.0f} МБ"
+                   f"{disk_note}; попаданий {artifact_stats['hits']}, с диска {artifact_stats['disk_hits']}, "
+                   f"расчетов {artifact_stats['misses']}, ожиданий чужого расчета {artifact_stats['waits']}, "
+                   f"вытеснений {artifact_stats['evictions']}")
+        if PROFILE_LOG:
+            st.caption(f"Замеры прогона дописаны в {PROFILE_LOG}")
 
 if df is None:
     st.info("👆 Выберите источник данных и загрузите таблицу для начала анализа")
@@ -756,7 +1430,7 @@ if df is None:
         - **Segment** — товарный сегмент
         - **Sum** — сумма продаж
         
-        Опционально: `Art` (артикул), `Qty` (количество)
+        Опционально: `Art` (артикул), `Qty` (количество), `Date` (дата продажи — для прогноза оборота)
         
         ### Google Sheets
         
@@ -0,0 +1,294 @@
+"""Общий для всех сессий кэш результатов расчета (артефактов).
+
+Матрицы pivot, результаты перебора k, кластеризации, linkage-деревья и
+байты отчетов хранятся один раз на процесс сервера: вторая сессия с тем же
+файлом и параметрами получает готовый результат. Ключ — имя функции, ее
+параметры (аргументы с префиксом "_" в ключ не входят, как в st.cache_data)
+и отпечаток исходного кода приложения, поэтому после обновления кода старые
+записи не используются.
+
+Память ограничена бюджетом (KLASTER_ARTIFACT_CACHE_MB) с вытеснением LRU.
+Дисковый уровень (KLASTER_ARTIFACT_DIR) необязателен: записи переживают
+перезапуск и доступны нескольким процессам сервера. Если несколько сессий
+одновременно запрашивают отсутствующий результат, считает только одна —
+остальные ждут ее (блокировка на ключ в процессе и файловая блокировка
+между процессами).
+
+Записи на диске — pickle: каталог должен быть доступен на запись только
+серверу приложения.
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    import fcntl
+except ImportError:  # Windows: без блокировки между процессами
+    fcntl = None
+
+ARTIFACT_CACHE_MB = int(os.environ.get('KLASTER_ARTIFACT_CACHE_MB', '1024'))
+ARTIFACT_DIR = os.environ.get('KLASTER_ARTIFACT_DIR')
+ARTIFACT_DISK_MB = int(os.environ.get('KLASTER_ARTIFACT_DISK_MB', '4096'))
+
+_MISSING = object()
+
+
+def _code_fingerprint():
+    """Хэш исходников модулей приложения (все .py рядом с этим файлом)."""
+    digest = hashlib.blake2b(digest_size=8)
+    for path in sorted(Path(__file__).parent.glob('*.py')):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+CODE_VERSION = _code_fingerprint()
+
+
+def artifact_size(value):
+    """Оценка объема значения в памяти, байт."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sp.issparse(value):
+        # CSR/CSC: значения, индексы столбцов (строк) и указатели
+        return sum(getattr(value, name).nbytes for name in ('data', 'indices', 'indptr') if hasattr(value, name))
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(artifact_size(k) + artifact_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(artifact_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def freeze(value):
+    """Массивы numpy в значении -> только для чтения (значение общее для всех сессий)."""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for item in value.values():
+            freeze(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            freeze(item)
+    return value
+
+
+class ArtifactCache:
+    """LRU-кэш в памяти с бюджетом, необязательным диском и одним расчетом на ключ."""
+
+    def __init__(self, max_bytes=ARTIFACT_CACHE_MB * 1024 ** 2, disk_dir=ARTIFACT_DIR,
+                 disk_max_bytes=ARTIFACT_DISK_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0}
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_memory(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return self._entries[key][0]
+
+    def _put_memory(self, key, value):
+        size = artifact_size(value)
+        # Значение больше всего бюджета в памяти не держим (оно может остаться на диске)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    @contextmanager
+    def _key_lock(self, key):
+        """Один расчет на ключ в процессе: остальные потоки ждут его результата."""
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        lock = entry[0]
+        if not lock.acquire(blocking=False):
+            with self._lock:
+                self.stats['waits'] += 1
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._key_locks.pop(key, None)
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{key}.pkl"
+
+    @contextmanager
+    def _disk_lock(self, key):
+        """Файловая блокировка ключа между процессами сервера."""
+        if self.disk_dir is None or fcntl is None:
+            yield
+            return
+        with open(self.disk_dir / f"{key}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return _MISSING
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return _MISSING
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Поврежденная запись или запись несовместимой версии библиотек
+            path.unlink(missing_ok=True)
+            return _MISSING
+        now = time.time()
+        os.utime(path, (now, now))
+        with self._lock:
+            self.stats['disk_hits'] += 1
+        return freeze(value)
+
+    def _write_disk(self, key, value):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """Удаляет наименее недавно использованные файлы сверх дискового лимита."""
+        entries = []
+        for path in self.disk_dir.glob('*.pkl'):
+            try:
+                entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except FileNotFoundError:  # удален другим процессом
+                continue
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.disk_max_bytes:
+                break
+            total -= size
+            path.unlink(missing_ok=True)
+            path.with_suffix('.lock').unlink(missing_ok=True)
+
+    def get_or_compute(self, key, compute):
+        """Значение по ключу; при промахе вызывает compute() — один раз на ключ.
+
+        Порядок: память, затем (под блокировкой ключа) снова память — ее могла
+        заполнить параллельная сессия, — диск и только потом расчет.
+        """
+        value = self._get_memory(key)
+        if value is not _MISSING:
+            return value
+        with self._key_lock(key):
+            value = self._get_memory(key)
+            if value is not _MISSING:
+                return value
+            with self._disk_lock(key):
+                value = self._read_disk(key)
+                if value is _MISSING:
+                    with self._lock:
+                        self.stats['misses'] += 1
+                    value = freeze(compute())
+                    self._write_disk(key, value)
+            self._put_memory(key, value)
+        return value
+
+    def clear(self, prefix=''):
+        """Удаляет записи с ключами, начинающимися с prefix (по умолчанию — все)."""
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._bytes -= self._entries.pop(key)[1]
+        if self.disk_dir is not None:
+            for path in self.disk_dir.glob(f"{prefix}*.pkl"):
+                path.unlink(missing_ok=True)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """Кэш процесса (создается при первом обращении по настройкам из окружения)."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ArtifactCache()
+        return _default_cache
+
+
+def shared_cache(cache=None):
+    """Декоратор: результат функции хранится в общем кэше процесса.
+
+    Ключ — имя функции, значения аргументов без префикса "_" (их repr) и
+    CODE_VERSION. Возвращаемые массивы numpy становятся только для чтения:
+    один и тот же объект получают все сессии. clear() удаляет записи этой
+    функции.
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        def target():
+            return cache if cache is not None else default_cache()
+
+        def key_for(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = [(name, value) for name, value in bound.arguments.items() if not name.startswith('_')]
+            digest = hashlib.blake2b(repr((CODE_VERSION, params)).encode(), digest_size=16).hexdigest()
+            return f"{func.__name__}-{digest}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return target().get_or_compute(key_for(args, kwargs), lambda: func(*args, **kwargs))
+
+        wrapper.clear = lambda: target().clear(f"{func.__name__}-")
+        return wrapper
+    return decorate
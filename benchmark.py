@@ -0,0 +1,273 @@
+"""Воспроизводимый бенчмарк этапов расчета на синтетических данных.
+
+Примеры:
+    python benchmark.py --sizes small medium -o bench.json
+    python benchmark.py --custom 5000,40,3000,2000000 -o bench_big.json
+    python benchmark.py --sizes small medium -o new.json --compare bench.json
+
+Для каждого размера генерируется таблица продаж (synthetic.make_sales),
+сохраняется во временный файл и проходит те же этапы, что и в приложении:
+load (чтение и очистка загрузчиками loaders: потоковый stream_csv или
+load_excel_cached с кэшем Parquet), pivot, scale, distances, sweep, fit,
+quality, pca, linkage, similarity, export. По каждому этапу записываются время, процессорное время
+и память (profiling.measure), по прогону — пиковая память процесса и ARI
+найденных кластеров относительно скрытых. Каждый размер считается в
+отдельном процессе, чтобы пиковая память одного прогона не влияла на
+следующий. С --compare время этапов сравнивается с прошлым JSON; код
+возврата 1, если какой-то этап замедлился сильнее порога.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy
+import sklearn
+from sklearn.metrics import adjusted_rand_score
+
+import pipeline
+from distances import matrix_fits, pairwise_matrix
+from engine import clustered_table, optimal_k, result_frame
+from hierarchy import linkage_tree
+from loaders import ParquetCache, load_excel_cached, stream_csv
+from neighbors import NeighborIndex
+from profiling import measure, peak_rss_mb
+from synthetic import make_sales, write_sales
+
+BENCHMARK_FORMAT_VERSION = 2
+
+# Размеры: магазины, сегменты, артикулы, строки продаж
+SIZES = {
+    'small': {'n_stores': 200, 'n_segments': 15, 'n_articles': 300, 'n_rows': 50_000},
+    'medium': {'n_stores': 2000, 'n_segments': 30, 'n_articles': 2000, 'n_rows': 1_000_000},
+    'large': {'n_stores': 10_000, 'n_segments': 40, 'n_articles': 5000, 'n_rows': 5_000_000},
+}
+STAGES = ['load', 'pivot', 'scale', 'distances', 'sweep', 'fit', 'quality',
+          'pca', 'linkage', 'similarity', 'export']
+
+# Замедление этапа, которое --compare считает регрессией, и минимальное время
+# этапа в базовом прогоне (более короткие этапы слишком шумные для сравнения)
+REGRESSION_RATIO = 1.25
+MIN_COMPARE_SECONDS = 0.05
+
+
+def run_size(name, size, n_clusters=5, seed=0, file_format='csv', min_k=2, max_k=10,
+             n_jobs=1, trace_memory=False):
+    """Один прогон всех этапов. Возвращает dict с размером, этапами и итогами."""
+    stages = {}
+
+    @contextmanager
+    def stage(stage_name):
+        with measure(trace_memory) as stats:
+            stages[stage_name] = stats
+            yield stats
+
+    df, true_labels = make_sales(n_clusters=n_clusters, seed=seed, **size)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_sales(df, Path(tmp) / f"sales.{file_format}")
+        file_mb = path.stat().st_size / 1024 ** 2
+        del df
+        # Как в приложении: CSV агрегируется при чтении, Excel очищается и кладется в кэш
+        with stage('load') as load_stats:
+            if file_format == 'csv':
+                df, load_meta = stream_csv(path)
+            else:
+                df, load_meta = load_excel_cached(path.read_bytes(), ParquetCache(Path(tmp) / 'cache'))
+        load_stats['file_mb'] = file_mb
+        load_stats['rows_dropped'] = load_meta['rows_dropped']
+    with stage('pivot'):
+        pivot_table, pivot_pct = pipeline.build_pivot(df)
+    with stage('scale'):
+        X_scaled, _ = pipeline.scale_features(pivot_pct)
+
+    n_stores = len(pivot_pct)
+    # Как в engine.run_clustering: матрица расстояний — только если помещается в бюджет
+    D = None
+    with stage('distances') as distance_stats:
+        if matrix_fits(n_stores, n_matrices=2):
+            D = pairwise_matrix(X_scaled, 'euclidean')
+    distance_stats['skipped'] = D is None
+
+    k_range = range(min_k, min(max_k, n_stores - 1) + 1)
+    with stage('sweep'):
+        sweep = pipeline.sweep_k(X_scaled, k_range, 'k-means++', n_jobs=n_jobs, D=D)
+    best_k = optimal_k(sweep)['silhouette']
+    with stage('fit'):
+        clusters, _ = pipeline.fit_clusters(X_scaled, best_k, 'euclidean')
+    with stage('quality'):
+        quality = pipeline.quality_metrics(X_scaled, clusters, D)
+    with stage('pca'):
+        pipeline.project_2d(X_scaled)
+
+    tree = None
+    with stage('linkage') as linkage_stats:
+        if D is not None:
+            tree = linkage_tree(X_scaled, 'ward', 'euclidean', D)
+    linkage_stats['skipped'] = tree is None
+    del D, tree
+
+    with stage('similarity'):
+        NeighborIndex(pivot_pct.to_numpy(), pivot_pct.index, clusters).batch(5, same_cluster=True)
+    with stage('export') as export_stats:
+        table = result_frame(clustered_table(pivot_table, pivot_pct, clusters))
+        csv_bytes = table.to_csv(index=False).encode('utf-8-sig')
+        report = pipeline.build_excel_report(
+            table, pipeline.cluster_profiles(pivot_pct, clusters),
+            (quality['silhouette'], quality['davies_bouldin'], quality['calinski_harabasz']))
+    export_stats['bytes'] = len(csv_bytes) + len(report)
+
+    found = pd.Series(clusters, index=pivot_pct.index.astype(str))
+    return {
+        'name': name,
+        'size': {**size, 'n_clusters': n_clusters, 'seed': seed, 'format': file_format,
+                 'min_k': min_k, 'max_k': max_k, 'n_jobs': n_jobs, 'trace_memory': trace_memory},
+        'n_stores': n_stores,
+        'rows_clean': load_meta['rows_raw'] - load_meta['rows_dropped'],
+        'k': int(best_k),
+        'silhouette': float(quality['silhouette']),
+        'ari': float(adjusted_rand_score(true_labels.reindex(found.index), found)),
+        'stages': stages,
+        'total_seconds': sum(stats['seconds'] for stats in stages.values()),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_isolated(name, size, **kwargs):
+    """run_size() в отдельном процессе (spawn) — пиковая память только этого прогона."""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_size, name, size, **kwargs).result()
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Версии и железо — чтобы результаты разных машин не сравнивались вслепую."""
+    return {
+        'git': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scikit-learn': sklearn.__version__,
+        'scipy': scipy.__version__,
+    }
+
+
+def compare(baseline, current, ratio=REGRESSION_RATIO, min_seconds=MIN_COMPARE_SECONDS):
+    """Этапы, замедлившиеся относительно baseline более чем в ratio раз.
+
+    Прогоны сопоставляются по имени размера. Возвращает список dict:
+    run, stage, baseline, current (секунды) и ratio.
+    """
+    baseline_runs = {run['name']: run for run in baseline['runs']}
+    regressions = []
+    for run in current['runs']:
+        base = baseline_runs.get(run['name'])
+        if base is None or base['size'] != run['size']:
+            continue
+        for stage_name, stats in run['stages'].items():
+            base_seconds = base['stages'].get(stage_name, {}).get('seconds')
+            if base_seconds is None or base_seconds < min_seconds:
+                continue
+            if stats['seconds'] / base_seconds > ratio:
+                regressions.append({'run': run['name'], 'stage': stage_name, 'baseline': base_seconds,
+                                    'current': stats['seconds'], 'ratio': stats['seconds'] / base_seconds})
+    return regressions
+
+
+def format_run(run):
+    lines = [f"{run['name']}: {run['n_stores']} магазинов, {run['rows_clean']:,} строк, k={run['k']}, "
+             f"ARI={run['ari']:.3f}, всего {run['total_seconds']:.2f} с, "
+             f"пиковая память {run['peak_rss_mb'] or 0:,.0f} МБ"]
+    for stage_name in STAGES:
+        stats = run['stages'][stage_name]
+        note = ' (пропущен)' if stats.get('skipped') else ''
+        memory = (f"пик выделений {stats['peak_alloc_mb']:,.1f} МБ" if 'peak_alloc_mb' in stats
+                  else f"+{stats.get('rss_growth_mb', 0):,.0f} МБ RSS")
+        lines.append(f"  {stage_name:<11} {stats['seconds']:8.3f} с  CPU {stats['cpu_seconds']:8.3f} с  "
+                     f"{memory}{note}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк этапов кластеризации на синтетических данных")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small'],
+                        help="Готовые размеры данных")
+    parser.add_argument('--custom', nargs='+', default=[], metavar='STORES,SEGMENTS,ARTICLES,ROWS',
+                        help="Свои размеры, например 5000,40,3000,2000000")
+    parser.add_argument('--clusters', type=int, default=5, help="Число скрытых кластеров в данных")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv', dest='file_format',
+                        help="Формат файла для этапа load")
+    parser.add_argument('--min-k', type=int, default=2)
+    parser.add_argument('--max-k', type=int, default=10)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Процессов для перебора k")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Пик выделений по этапам через tracemalloc (медленнее)")
+    parser.add_argument('--in-process', action='store_true',
+                        help="Не запускать каждый размер в отдельном процессе")
+    parser.add_argument('-o', '--output', default=None, help="JSON с результатами")
+    parser.add_argument('--compare', metavar='BASELINE', default=None,
+                        help="JSON прошлого прогона: сообщить об этапах, замедлившихся более чем "
+                             f"в {REGRESSION_RATIO} раза")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [(name, SIZES[name]) for name in args.sizes]
+    for spec in args.custom:
+        values = [int(value) for value in spec.split(',')]
+        if len(values) != 4:
+            print(f"Размер {spec}: нужно 4 числа STORES,SEGMENTS,ARTICLES,ROWS", file=sys.stderr)
+            return 2
+        sizes.append((spec, dict(zip(['n_stores', 'n_segments', 'n_articles', 'n_rows'], values))))
+
+    run = run_size if args.in_process else run_isolated
+    results = {
+        'format_version': BENCHMARK_FORMAT_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'runs': [],
+    }
+    for name, size in sizes:
+        result = run(name, size, n_clusters=args.clusters, seed=args.seed, file_format=args.file_format,
+                     min_k=args.min_k, max_k=args.max_k, n_jobs=args.jobs, trace_memory=args.trace_memory)
+        results['runs'].append(result)
+        print(format_run(result), flush=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f"Результаты: {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        regressions = compare(baseline, results)
+        for item in regressions:
+            print(f"РЕГРЕССИЯ {item['run']}/{item['stage']}: {item['baseline']:.3f} с -> "
+                  f"{item['current']:.3f} с (x{item['ratio']:.2f})")
+        if regressions:
+            return 1
+        print(f"Регрессий нет (порог x{REGRESSION_RATIO})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""Построение тяжелых графиков Plotly для больших сетей магазинов.
+
+Объем данных, уходящих в браузер, ограничивается: матрица магазин × сегмент
+показывается постранично, график PCA рисуется через WebGL, а сверх бюджета
+точек магазины агрегируются в сетку плотности с выборкой по кластерам.
+
+Дендрограмма рисуется одной трассой: все отрезки склеиваются в один массив
+координат с разделителями NaN (вместо отдельной трассы на каждое слияние).
+Большие деревья можно усекать (scipy truncate_mode) и раскрывать поддеревья
+по клику; при большом числе листьев используется WebGL (Scattergl).
+"""
+import os
+import time
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+from scipy.cluster.hierarchy import dendrogram
+
+from profiling import profiled
+
+WEBGL_LEAF_THRESHOLD = 1000
+MAX_TICK_LABELS = 200
+TRUNCATE_MODES = [None, 'lastp', 'level']
+
+# Режим большой сети: постраничная матрица и прореженный график PCA
+LARGE_NETWORK_STORES = int(os.environ.get('KLASTER_LARGE_NETWORK_STORES', '2000'))
+POINT_BUDGET = int(os.environ.get('KLASTER_POINT_BUDGET', '5000'))
+TABLE_PAGE_ROWS = 100
+DENSITY_BINS = 80
+
+
+def subtree_linkage(Z, node):
+    """Linkage matrix поддерева с корнем node.
+
+    Возвращает (Z_sub, node_ids): node_ids[i] — номер узла i поддерева в
+    исходном дереве (сначала m листьев, затем m - 1 слияний). Узлы >= n —
+    это слияния (строка Z[node - n]); строки упорядочены так, что потомки
+    всегда раньше родителя, и этот порядок сохраняется.
+    """
+    n = len(Z) + 1
+    if node < n:
+        raise ValueError("Поддерево строится только для узла-слияния")
+
+    rows, leaves, stack = [], [], [int(node)]
+    while stack:
+        current = stack.pop()
+        if current < n:
+            leaves.append(current)
+        else:
+            rows.append(current - n)
+            stack.extend(int(child) for child in Z[current - n, :2])
+    rows = np.sort(rows)
+    leaves = np.sort(leaves)
+
+    # Перенумерация: листья -> 0..m-1, слияния -> m, m+1, ...
+    mapping = {leaf: i for i, leaf in enumerate(leaves)}
+    mapping.update({n + row: len(leaves) + i for i, row in enumerate(rows)})
+    Z_sub = Z[rows].copy()
+    Z_sub[:, 0] = [mapping[int(a)] for a in Z[rows, 0]]
+    Z_sub[:, 1] = [mapping[int(b)] for b in Z[rows, 1]]
+    return Z_sub, np.concatenate([leaves, n + rows])
+
+
+def _segments(dendr):
+    """Все П-образные связи дендрограммы одной ломаной с разделителями NaN."""
+    icoord = np.asarray(dendr['icoord'], dtype=float)
+    dcoord = np.asarray(dendr['dcoord'], dtype=float)
+    gap = np.full((len(icoord), 1), np.nan)
+    return np.hstack([icoord, gap]).ravel(), np.hstack([dcoord, gap]).ravel()
+
+
+@profiled('dendrogram_figure')
+def dendrogram_figure(Z, labels, truncate_mode=None, p=30, root=None,
+                      webgl_threshold=WEBGL_LEAF_THRESHOLD, title=None):
+    """Дендрограмма (полная, усеченная или поддерево root).
+
+    Возвращает (figure, info): в info — номера узлов исходного дерева для
+    каждого отображаемого листа ('leaf_nodes', порядок трассы листьев),
+    число листьев, признак WebGL, размер JSON-представления и время
+    построения.
+    """
+    started = time.perf_counter()
+    labels = np.asarray(labels)
+    n = len(Z) + 1
+
+    node_ids = None
+    if root is not None and root >= n:
+        Z, node_ids = subtree_linkage(Z, root)
+        labels = labels[node_ids[:len(Z) + 1]]
+
+    kwargs = {'truncate_mode': truncate_mode, 'p': p} if truncate_mode else {}
+    dendr = dendrogram(Z, labels=labels.tolist(), no_plot=True, **kwargs)
+
+    leaf_nodes = np.asarray(dendr['leaves'])
+    if node_ids is not None:
+        leaf_nodes = node_ids[leaf_nodes]
+    n_leaves = len(leaf_nodes)
+    use_webgl = n_leaves > webgl_threshold
+    scatter = go.Scattergl if use_webgl else go.Scatter
+
+    x, y = _segments(dendr)
+    tick_positions = 5 + 10 * np.arange(n_leaves)
+
+    fig = go.Figure()
+    fig.add_trace(scatter(
+        x=x, y=y, mode='lines',
+        line=dict(color='rgb(100,100,100)', width=1),
+        hoverinfo='skip', showlegend=False, connectgaps=False
+    ))
+    # Маркеры листьев: подпись при наведении и клик для раскрытия усеченного узла
+    is_group = leaf_nodes >= n
+    fig.add_trace(scatter(
+        x=tick_positions, y=np.zeros(n_leaves), mode='markers',
+        marker=dict(size=np.where(is_group, 9, 4),
+                    color=np.where(is_group, 'rgb(214,39,40)', 'rgb(100,100,100)')),
+        text=dendr['ivl'], hovertemplate='%{text}<extra></extra>', showlegend=False
+    ))
+
+    xaxis = dict(title="Магазины")
+    if n_leaves <= MAX_TICK_LABELS:
+        xaxis.update(ticktext=dendr['ivl'], tickvals=tick_positions)
+    else:
+        xaxis.update(showticklabels=False)
+
+    fig.update_layout(
+        title=title or "Дендрограмма: иерархия схожести магазинов",
+        xaxis=xaxis,
+        yaxis_title="Расстояние",
+        height=600,
+        hovermode='closest',
+        clickmode='event+select'
+    )
+
+    payload_bytes = len(fig.to_json())
+    info = {
+        'leaf_nodes': leaf_nodes.tolist(),
+        'n_leaves': n_leaves,
+        'n_groups': int(is_group.sum()),
+        'webgl': use_webgl,
+        'payload_bytes': payload_bytes,
+        'build_seconds': time.perf_counter() - started,
+    }
+    return fig, info
+
+
+def stratified_sample(labels, budget, random_state=0):
+    """Индексы не более budget точек с сохранением доли каждого кластера.
+
+    Каждый кластер получает квоту пропорционально размеру, но не меньше
+    min(размер, 1) точки, чтобы малые кластеры не пропадали с графика.
+    Если из-за этого минимума квоты превышают budget, лишние точки
+    снимаются с самых больших квот (кластеров больше, чем budget, — часть
+    кластеров остается без точек).
+    """
+    labels = np.asarray(labels)
+    n = len(labels)
+    if n <= budget:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    uniques, codes = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(codes)
+    quotas = np.minimum(np.maximum(np.floor(sizes * budget / n).astype(int), 1), sizes)
+    for _ in range(quotas.sum() - budget):
+        quotas[np.argmax(quotas)] -= 1
+    picked = [
+        rng.choice(np.flatnonzero(codes == c), size=quotas[c], replace=False)
+        for c in range(len(uniques))
+    ]
+    return np.sort(np.concatenate(picked))
+
+
+@profiled('pca_figure')
+def pca_scatter_figure(X_pca, clusters, stores, title, point_budget=None,
+                       density_bins=DENSITY_BINS):
+    """Точечный график кластеров на плоскости PC1–PC2 (WebGL).
+
+    Если точек больше point_budget, все магазины агрегируются в сетку
+    плотности (считается на сервере, в браузер уходят только ячейки), а
+    поверх рисуется стратифицированная по кластерам выборка. Возвращает
+    (figure, info) с числом показанных точек и размером JSON.
+    """
+    clusters = np.asarray(clusters)
+    stores = np.asarray(stores)
+    n = len(clusters)
+    sampled = point_budget is not None and n > point_budget
+    shown = stratified_sample(clusters, point_budget) if sampled else np.arange(n)
+
+    fig = go.Figure()
+    if sampled:
+        counts, x_edges, y_edges = np.histogram2d(X_pca[:, 0], X_pca[:, 1], bins=density_bins)
+        fig.add_trace(go.Heatmap(
+            x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+            z=np.where(counts.T > 0, counts.T, np.nan),
+            colorscale='Greys', opacity=0.5, showscale=False,
+            hovertemplate='Магазинов в ячейке: %{z}<extra></extra>'
+        ))
+
+    palette = px.colors.qualitative.Set2
+    for i, cluster in enumerate(np.unique(clusters)):
+        idx = shown[clusters[shown] == cluster]
+        fig.add_trace(go.Scattergl(
+            x=X_pca[idx, 0], y=X_pca[idx, 1], mode='markers',
+            name=f"Кластер {cluster}", text=stores[idx],
+            marker=dict(size=6 if sampled else 12, color=palette[i % len(palette)],
+                        line=dict(width=0 if sampled else 2, color='white')),
+            hovertemplate='%{text}<br>PC1=%{x:.2f}<br>PC2=%{y:.2f}<extra></extra>'
+        ))
+
+    fig.update_layout(title=title, xaxis_title='PC1', yaxis_title='PC2',
+                      height=500, legend_title_text='Кластер')
+    info = {
+        'n_points': n,
+        'n_shown': len(shown),
+        'sampled': sampled,
+        'payload_bytes': len(fig.to_json()),
+    }
+    return fig, info
+
+
+def table_page(frame, page, page_rows=TABLE_PAGE_ROWS):
+    """Срез строк таблицы для страницы page (нумерация с 1)."""
+    start = (max(page, 1) - 1) * page_rows
+    return frame.iloc[start:start + page_rows]
@@ -0,0 +1,142 @@
+"""Пакетная кластеризация каталога файлов продаж из командной строки.
+
+Примеры:
+    python cli.py data/regions -o reports --jobs 8 --max-k 12 --save-model
+    python cli.py data/new_month -o assigned --assign reports/north_model.npz
+    python cli.py data/months -o monthly --incremental --window 6
+
+Для каждого файла (.xlsx, .xls, .csv) в каталоге вывода создаются CSV с
+кластерами, Excel-отчет и CSV похожих магазинов — те же, что выгружает
+приложение (с --save-model — еще и файл модели). С --assign магазины
+относятся к кластерам сохраненной модели без перекластеризации: CSV
+назначений и JSON с метриками дрейфа. С --incremental файлы каталога —
+периоды (имя файла = период): в сохраненные агрегаты добавляются только
+новые периоды, окно перекластеризуется с теплым стартом от прошлой модели,
+выгружается матрица миграции магазинов между кластерами. Код возврата 1, если хотя бы один
+файл не обработан.
+"""
+import argparse
+import sys
+from functools import partial
+
+from engine import DEFAULT_PARAMS, assign_file, find_inputs, process_file, run_batch, run_incremental
+from incremental import DEFAULT_WINDOW
+from pipeline import ENGINES, SWEEP_MODES
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Кластеризация магазинов по структуре ассортимента")
+    parser.add_argument('input_dir', help="Каталог с файлами продаж (Magazin, Segment, Sum)")
+    parser.add_argument('-o', '--output-dir', default='reports', help="Каталог для отчетов")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Число процессов (по умолчанию — все ядра)")
+    parser.add_argument('-k', '--clusters', type=int, default=None,
+                        help="Число кластеров (по умолчанию — оптимальное по Silhouette)")
+    parser.add_argument('--min-k', type=int, default=DEFAULT_PARAMS['min_k'])
+    parser.add_argument('--max-k', type=int, default=DEFAULT_PARAMS['max_k'])
+    parser.add_argument('--init', choices=['k-means++', 'random'], default=DEFAULT_PARAMS['init_method'])
+    parser.add_argument('--sweep-mode', choices=SWEEP_MODES, default=DEFAULT_PARAMS['sweep_mode'])
+    parser.add_argument('--metric', choices=['euclidean', 'manhattan'],
+                        default=DEFAULT_PARAMS['distance_metric'])
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_PARAMS['engine'])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_PARAMS['batch_size'])
+    parser.add_argument('--random-state', type=int, default=DEFAULT_PARAMS['random_state'])
+    parser.add_argument('--max-iter', type=int, default=DEFAULT_PARAMS['max_iter'])
+    parser.add_argument('--features', choices=['Segment', 'Art'], default=DEFAULT_PARAMS['feature_axis'],
+                        help="Признаки: доли сегментов или артикулы (SVD)")
+    parser.add_argument('--svd-components', type=int, default=DEFAULT_PARAMS['svd_components'])
+    parser.add_argument('--silhouette-sample', type=int, default=None,
+                        help="Оценивать силуэт по выборке такого размера")
+    parser.add_argument('--neighbors', type=int, default=DEFAULT_PARAMS['neighbors_top_n'],
+                        help="Похожих магазинов на магазин (0 — не выгружать)")
+    parser.add_argument('--float32', action='store_true',
+                        help="Хранить доли и признаки в float32 (вдвое меньше памяти)")
+    parser.add_argument('--stability', type=int, default=0, metavar='N',
+                        help="Оценить устойчивость кластеров на N повторных выборках (CSV по кластерам и магазинам)")
+    parser.add_argument('--forecast', choices=['MS', 'D'], default=None, metavar='FREQ',
+                        help="Прогноз оборота кластеров по колонке Date: MS — по месяцам, D — по дням "
+                             "(лист \"Прогноз\" в Excel-отчете)")
+    parser.add_argument('--forecast-horizon', type=int, default=None,
+                        help="Периодов прогноза (по умолчанию 6 месяцев или 90 дней)")
+    parser.add_argument('--forecast-by-segment', action='store_true',
+                        help="Прогноз по кластеру × сегменту")
+    parser.add_argument('--save-model', action='store_true',
+                        help="Сохранить модель кластеров (<файл>_model.npz) для --assign")
+    parser.add_argument('--assign', metavar='MODEL', default=None,
+                        help="Отнести магазины к кластерам сохраненной модели вместо перекластеризации")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Файлы — периоды; перекластеризация окна с теплым стартом")
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help="Число последних периодов в окне (для --incremental)")
+    parser.add_argument('--state-dir', default=None,
+                        help="Каталог агрегатов периодов и модели (по умолчанию <output-dir>/state)")
+    parser.add_argument('--warm-start', metavar='MODEL', default=None,
+                        help="Модель для теплого старта (по умолчанию — модель прошлого запуска)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = find_inputs(args.input_dir)
+    if not paths:
+        print(f"В каталоге {args.input_dir} нет файлов .xlsx/.xls/.csv", file=sys.stderr)
+        return 1
+
+    params = {
+        'min_k': args.min_k,
+        'max_k': args.max_k,
+        'n_clusters': args.clusters,
+        'init_method': args.init,
+        'sweep_mode': args.sweep_mode,
+        'silhouette_sample': args.silhouette_sample,
+        'distance_metric': args.metric,
+        'random_state': args.random_state,
+        'max_iter': args.max_iter,
+        'engine': args.engine,
+        'batch_size': args.batch_size,
+        'feature_axis': args.features,
+        'svd_components': args.svd_components,
+        'neighbors_top_n': args.neighbors,
+        'float32': args.float32,
+        'stability_resamples': args.stability,
+        'forecast_freq': args.forecast,
+        'forecast_horizon': args.forecast_horizon,
+        'forecast_by_segment': args.forecast_by_segment,
+    }
+
+    if args.incremental:
+        state_dir = args.state_dir or f"{args.output_dir}/state"
+        summary = run_incremental(paths, args.output_dir, state_dir, args.window, args.warm_start, params)
+        added = ', '.join(summary['added_periods']) or 'нет'
+        print(f"Новые периоды: {added}. Окно: {', '.join(summary['window'])}")
+        start = 'теплый старт' if summary['warm_start'] else 'полный расчет'
+        moved = '' if summary['moved'] is None else f", сменили кластер: {summary['moved']} магазинов"
+        print(f"k={summary['k']} ({start}, {summary['seconds']:.1f} с){moved}. Файлы: {args.output_dir}")
+        return 0
+
+    if args.assign:
+        task = partial(assign_file, out_dir=args.output_dir, model_path=args.assign)
+    else:
+        task = partial(process_file, out_dir=args.output_dir, params=params, save_model=args.save_model)
+
+    def progress(done, summary):
+        if summary['error']:
+            status = f"ОШИБКА {summary['error']}"
+        elif 'drift' in summary:
+            drift = summary['drift']
+            status = (f"{summary['stores']} магазинов, вне модели {drift['outlier_share']:.0%}, "
+                      f"дрейф расстояний x{drift['distance_ratio']:.2f}"
+                      f"{' — РЕКОМЕНДУЕТСЯ ПЕРЕКЛАСТЕРИЗАЦИЯ' if drift['refit_recommended'] else ''}")
+        else:
+            status = (f"{summary['stores']} магазинов, k={summary['k']}, "
+                      f"silhouette={summary['silhouette']:.3f}, {summary['seconds']:.1f} с")
+        print(f"[{done}/{len(paths)}] {summary['file']}: {status}", flush=True)
+
+    summaries = run_batch(paths, task, args.jobs, progress)
+    failed = [s for s in summaries if s['error']]
+    print(f"Готово: {len(summaries) - len(failed)} из {len(summaries)} файлов, отчеты в {args.output_dir}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
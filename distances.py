@@ -0,0 +1,102 @@
+"""Матрицы попарных расстояний и силуэт на их основе.
+
+Матрица считается один раз на набор данных блоками строк (пиковая память —
+один блок в float64) и хранится в float32. Ее переиспользуют все расчеты
+силуэта и иерархическая кластеризация (metric='precomputed'). Если
+матрица не помещается в бюджет памяти, силуэт оценивается по случайной
+выборке магазинов с доверительным интервалом.
+"""
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics import pairwise_distances, silhouette_score
+
+from profiling import profiled
+
+DISTANCE_BUDGET_MB = int(os.environ.get('KLASTER_DISTANCE_BUDGET_MB', '1024'))
+BLOCK_ROWS = 1024
+SILHOUETTE_SAMPLE_SIZE = 2000
+
+
+def matrix_fits(n_rows, n_matrices=1, budget_mb=DISTANCE_BUDGET_MB):
+    """Помещаются ли n_matrices матриц n×n (float32) в бюджет памяти."""
+    return n_matrices * n_rows * n_rows * 4 <= budget_mb * 1024 ** 2
+
+
+@profiled('pairwise_matrix')
+def pairwise_matrix(X, metric='euclidean', block_rows=BLOCK_ROWS, dtype=np.float32):
+    """Полная матрица расстояний, посчитанная блоками строк (X может быть разреженной)."""
+    if not sp.issparse(X):
+        # float32-признаки не копируются в float64: sklearn сам повышает точность по блокам
+        X = np.asarray(X)
+        if X.dtype not in (np.float32, np.float64):
+            X = X.astype(np.float64)
+    n = X.shape[0]
+    D = np.empty((n, n), dtype=dtype)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        D[start:stop] = pairwise_distances(X[start:stop], X, metric=metric)
+    # Ошибки округления дают ненулевую диагональ, а precomputed-метрики ее проверяют
+    np.fill_diagonal(D, 0)
+    D.flags.writeable = False
+    return D
+
+
+def sampled_silhouette(X, labels, metric='euclidean', sample_size=SILHOUETTE_SAMPLE_SIZE,
+                       random_state=0, block_rows=BLOCK_ROWS):
+    """Оценка силуэта по выборке магазинов. Возвращает (оценка, полуширина 95% ДИ).
+
+    Для выбранных магазинов силуэт считается точно — по расстояниям до всех
+    n магазинов, поэтому среднее по выборке несмещенно оценивает силуэт всего
+    набора, а разброс значений дает доверительный интервал.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    labels = np.asarray(labels)
+    n = len(X)
+    _, codes = np.unique(labels, return_inverse=True)
+    n_clusters = codes.max() + 1
+    onehot = np.zeros((n, n_clusters))
+    onehot[np.arange(n), codes] = 1
+    sizes = onehot.sum(axis=0)
+
+    rng = np.random.default_rng(random_state)
+    sample = rng.choice(n, size=min(sample_size, n), replace=False)
+
+    values = []
+    for start in range(0, len(sample), block_rows):
+        idx = sample[start:start + block_rows]
+        # Суммы расстояний от каждого выбранного магазина до каждого кластера
+        sums = pairwise_distances(X[idx], X, metric=metric) @ onehot
+        own = codes[idx]
+        own_size = sizes[own]
+        a = sums[np.arange(len(idx)), own] / np.maximum(own_size - 1, 1)
+        means = sums / sizes
+        means[np.arange(len(idx)), own] = np.inf
+        b = means.min(axis=1)
+        s = (b - a) / np.maximum(a, b)
+        # Как в sklearn: для кластера из одного магазина силуэт равен 0
+        s[own_size == 1] = 0
+        values.append(np.nan_to_num(s))
+
+    values = np.concatenate(values)
+    m = len(values)
+    if m < 2 or m == n:
+        return float(values.mean()), 0.0
+    # Поправка на конечную совокупность: выборка без возвращения из n магазинов
+    fpc = np.sqrt((n - m) / (n - 1))
+    half_width = 1.96 * values.std(ddof=1) / np.sqrt(m) * fpc
+    return float(values.mean()), float(half_width)
+
+
+@profiled('silhouette')
+def silhouette(X, labels, D=None, sample_size=None, random_state=0):
+    """Силуэт: по готовой матрице D, по выборке или напрямую.
+
+    Возвращает (оценка, полуширина 95% ДИ); для точного расчета ДИ = 0.
+    """
+    if D is not None:
+        return float(silhouette_score(D, labels, metric='precomputed')), 0.0
+    if sample_size is not None and sample_size < len(X):
+        return sampled_silhouette(X, labels, sample_size=sample_size, random_state=random_state)
+    return float(silhouette_score(X, labels)), 0.0
@@ -0,0 +1,483 @@
+"""Пакетный запуск кластеризации без Streamlit.
+
+Конвейер загрузка -> pivot -> признаки -> sweep -> fit -> профили -> соседи ->
+отчет. Этапы (compute_*, model_from_fit, excel_report) решают, какие данные и
+параметры идут в функции pipeline.py; run_clustering() вызывает их подряд, а
+app.py — каждый под своим кэшем, поэтому при одинаковых параметрах
+результаты интерфейса и пакетного запуска совпадают.
+Файлы каталога обрабатываются параллельно в пуле процессов (parallel.py).
+Результат можно сохранить как модель (model.py) и затем относить к ее
+кластерам новые данные без перекластеризации.
+"""
+import json
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+from distances import matrix_fits, pairwise_matrix
+from forecast import DATE_COL, forecast_clusters, forecast_sheet, has_dates
+from hierarchy import linkage_tree
+from incremental import DEFAULT_WINDOW, PeriodAggregates, warm_recluster
+from loaders import KEY_COLS, ParquetCache, load_excel_cached, stream_csv
+from model import ClusterModel
+from neighbors import NeighborIndex
+from parallel import default_n_jobs, process_pool
+from stability import bootstrap_stability
+
+INPUT_SUFFIXES = ('.xlsx', '.xls', '.csv')
+MIN_STORES = 3
+QUALITY_METRICS = ('silhouette', 'davies_bouldin', 'calinski_harabasz')
+# Режимы перебора, которые берут метрики уже посчитанных k из k_cache
+K_CACHE_MODES = ('exhaustive', 'adaptive')
+# Деревья linkage (метод, метрика): иерархический перебор k режет дерево Ward,
+# кластеризация Manhattan строится по дереву average (его же рисует дендрограмма)
+SWEEP_LINKAGE = ('ward', 'euclidean')
+MANHATTAN_LINKAGE = ('average', 'manhattan')
+
+# Значения по умолчанию совпадают с виджетами app.py
+DEFAULT_PARAMS = {
+    'min_k': 2,
+    'max_k': 10,
+    'n_clusters': None,          # None — оптимальное k по Silhouette
+    'init_method': 'k-means++',
+    'sweep_mode': 'exhaustive',
+    'silhouette_sample': None,
+    'distance_metric': 'euclidean',
+    'random_state': 42,
+    'max_iter': 300,
+    'engine': 'kmeans',
+    'batch_size': 1024,
+    'feature_axis': 'Segment',
+    'svd_components': 50,
+    'neighbors_top_n': 5,        # 0 — без таблицы похожих магазинов
+    'neighbors_same_cluster': True,
+    'float32': False,            # доли и признаки в float32 (вдвое меньше памяти)
+    'stability_resamples': 0,    # максимум выборок для оценки устойчивости (0 — не оценивать)
+    'forecast_freq': None,       # 'MS' / 'D' — прогноз оборота кластеров по колонке Date (None — без прогноза)
+    'forecast_horizon': None,    # периодов вперед (None — forecast.DEFAULT_HORIZON)
+    'forecast_by_segment': False,
+}
+
+
+def read_sales_file(path, cache=None, keep_dates=False, feature_axis='Segment'):
+    """Загружает и очищает файл продаж (.xlsx/.xls или .csv). Возвращает (df, meta).
+
+    CSV агрегируется при чтении; keep_dates=True сохраняет в агрегате колонку
+    Date (если она есть в файле) — она нужна для прогноза, feature_axis
+    (например, Art) — колонку признаков кластеризации.
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.csv':
+        columns = pd.read_csv(path, nrows=0).columns
+        keys = list(KEY_COLS)
+        if feature_axis != 'Segment' and feature_axis in columns:
+            keys.append(feature_axis)
+        if keep_dates and DATE_COL in columns:
+            keys.append(DATE_COL)
+        return stream_csv(path, keys=keys)
+    if suffix in ('.xlsx', '.xls'):
+        return load_excel_cached(path.read_bytes(), cache)
+    raise ValueError(f"Неподдерживаемый формат файла: {path.name}")
+
+
+def fit_params_for(params):
+    """Параметры итоговой кластеризации, которые реально читает fit_clusters().
+
+    Параметры KMeans не влияют на иерархическую кластеризацию (Manhattan).
+    """
+    if params['distance_metric'] == 'euclidean' and params['engine'] == 'minibatch':
+        return (('random_state', params['random_state']), ('init_method', params['init_method']),
+                ('engine', 'minibatch'), ('batch_size', params['batch_size']))
+    if params['distance_metric'] == 'euclidean':
+        return (('random_state', params['random_state']), ('init_method', params['init_method']),
+                ('max_iter', params['max_iter']))
+    return ()
+
+
+def check_stores(pivot_pct):
+    """ValueError, если магазинов меньше MIN_STORES."""
+    if len(pivot_pct) < MIN_STORES:
+        raise ValueError(f"Недостаточно магазинов для кластеризации: {len(pivot_pct)}. Минимум: {MIN_STORES}")
+
+
+def compute_features(df, pivot_pct, feature_axis='Segment', svd_components=50):
+    """Признаки кластеризации: (X_scaled, similarity_features, info).
+
+    Segment — стандартизованные доли сегментов (similarity_features и info —
+    None). Иначе — разреженные доли по колонке feature_axis и их
+    TruncatedSVD: similarity_features — эти доли для поиска соседей, info —
+    размеры, заполненность и объясненная дисперсия.
+    """
+    if feature_axis == 'Segment':
+        X_scaled, _ = pipeline.scale_features(pivot_pct)
+        return X_scaled, None, None
+    if feature_axis not in df.columns:
+        raise ValueError(f"В данных нет колонки {feature_axis} для кластеризации по ней")
+    similarity_features, X_scaled, info = pipeline.build_sparse_features(
+        df, feature_axis, pivot_pct.index, svd_components)
+    return X_scaled, similarity_features, info
+
+
+def k_range_for(min_k, max_k, n_stores):
+    """Диапазон перебора k, ограниченный числом магазинов."""
+    max_k = min(max_k, n_stores - 1)
+    return range(min(min_k, max_k), max_k + 1)
+
+
+def compute_sweep(X_scaled, k_range, init_method, mode='exhaustive', D=None, silhouette_sample=None,
+                  tree=None, n_jobs=1, k_cache=None, progress=None):
+    """Перебор k (pipeline.sweep_k). tree — дерево SWEEP_LINKAGE для mode='hierarchical'.
+
+    k_cache используется только режимами K_CACHE_MODES.
+    """
+    return pipeline.sweep_k(X_scaled, k_range, init_method, progress, n_jobs=n_jobs, D=D,
+                            silhouette_sample=silhouette_sample, mode=mode, tree=tree,
+                            k_cache=k_cache if mode in K_CACHE_MODES else None)
+
+
+def compute_fit(X_scaled, n_clusters, distance_metric, fit_params, D=None, silhouette_sample=None, tree=None):
+    """Итоговая кластеризация и ее качество: (clusters, inertia, quality).
+
+    fit_params — fit_params_for(); tree — дерево MANHATTAN_LINKAGE для
+    distance_metric='manhattan'; D — евклидова матрица расстояний для метрик.
+    """
+    clusters, inertia = pipeline.fit_clusters(X_scaled, n_clusters, distance_metric, tree=tree,
+                                              **dict(fit_params))
+    return clusters, inertia, pipeline.quality_metrics(X_scaled, clusters, D, silhouette_sample)
+
+
+def compute_neighbors(pivot_pct, clusters, similarity_features=None):
+    """Индекс похожих магазинов: по долям сегментов или по similarity_features."""
+    features = pivot_pct.values if similarity_features is None else similarity_features
+    return NeighborIndex(features, pivot_pct.index, clusters)
+
+
+def compute_stability(X_scaled, clusters, n_clusters, distance_metric, fit_params, stores, n_resamples,
+                      mode='subsample', random_state=0, consensus=None, n_jobs=1, progress=None):
+    """Устойчивость кластеров к повторному обучению (stability.bootstrap_stability)."""
+    return bootstrap_stability(X_scaled, clusters, n_clusters, distance_metric, fit_params, stores=stores,
+                               n_resamples=n_resamples, mode=mode, random_state=random_state,
+                               consensus=consensus, n_jobs=n_jobs, progress=progress)
+
+
+def compute_forecast(df, stores, clusters, freq, horizon=None, by_segment=False, n_jobs=1, progress=None):
+    """Прогноз оборота кластеров по колонке Date (forecast.forecast_clusters)."""
+    return forecast_clusters(df, pd.Series(clusters, index=stores), freq, horizon, by_segment,
+                             n_jobs=n_jobs, progress=progress)
+
+
+def model_from_fit(pivot_pct, clusters, distance_metric, fit_params, quality, projection=None, **meta):
+    """Сохраняемая модель (model.ClusterModel) итоговой кластеризации по сегментам."""
+    return ClusterModel.from_fit(
+        pivot_pct, clusters, distance_metric, projection=projection, fit_params=dict(fit_params),
+        quality={name: float(quality[name]) for name in QUALITY_METRICS}, **meta)
+
+
+def excel_report(table, profiles, quality, forecast=None):
+    """Байты Excel-отчета: итоговая таблица, профили, метрики и (если есть) прогноз."""
+    return pipeline.build_excel_report(table, profiles, tuple(quality[name] for name in QUALITY_METRICS),
+                                       None if forecast is None else forecast_sheet(forecast))
+
+
+def optimal_k(sweep):
+    """Оптимальное k по каждой метрике перебора (и по методу локтя)."""
+    k_range = list(sweep['k'])
+    # Точка максимального изменения inertia на единицу k (сетка adaptive неравномерна)
+    elbow = pipeline.elbow_k(k_range, sweep['inertia'])
+    return {
+        'silhouette': k_range[int(np.argmax(sweep['silhouette']))],
+        'davies_bouldin': k_range[int(np.argmin(sweep['davies_bouldin']))],
+        'calinski_harabasz': k_range[int(np.argmax(sweep['calinski_harabasz']))],
+        'elbow': elbow,
+    }
+
+
+def clustered_table(pivot_table, pivot_pct, clusters):
+    """Доли сегментов с номером кластера и оборотом магазина, по кластерам."""
+    table = pivot_pct.copy()
+    table['Кластер'] = clusters
+    table = table.sort_values('Кластер')
+    table['Оборот_магазина'] = table.index.map(pivot_table.sum(axis=1))
+    return table
+
+
+def result_frame(table):
+    """Итоговая таблица для экспорта (магазин — колонкой)."""
+    return table.reset_index().rename(columns={'index': 'Магазин'})
+
+
+def run_clustering(df, **params):
+    """Полный расчет по очищенной таблице продаж (формат loaders.clean_sales).
+
+    Параметры — см. DEFAULT_PARAMS. Возвращает dict с матрицами, перебором k,
+    метками, метриками качества, профилями, итоговой таблицей и (если
+    neighbors_top_n > 0) таблицей похожих магазинов.
+    """
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise TypeError(f"Неизвестные параметры: {', '.join(sorted(unknown))}")
+    params = {**DEFAULT_PARAMS, **params}
+
+    pivot_table, pivot_pct = pipeline.build_pivot(df, np.float32 if params['float32'] else np.float64)
+    check_stores(pivot_pct)
+    n_stores = len(pivot_pct)
+    X_scaled, similarity_features, _ = compute_features(df, pivot_pct, params['feature_axis'],
+                                                        params['svd_components'])
+
+    # Как в app.py: матрицы расстояний — только если обе помещаются в бюджет
+    distance_matrices_fit = matrix_fits(n_stores, n_matrices=2)
+    silhouette_sample = params['silhouette_sample']
+    D_euclidean = None
+    if distance_matrices_fit and not silhouette_sample:
+        D_euclidean = pairwise_matrix(X_scaled, 'euclidean')
+
+    k_range = k_range_for(params['min_k'], params['max_k'], n_stores)
+    sweep_tree = None
+    if params['sweep_mode'] == 'hierarchical':
+        sweep_tree = linkage_tree(X_scaled, *SWEEP_LINKAGE, D_euclidean)
+    sweep = compute_sweep(X_scaled, k_range, params['init_method'], params['sweep_mode'], D_euclidean,
+                          silhouette_sample, sweep_tree)
+    best_k = optimal_k(sweep)
+    n_clusters = params['n_clusters'] or best_k['silhouette']
+
+    tree = None
+    if params['distance_metric'] == 'manhattan':
+        D_manhattan = pairwise_matrix(X_scaled, 'manhattan') if distance_matrices_fit else None
+        tree = linkage_tree(X_scaled, *MANHATTAN_LINKAGE, D_manhattan)
+    fit_params = fit_params_for(params)
+    clusters, inertia, quality = compute_fit(X_scaled, n_clusters, params['distance_metric'], fit_params,
+                                             D_euclidean, silhouette_sample, tree)
+
+    table = clustered_table(pivot_table, pivot_pct, clusters)
+    result = {
+        'params': params,
+        'pivot_table': pivot_table,
+        'pivot_pct': pivot_pct,
+        'X_scaled': X_scaled,
+        'sweep': sweep,
+        'optimal_k': best_k,
+        'n_clusters': n_clusters,
+        'clusters': clusters,
+        'inertia': inertia,
+        'quality': quality,
+        'profiles': pipeline.cluster_profiles(pivot_pct, clusters),
+        'table': result_frame(table),
+        'neighbors': None,
+        'stability': None,
+        'forecast': None,
+    }
+    if params['neighbors_top_n']:
+        index = compute_neighbors(pivot_pct, clusters, similarity_features)
+        result['neighbors'] = index.batch(min(params['neighbors_top_n'], n_stores - 1),
+                                          params['neighbors_same_cluster'])
+    if params['stability_resamples']:
+        # Файлы уже распределены по процессам пакетного режима, поэтому здесь — последовательно
+        result['stability'] = compute_stability(
+            X_scaled, clusters, n_clusters, params['distance_metric'], fit_params, pivot_pct.index,
+            params['stability_resamples'], random_state=params['random_state'], consensus=False)
+    if params['forecast_freq'] and has_dates(df):
+        result['forecast'] = compute_forecast(
+            df, pivot_pct.index, clusters, params['forecast_freq'], params['forecast_horizon'],
+            params['forecast_by_segment'])
+    return result
+
+
+def write_reports(result, out_dir, stem):
+    """CSV и Excel-отчет (и CSV соседей) в out_dir. Возвращает список путей."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    k = result['n_clusters']
+
+    csv_path = out_dir / f"{stem}_store_clusters_k{k}.csv"
+    result['table'].to_csv(csv_path, index=False, encoding='utf-8-sig')
+    report_path = out_dir / f"{stem}_store_clustering_report_k{k}.xlsx"
+    report_path.write_bytes(excel_report(result['table'], result['profiles'], result['quality'],
+                                         result['forecast']))
+    paths = [csv_path, report_path]
+    if result['neighbors'] is not None:
+        neighbors_path = out_dir / f"{stem}_store_neighbors.csv"
+        result['neighbors'].to_csv(neighbors_path, index=False, encoding='utf-8-sig')
+        paths.append(neighbors_path)
+    if result['stability'] is not None:
+        for name in ('clusters', 'stores'):
+            stability_path = out_dir / f"{stem}_stability_{name}.csv"
+            result['stability'][name].to_csv(stability_path, index=False, encoding='utf-8-sig')
+            paths.append(stability_path)
+    return paths
+
+
+def build_model(result, **meta):
+    """Сохраняемая модель кластеров (model.ClusterModel) по результату run_clustering()."""
+    params = result['params']
+    if params['feature_axis'] != 'Segment':
+        raise ValueError("Модель сохраняется только для кластеризации по сегментам")
+    projection, _ = pipeline.project_2d(result['X_scaled'])
+    return model_from_fit(result['pivot_pct'], result['clusters'], params['distance_metric'],
+                          fit_params_for(params), result['quality'], projection, **meta)
+
+
+def assign_stores(df, model):
+    """Назначение магазинов таблицы продаж в кластеры сохраненной модели.
+
+    Возвращает (таблица назначений, метрики дрейфа).
+    """
+    _, pivot_pct = pipeline.build_pivot(df)
+    assigned = model.assign(pivot_pct)
+    return assigned, model.drift(pivot_pct, assigned)
+
+
+def process_file(path, out_dir, params, save_model=False):
+    """Загрузка, расчет и отчеты для одного файла. Возвращает строку сводки."""
+    started = time.perf_counter()
+    path = Path(path)
+    df, load_meta = read_sales_file(path, ParquetCache(), keep_dates=bool(params.get('forecast_freq')),
+                                    feature_axis=params.get('feature_axis', 'Segment'))
+    result = run_clustering(df, **params)
+    outputs = write_reports(result, out_dir, path.stem)
+    if save_model:
+        model_path = Path(out_dir) / f"{path.stem}_model.npz"
+        build_model(result, source=path.name, data_key=load_meta.get('key')).save(model_path)
+        outputs.append(model_path)
+    return {
+        'file': path.name,
+        'stores': len(result['pivot_pct']),
+        'k': result['n_clusters'],
+        'silhouette': result['quality']['silhouette'],
+        'seconds': time.perf_counter() - started,
+        'outputs': [str(p) for p in outputs],
+        'error': None,
+    }
+
+
+def assign_file(path, out_dir, model_path):
+    """Назначение магазинов файла в кластеры модели model_path (без перекластеризации)."""
+    started = time.perf_counter()
+    path = Path(path)
+    model = ClusterModel.load(model_path)
+    df, _ = read_sales_file(path, ParquetCache())
+    assigned, drift = assign_stores(df, model)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    assigned_path = out_dir / f"{path.stem}_assigned.csv"
+    assigned.to_csv(assigned_path, index=False, encoding='utf-8-sig')
+    drift_path = out_dir / f"{path.stem}_drift.json"
+    drift_path.write_text(json.dumps(drift, ensure_ascii=False, indent=2), encoding='utf-8')
+    return {
+        'file': path.name,
+        'stores': len(assigned),
+        'k': model.n_clusters,
+        'silhouette': None,
+        'drift': drift,
+        'seconds': time.perf_counter() - started,
+        'outputs': [str(assigned_path), str(drift_path)],
+        'error': None,
+    }
+
+
+def run_incremental(paths, out_dir, state_dir, window=DEFAULT_WINDOW, model_path=None, params=None):
+    """Инкрементальный запуск: файлы — периоды (имя файла = период, по порядку имен).
+
+    В агрегаты state_dir добавляются только новые или изменившиеся периоды,
+    окно последних window периодов перекластеризуется с теплым стартом от
+    модели model_path (или от модели прошлого запуска в state_dir). Без
+    предыдущей модели выполняется обычный расчет run_clustering(). Возвращает
+    сводку: добавленные периоды, окно, время, число переходов и пути файлов.
+    """
+    started = time.perf_counter()
+    state_dir, out_dir = Path(state_dir), Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    aggregates = PeriodAggregates.load(state_dir, window)
+    added = []
+    for path in sorted(paths, key=lambda p: Path(p).stem):
+        df, meta = read_sales_file(path, ParquetCache())
+        if aggregates.add_period(Path(path).stem, df, meta.get('key')):
+            added.append(Path(path).stem)
+    aggregates.save(state_dir)
+
+    state_model = state_dir / 'model.npz'
+    model_path = model_path or (state_model if state_model.exists() else None)
+    window_df = aggregates.window_frame()
+    outputs = []
+    if model_path is None:
+        result = run_clustering(window_df, **{**(params or {}), 'neighbors_top_n': 0})
+        model = build_model(result, periods=list(aggregates.periods))
+        clusters, moved = result['clusters'], None
+    else:
+        result = warm_recluster(window_df, ClusterModel.load(model_path),
+                                n_clusters=(params or {}).get('n_clusters'))
+        model, clusters, moved = result['model'], result['clusters'], result['moved']
+        model.meta['periods'] = list(aggregates.periods)
+        migration_path = out_dir / 'migration_matrix.csv'
+        result['migration'].to_csv(migration_path, encoding='utf-8-sig')
+        moved_path = out_dir / 'moved_stores.csv'
+        moved.to_csv(moved_path, index=False, encoding='utf-8-sig')
+        outputs += [migration_path, moved_path]
+
+    window_name = f"{min(aggregates.periods)}_{max(aggregates.periods)}"
+    clusters_path = out_dir / f"window_{window_name}_store_clusters.csv"
+    table = clustered_table(result['pivot_table'], result['pivot_pct'], clusters)
+    result_frame(table).to_csv(
+        clusters_path, index=False, encoding='utf-8-sig')
+    model.save(state_model)
+    outputs += [clusters_path, state_model]
+    return {
+        'added_periods': added,
+        'window': list(aggregates.periods),
+        'warm_start': model_path is not None,
+        'k': model.n_clusters,
+        'moved': None if moved is None else len(moved),
+        'seconds': time.perf_counter() - started,
+        'outputs': [str(p) for p in outputs],
+    }
+
+
+def find_inputs(input_dir):
+    """Файлы продаж каталога (без временных файлов Excel '~$...')."""
+    return sorted(p for p in Path(input_dir).iterdir()
+                  if p.suffix.lower() in INPUT_SUFFIXES and not p.name.startswith('~$'))
+
+
+def run_batch(paths, task, n_jobs=None, progress=None):
+    """Применяет task(path) к файлам параллельно (по файлу на процесс).
+
+    task — функция уровня модуля (или functools.partial от нее), например
+    partial(process_file, out_dir=..., params=...) или partial(assign_file, ...).
+    Ошибка в одном файле не останавливает остальные: она попадает в поле
+    'error' его строки сводки. progress(done, summary) вызывается по мере
+    готовности. Возвращает сводки в порядке paths.
+    """
+    paths = list(paths)
+    n_jobs = max(1, min(n_jobs or default_n_jobs(), len(paths)))
+    summaries = {}
+
+    def finish(path, summary):
+        summaries[path] = summary
+        if progress is not None:
+            progress(len(summaries), summary)
+
+    def failed(path, exc):
+        return {'file': Path(path).name, 'stores': None, 'k': None, 'silhouette': None,
+                'seconds': None, 'outputs': [], 'error': f"{type(exc).__name__}: {exc}"}
+
+    if n_jobs == 1:
+        for path in paths:
+            try:
+                finish(path, task(path))
+            except Exception as exc:
+                finish(path, failed(path, exc))
+    else:
+        with process_pool(n_jobs) as pool:
+            futures = {pool.submit(task, path): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    finish(path, future.result())
+                except Exception as exc:
+                    finish(path, failed(path, exc))
+    return [summaries[path] for path in paths]
@@ -0,0 +1,58 @@
+"""Матрица признаков магазин × (сегмент | артикул) в разреженном виде.
+
+Ключи факторизуются в целочисленные коды (категории из loaders.clean_sales),
+Sum накапливается сразу в scipy.sparse CSR без промежуточных плотных таблиц.
+Для артикулов (десятки тысяч колонок, >95% нулей) доли считаются без
+уплотнения, а кластеризация идет по TruncatedSVD-представлению.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.decomposition import TruncatedSVD
+
+SVD_COMPONENTS = 50
+
+
+def factorize(col):
+    """Коды и уникальные значения колонки (для category — без пересчета)."""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy(), col.cat.categories
+    codes, uniques = pd.factorize(col.astype(str), sort=True)
+    return codes, uniques
+
+
+def sparse_matrix(df, feature_col='Segment'):
+    """CSR-матрица оборотов магазин × feature_col.
+
+    Возвращает (матрица, индекс магазинов, индекс признаков). Строки с
+    пустым значением признака пропускаются.
+    """
+    rows, stores = factorize(df['Magazin'])
+    cols, features = factorize(df[feature_col])
+    values = df['Sum'].to_numpy(dtype=np.float64)
+
+    mask = (rows >= 0) & (cols >= 0)
+    # Повторяющиеся пары (магазин, признак) суммируются при сборке CSR
+    matrix = sp.csr_matrix(
+        (values[mask], (rows[mask], cols[mask])),
+        shape=(len(stores), len(features))
+    )
+    matrix.sum_duplicates()
+    return (matrix,
+            pd.Index(stores, name='Magazin').astype(str),
+            pd.Index(features, name=feature_col).astype(str))
+
+
+def row_shares(matrix):
+    """Доли признаков в обороте каждого магазина (%), без уплотнения."""
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(100.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    return sp.diags(scale) @ matrix
+
+
+def reduce_svd(shares, n_components=SVD_COMPONENTS, random_state=42):
+    """TruncatedSVD-представление долей. Возвращает (embedding, объясненная дисперсия)."""
+    n_components = max(1, min(n_components, min(shares.shape) - 1))
+    svd = TruncatedSVD(n_components=n_components, random_state=random_state)
+    embedding = svd.fit_transform(shares)
+    return embedding, float(svd.explained_variance_ratio_.sum())
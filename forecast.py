@@ -0,0 +1,217 @@
+"""Прогноз оборота кластеров (Prophet).
+
+Sum агрегируется по кластеру (и, по выбору, по кластеру × сегменту) и
+периоду — дню или месяцу — по необязательной колонке Date. Каждый ряд
+обучается отдельной моделью Prophet; ряды распределяются по пулу процессов.
+Обученная модель сохраняется на диске в JSON (prophet.serialize, без
+pickle) под хэшем ряда и настроек: ряды, которые не изменились, повторно не
+обучаются, а смена горизонта требует только predict(). Размер каталога
+моделей ограничен (KLASTER_PROPHET_CACHE_MB) с вытеснением LRU.
+
+Prophet — тяжелая зависимость, поэтому импортируется при первом обучении.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from loaders import DEFAULT_CACHE_DIR
+from parallel import default_n_jobs, process_pool
+
+DATE_COL = 'Date'
+FREQS = {'MS': 'месяц', 'D': 'день'}
+DEFAULT_HORIZON = {'MS': 6, 'D': 90}
+# Меньше точек — ряд не прогнозируется (статус в сводке)
+MIN_POINTS = {'MS': 6, 'D': 28}
+PROPHET_PARAMS = {
+    'MS': {'weekly_seasonality': False, 'daily_seasonality': False, 'interval_width': 0.8},
+    'D': {'daily_seasonality': False, 'interval_width': 0.8},
+}
+DEFAULT_MODEL_DIR = Path(DEFAULT_CACHE_DIR) / 'prophet'
+# Лимит каталога моделей; сверх него удаляются давно не использованные (LRU по mtime)
+MODEL_CACHE_MAX_MB = int(os.environ.get('KLASTER_PROPHET_CACHE_MB', '512'))
+
+
+def has_dates(df):
+    return DATE_COL in df.columns
+
+
+def parse_dates(values):
+    """Колонка Date -> datetime: даты Excel, ISO (2024-01-31) или ДД.ММ.ГГГГ."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    dates = pd.to_datetime(values, errors='coerce', format='ISO8601')
+    rest = dates.isna() & values.notna()
+    if rest.any():
+        dates[rest] = pd.to_datetime(values[rest], errors='coerce', dayfirst=True)
+    return dates
+
+
+def cluster_series(df, labels, freq='MS', by_segment=False):
+    """Длинная таблица рядов: Кластер, [Segment], ds, y.
+
+    labels — Series магазин -> кластер. Пропущенные периоды внутри ряда
+    заполняются нулем (в этот период продаж не было).
+    """
+    dates = parse_dates(df[DATE_COL])
+    stores = df['Magazin'].astype(str)
+    frame = pd.DataFrame({
+        'Кластер': stores.map(labels.set_axis(labels.index.astype(str))),
+        'ds': dates.dt.to_period('M').dt.to_timestamp() if freq == 'MS' else dates.dt.normalize(),
+        'y': df['Sum'].to_numpy(dtype=np.float64),
+    })
+    keys = ['Кластер']
+    if by_segment:
+        frame['Segment'] = df['Segment'].astype(str).to_numpy()
+        keys.append('Segment')
+    frame = frame.dropna(subset=['Кластер', 'ds'])
+    frame['Кластер'] = frame['Кластер'].astype(int)
+    series = frame.groupby(keys + ['ds'], sort=True)['y'].sum().reset_index()
+
+    parts = []
+    for key, part in series.groupby(keys, sort=True):
+        full = pd.date_range(part['ds'].min(), part['ds'].max(), freq=freq)
+        filled = part.set_index('ds')['y'].reindex(full, fill_value=0.0).rename_axis('ds').reset_index()
+        for name, value in zip(keys, key if isinstance(key, tuple) else (key,)):
+            filled[name] = value
+        parts.append(filled[keys + ['ds', 'y']])
+    if not parts:
+        return pd.DataFrame(columns=keys + ['ds', 'y'])
+    return pd.concat(parts, ignore_index=True)
+
+
+def series_hash(ds, y, freq):
+    """Ключ модели: значения ряда и настройки Prophet (не номер кластера)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.asarray(ds, dtype='datetime64[ns]').view(np.int64).tobytes())
+    digest.update(np.asarray(y, dtype=np.float64).tobytes())
+    digest.update(json.dumps([freq, PROPHET_PARAMS[freq]], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def fit_series(ds, y, freq, horizon, model_dir=DEFAULT_MODEL_DIR):
+    """Прогноз одного ряда на horizon периодов вперед.
+
+    Возвращает (DataFrame ds, yhat, yhat_lower, yhat_upper только для
+    будущих периодов, статус): 'cached' — модель взята с диска, 'fitted' —
+    обучена и сохранена, 'short' — мало точек, прогноза нет.
+    """
+    if len(ds) < MIN_POINTS[freq]:
+        return None, 'short'
+    from prophet import Prophet
+    from prophet.serialize import model_from_json, model_to_json
+    # cmdstanpy пишет в лог каждый запуск оптимизатора; свой обработчик
+    # не дает ему при первом запуске добавить обработчик уровня INFO
+    stan_logger = logging.getLogger('cmdstanpy')
+    if not stan_logger.handlers:
+        stan_logger.addHandler(logging.NullHandler())
+    stan_logger.setLevel(logging.WARNING)
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    model_path = model_dir / f"{series_hash(ds, y, freq)}.json"
+    model = None
+    if model_path.exists():
+        try:
+            text = model_path.read_text(encoding='utf-8')
+            now = time.time()
+            os.utime(model_path, (now, now))
+            model = model_from_json(text)
+            status = 'cached'
+        except (OSError, ValueError, KeyError):
+            # Запись удалена вытеснением в другом процессе или повреждена
+            model = None
+    if model is None:
+        model = Prophet(**PROPHET_PARAMS[freq])
+        model.fit(pd.DataFrame({'ds': ds, 'y': y}))
+        tmp_path = model_path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_path.write_text(model_to_json(model), encoding='utf-8')
+        tmp_path.replace(model_path)
+        status = 'fitted'
+
+    future = model.make_future_dataframe(periods=horizon, freq=freq, include_history=False)
+    predicted = model.predict(future)[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+    # Оборот не бывает отрицательным
+    predicted[['yhat', 'yhat_lower', 'yhat_upper']] = predicted[['yhat', 'yhat_lower', 'yhat_upper']].clip(lower=0)
+    return predicted, status
+
+
+def evict_models(model_dir=DEFAULT_MODEL_DIR, max_bytes=MODEL_CACHE_MAX_MB * 1024 ** 2):
+    """Удаляет наименее недавно использованные модели сверх лимита каталога."""
+    entries = []
+    for path in Path(model_dir).glob('*.json'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # удалена другим процессом
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    # Самую свежую модель не удаляем, даже если она одна больше лимита
+    for _, size, path in entries[:-1]:
+        if total <= max_bytes:
+            break
+        total -= size
+        path.unlink(missing_ok=True)
+
+
+def forecast_clusters(df, labels, freq='MS', horizon=None, by_segment=False, n_jobs=None,
+                      model_dir=DEFAULT_MODEL_DIR, progress=None):
+    """Прогноз оборота всех кластеров (или кластеров × сегментов).
+
+    progress(done, total) вызывается по мере готовности рядов. Возвращает
+    dict: history (Кластер, [Segment], ds, y), forecast (те же ключи, ds,
+    yhat, yhat_lower, yhat_upper) и summary — по ряду: точек истории,
+    статус модели, прогноз за горизонт и оборот за столько же последних
+    периодов.
+    """
+    horizon = horizon or DEFAULT_HORIZON[freq]
+    history = cluster_series(df, labels, freq, by_segment)
+    keys = ['Кластер'] + (['Segment'] if by_segment else [])
+    groups = [(key if isinstance(key, tuple) else (key,), part)
+              for key, part in history.groupby(keys, sort=True)]
+
+    tasks = [(part['ds'].to_numpy(), part['y'].to_numpy(), freq, horizon, model_dir) for _, part in groups]
+    n_workers = max(1, min(n_jobs or default_n_jobs(), len(tasks)))
+    results = [None] * len(tasks)
+    if n_workers == 1:
+        for i, task in enumerate(tasks):
+            results[i] = fit_series(*task)
+            if progress is not None:
+                progress(i + 1, len(tasks))
+    else:
+        with process_pool(n_workers) as pool:
+            futures = {pool.submit(fit_series, *task): i for i, task in enumerate(tasks)}
+            for done, future in enumerate(as_completed(futures), 1):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress(done, len(tasks))
+    evict_models(model_dir)
+
+    forecasts, summary = [], []
+    for (key, part), (predicted, status) in zip(groups, results):
+        row = dict(zip(keys, key))
+        row.update({'Точек': len(part), 'Модель': status, 'Прогноз': np.nan, 'Факт_за_столько_же': np.nan})
+        if predicted is not None:
+            forecasts.append(predicted.assign(**dict(zip(keys, key))))
+            row['Прогноз'] = predicted['yhat'].sum()
+            row['Факт_за_столько_же'] = part['y'].tail(horizon).sum()
+        summary.append(row)
+    forecast = (pd.concat(forecasts, ignore_index=True)[keys + ['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+                if forecasts else pd.DataFrame(columns=keys + ['ds', 'yhat', 'yhat_lower', 'yhat_upper']))
+    summary = pd.DataFrame(summary)
+    summary['Изменение_%'] = (summary['Прогноз'] / summary['Факт_за_столько_же'] - 1) * 100
+    return {'freq': freq, 'horizon': horizon, 'history': history, 'forecast': forecast, 'summary': summary}
+
+
+def forecast_sheet(result):
+    """Таблица для листа Excel-отчета: будущие периоды с границами интервала."""
+    names = {'Segment': 'Сегмент', 'ds': 'Период', 'yhat': 'Прогноз',
+             'yhat_lower': 'Нижняя_граница', 'yhat_upper': 'Верхняя_граница'}
+    return result['forecast'].rename(columns=names)
@@ -0,0 +1,42 @@
+"""Иерархическая кластеризация на одном дереве.
+
+Linkage matrix строится один раз на (данные, метод связи, метрику) и затем
+используется для дендрограммы, итоговой иерархической кластеризации и
+иерархического перебора k: метки для любого k получаются разрезом дерева
+(fcluster), что почти ничего не стоит.
+"""
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+
+from profiling import profiled
+
+LINKAGE_METHODS = ['ward', 'average', 'complete', 'single']
+LINKAGE_METRICS = ['euclidean', 'manhattan']
+
+
+@profiled('linkage')
+def linkage_tree(X, method='ward', metric='euclidean', D=None):
+    """Linkage matrix. D — готовая квадратная матрица расстояний той же метрики."""
+    if method == 'ward' and metric != 'euclidean':
+        raise ValueError("Метод Ward определен только для евклидова расстояния")
+    if D is not None:
+        condensed = squareform(np.asarray(D, dtype=np.float64), checks=False)
+        return linkage(condensed, method=method)
+    scipy_metric = 'cityblock' if metric == 'manhattan' else metric
+    return linkage(X, method=method, metric=scipy_metric)
+
+
+def cut_tree(Z, n_clusters):
+    """Метки 0..k-1 для разреза дерева на n_clusters кластеров."""
+    return fcluster(Z, t=n_clusters, criterion='maxclust') - 1
+
+
+def within_cluster_sse(X, labels):
+    """Сумма квадратов расстояний до центров кластеров (аналог inertia KMeans)."""
+    X = np.asarray(X, dtype=np.float64)
+    counts = np.bincount(labels)
+    centers = np.zeros((len(counts), X.shape[1]))
+    np.add.at(centers, labels, X)
+    centers /= np.maximum(counts, 1)[:, None]
+    return float(((X - centers[labels]) ** 2).sum())
@@ -0,0 +1,254 @@
+"""Инкрементальная перекластеризация по периодам.
+
+Агрегаты (Magazin, Segment) -> Sum хранятся по периодам; скользящее окно
+(например, последние 6 месяцев) поддерживается как бегущая сумма: новый
+период прибавляется, выпавший из окна — вычитается, без повторного чтения
+всей истории. Перекластеризация окна стартует с центров предыдущей модели
+(model.ClusterModel), а новые кластеры сопоставляются старым венгерским
+алгоритмом по расстояниям между центрами, поэтому номера кластеров
+сохраняются между запусками. Матрица миграции показывает, какие магазины
+перешли в другой кластер.
+"""
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans
+from sklearn.metrics import pairwise_distances
+
+import pipeline
+from hierarchy import within_cluster_sse
+from loaders import KEY_COLS, frame_hash
+from model import ClusterModel
+
+# Сколько последних периодов входит в окно по умолчанию (README: повтор раз в 3–6 месяцев)
+DEFAULT_WINDOW = 6
+NEW_STORE = 'Новый'
+CLOSED_STORE = 'Выбыл'
+
+
+def _aggregate(df):
+    """Сумма Sum по (Magazin, Segment) для таблицы формата loaders.clean_sales."""
+    keys = df[KEY_COLS].astype(str)
+    return df['Sum'].groupby([keys[col] for col in KEY_COLS], sort=False).sum()
+
+
+class PeriodAggregates:
+    """Агрегаты продаж по периодам и бегущая сумма по окну последних периодов."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.periods = OrderedDict()
+        self.keys = {}
+        self.total = pd.Series(dtype='float64')
+
+    def _apply(self, part, sign):
+        if self.total.empty:
+            self.total = sign * part
+        else:
+            self.total = self.total.add(sign * part, fill_value=0)
+        # Пары, полностью выпавшие из окна, не должны оставаться нулевыми строками
+        self.total = self.total[self.total.abs() > 1e-9]
+
+    def add_period(self, period, df, key=None):
+        """Добавляет (или заменяет) период; в бегущую сумму идет только разница.
+
+        Возвращает False, если период с тем же key уже учтен или старше
+        заполненного окна.
+        """
+        key = key or frame_hash(df)
+        if self.keys.get(period) == key:
+            return False
+        if period not in self.periods and len(self.periods) >= self.window and period < min(self.periods):
+            return False
+        part = _aggregate(df)
+        if period in self.periods:
+            self._apply(self.periods.pop(period), -1)
+        self.periods[period] = part
+        self.keys[period] = key
+        self._apply(part, +1)
+        self._trim()
+        return True
+
+    def _trim(self):
+        # Периоды упорядочены по имени (например, 2024-01, 2024-02, ...)
+        for period in sorted(self.periods)[:-self.window or None]:
+            self._apply(self.periods.pop(period), -1)
+            self.keys.pop(period)
+
+    def window_frame(self):
+        """Суммы по окну в формате loaders.clean_sales."""
+        df = self.total.rename('Sum').reset_index()
+        df.columns = KEY_COLS + ['Sum']
+        for col in KEY_COLS:
+            df[col] = df[col].astype('category')
+        return df
+
+    def save(self, directory):
+        """Периоды — в parquet, список и хэши — в index.json."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for old in directory.glob('period=*.parquet'):
+            if old.stem.split('=', 1)[1] not in self.periods:
+                old.unlink()
+        for period, part in self.periods.items():
+            part.rename('Sum').reset_index().to_parquet(directory / f"period={period}.parquet", index=False)
+        (directory / 'index.json').write_text(
+            json.dumps({'window': self.window, 'keys': self.keys}, ensure_ascii=False), encoding='utf-8')
+
+    @classmethod
+    def load(cls, directory, window=None):
+        directory = Path(directory)
+        index_path = directory / 'index.json'
+        if not index_path.exists():
+            return cls(window or DEFAULT_WINDOW)
+        index = json.loads(index_path.read_text(encoding='utf-8'))
+        aggregates = cls(window or index['window'])
+        for period, key in index['keys'].items():
+            part = pd.read_parquet(directory / f"period={period}.parquet")
+            series = part.set_index(KEY_COLS)['Sum']
+            aggregates.periods[period] = series
+            aggregates.keys[period] = key
+            aggregates._apply(series, +1)
+        aggregates._trim()
+        return aggregates
+
+
+def warm_centroids(prev_model, pivot_pct, mean, scale):
+    """Центры предыдущей модели в стандартизованном пространстве новых данных.
+
+    Центры переводятся обратно в доли сегментов (статистики старой модели) и
+    стандартизуются статистиками новых данных; сегменты, которых не было в
+    модели, получают долю 0.
+    """
+    centroids_pct = pd.DataFrame(prev_model.centroids * prev_model.scale + prev_model.mean,
+                                 columns=prev_model.segments)
+    aligned = centroids_pct.reindex(columns=pivot_pct.columns.astype(str), fill_value=0)
+    return (aligned.to_numpy() - mean) / scale
+
+
+def match_labels(prev_centroids, new_centroids):
+    """Перенумерация новых кластеров в номера старых (венгерский алгоритм).
+
+    Возвращает массив mapping: новый кластер i -> номер mapping[i]. Лишние
+    новые кластеры (если k выросло) получают номера после старых.
+    """
+    cost = pairwise_distances(new_centroids, prev_centroids)
+    rows, cols = linear_sum_assignment(cost)
+    mapping = np.full(len(new_centroids), -1)
+    mapping[rows] = cols
+    unmatched = np.flatnonzero(mapping < 0)
+    mapping[unmatched] = len(prev_centroids) + np.arange(len(unmatched))
+    return mapping
+
+
+def migration_matrix(prev_labels, new_labels):
+    """Матрица миграции: строки — прежний кластер, колонки — новый.
+
+    Магазины, которых не было раньше, попадают в строку NEW_STORE, выбывшие —
+    в колонку CLOSED_STORE.
+    """
+    stores = prev_labels.index.union(new_labels.index)
+    prev = prev_labels.astype('Int64').reindex(stores)
+    new = new_labels.astype('Int64').reindex(stores)
+    table = pd.DataFrame({
+        'Было': prev.astype(object).fillna(NEW_STORE).astype(str),
+        'Стало': new.astype(object).fillna(CLOSED_STORE).astype(str),
+    })
+    matrix = pd.crosstab(table['Было'], table['Стало'])
+    # Номера кластеров по возрастанию как числа ("2" раньше "10"), новые и выбывшие — последними
+    return matrix.reindex(index=_label_order(prev, NEW_STORE), columns=_label_order(new, CLOSED_STORE),
+                          fill_value=0).rename_axis(index='Было', columns='Стало')
+
+
+def _label_order(labels, missing):
+    order = [str(label) for label in sorted(labels.dropna().astype(int).unique())]
+    return order + [missing] if labels.isna().any() else order
+
+
+def moved_stores(prev_labels, new_labels):
+    """Магазины, сменившие кластер (только присутствующие в обоих запусках)."""
+    common = prev_labels.index.intersection(new_labels.index)
+    before = prev_labels.reindex(common)
+    after = new_labels.reindex(common)
+    moved = before != after
+    return pd.DataFrame({
+        'Магазин': common[moved],
+        'Было': before[moved].to_numpy(),
+        'Стало': after[moved].to_numpy(),
+    })
+
+
+def warm_recluster(df, prev_model, n_clusters=None, max_iter=300, random_state=42):
+    """Перекластеризация с теплым стартом от prev_model и сохранением номеров.
+
+    n_clusters по умолчанию — число кластеров prev_model; если оно другое,
+    KMeans стартует холодно (k-means++), но сопоставление номеров все равно
+    выполняется. Модель с манхэттенской метрикой (иерархическая
+    кластеризация) стартовать с центров не может: дерево строится заново,
+    а номера сопоставляются по центрам так же. Возвращает dict: матрицы
+    оборотов и долей, метки (в номерах старой модели), inertia, число
+    итераций KMeans, признак теплого старта, перенумерация, матрица
+    миграции, переместившиеся магазины, новая модель (с метрикой
+    prev_model) и время.
+    """
+    started = time.perf_counter()
+    pivot_table, pivot_pct = pipeline.build_pivot(df)
+    X_scaled, scaler = pipeline.scale_features(pivot_pct)
+    prev_centroids = warm_centroids(prev_model, pivot_pct, scaler.mean_, scaler.scale_)
+
+    n_clusters = n_clusters or prev_model.n_clusters
+    warm_start = prev_model.metric == 'euclidean' and n_clusters == prev_model.n_clusters
+    if prev_model.metric == 'manhattan':
+        raw_labels, _ = pipeline.fit_clusters(X_scaled, n_clusters, 'manhattan')
+        counts = np.bincount(raw_labels, minlength=n_clusters)
+        centers = np.zeros((n_clusters, X_scaled.shape[1]))
+        np.add.at(centers, raw_labels, X_scaled)
+        centers /= np.maximum(counts, 1)[:, None]
+        inertia, n_iter = within_cluster_sse(X_scaled, raw_labels), 0
+    else:
+        if warm_start:
+            kmeans = KMeans(n_clusters=n_clusters, init=prev_centroids, n_init=1,
+                            max_iter=max_iter, random_state=random_state)
+        else:
+            kmeans = KMeans(n_clusters=n_clusters, init='k-means++', n_init=10,
+                            max_iter=max_iter, random_state=random_state)
+        raw_labels = kmeans.fit_predict(X_scaled)
+        centers, inertia, n_iter = kmeans.cluster_centers_, float(kmeans.inertia_), int(kmeans.n_iter_)
+
+    mapping = match_labels(prev_centroids, centers)
+    clusters = mapping[raw_labels]
+    if n_clusters < prev_model.n_clusters:
+        # k уменьшилось: номера исчезнувших кластеров освобождаются, порядок остальных сохраняется
+        clusters = np.unique(clusters, return_inverse=True)[1]
+    labels = pd.Series(clusters, index=pivot_pct.index.astype(str), name='Кластер')
+
+    result = {
+        'pivot_table': pivot_table,
+        'pivot_pct': pivot_pct,
+        'X_scaled': X_scaled,
+        'clusters': clusters,
+        'inertia': inertia,
+        'n_iter': n_iter,
+        'warm_start': warm_start,
+        'mapping': mapping,
+        'seconds': time.perf_counter() - started,
+    }
+    if prev_model.labels is not None:
+        result['migration'] = migration_matrix(prev_model.labels, labels)
+        result['moved'] = moved_stores(prev_model.labels, labels)
+    else:
+        result['migration'] = None
+        result['moved'] = None
+    result['model'] = ClusterModel.from_fit(pivot_pct, clusters, prev_model.metric,
+                                            warm_start=warm_start, previous=prev_model.meta.get('created_at'))
+    if prev_model.projection is not None:
+        # Оси PC1–PC2 прежней модели: магазины нового периода остаются на той же карте
+        result['model'].projection = prev_model.projection_for(result['model'].segments)
+    else:
+        result['model'].projection = pipeline.project_2d(X_scaled)[0].unscaled(scaler.mean_, scaler.scale_)
+    return result
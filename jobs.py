@@ -0,0 +1,178 @@
+"""Фоновые расчеты, переживающие перезапуски скрипта Streamlit.
+
+Каждое касание виджета перезапускает app.py с начала; синхронный расчет при
+этом начинался бы заново. Тяжелые этапы (перебор k, итоговая кластеризация,
+linkage-деревья) вместо этого отправляются в пул потоков процесса сервера:
+задание живет между перезапусками и находится по ключу — параметрам этапа.
+Следующий прогон скрипта, запросивший тот же ключ, получает уже идущее или
+готовое задание, а не запускает расчет снова.
+
+Задание занимает слот сессии (сессия, этап). Когда в слот приходит задание
+с другим ключом (входные данные изменились), прежнее отменяется, если его не
+ждет слот другой сессии. Отмена кооперативная: функция задания получает сам
+Job и через job.report()/job.check() узнает об отмене (исключение
+Cancelled); расчет, не вызывающий их (один KMeans), доходит до конца, но
+результат никто не ждет. Промежуточные результаты (метрики уже посчитанных
+k) копятся в job.partial, и интерфейс рисует их, пока задание идет.
+
+Задание выполняется в потоке пула, где нет профайлера сессии, и одно задание
+может ждать несколько сессий. Поэтому этапы задания (@profiled) замеряются
+его собственным профайлером job.profiler; сессия, забравшая результат,
+добавляет эти замеры в свою панель (Profiler.merge).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from profiling import Profiler, activate
+
+JOB_WORKERS = int(os.environ.get('KLASTER_JOB_WORKERS', '4'))
+# Сколько завершенных заданий хранить для мгновенной выдачи результата
+KEEP_FINISHED = 32
+# Сколько прогон скрипта ждет задание, прежде чем показать его ход
+# (короткие расчеты и попадания в кэш не требуют опроса), и период опроса
+JOB_WAIT_SECONDS = 1.0
+JOB_POLL_SECONDS = 1.0
+
+
+class Cancelled(Exception):
+    """Задание отменено: его результат больше не нужен."""
+
+
+class Job:
+    """Одно фоновое задание: будущий результат, промежуточные результаты, отмена."""
+
+    def __init__(self, key):
+        self.key = key
+        self.partial = []
+        self.future = None
+        self.started = time.perf_counter()
+        self.finished = None
+        # Замеры этапов задания (закрыты, когда задание завершено)
+        self.profiler = Profiler(job=str(key))
+        self._cancel = threading.Event()
+
+    def run(self, func, args, kwargs):
+        activate(self.profiler)
+        try:
+            self.check()
+            return func(self, *args, **kwargs)
+        finally:
+            self.profiler.finish(log_path=None)
+            activate(None)
+            self.finished = time.perf_counter()
+
+    def check(self):
+        """Исключение Cancelled, если задание отменено."""
+        if self._cancel.is_set():
+            raise Cancelled(self.key)
+
+    def report(self, item):
+        """Промежуточный результат (и точка проверки отмены)."""
+        self.check()
+        self.partial.append(item)
+
+    def cancel(self):
+        self._cancel.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    @property
+    def failed(self):
+        """Задание завершилось ошибкой или отменой (его можно запускать заново)."""
+        if not self.future.done():
+            return False
+        if self.future.cancelled():
+            return True
+        return self.future.exception() is not None
+
+    @property
+    def seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def wait(self, timeout=None):
+        """Ждет завершения не дольше timeout секунд. True — задание завершено."""
+        try:
+            self.future.exception(timeout)
+        except (TimeoutError, CancelledError):
+            pass
+        return self.done
+
+    def result(self):
+        return self.future.result()
+
+
+class JobManager:
+    """Задания процесса по ключам и слоты сессий, которые их ждут."""
+
+    def __init__(self, max_workers=JOB_WORKERS, keep_finished=KEEP_FINISHED):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='klaster-job')
+        self.keep_finished = keep_finished
+        self._jobs = OrderedDict()
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def submit(self, slot, key, func, *args, **kwargs):
+        """Задание с ключом key для слота slot: уже существующее или новое.
+
+        func(job, *args, **kwargs) выполняется в пуле потоков. Задание,
+        завершившееся ошибкой или отмененное, при повторном запросе
+        запускается заново. Прежнее задание слота отменяется, если его не
+        ждут другие слоты.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.failed or (job.cancelled and not job.done):
+                job = Job(key)
+                job.future = self._executor.submit(job.run, func, args, kwargs)
+                self._jobs[key] = job
+            self._jobs.move_to_end(key)
+            previous = self._slots.get(slot)
+            self._slots[slot] = key
+            if previous is not None and previous != key:
+                self._release(previous)
+            self._trim()
+        return job
+
+    def cancel(self, slot):
+        """Освобождает слот; его задание отменяется, если больше никому не нужно."""
+        with self._lock:
+            key = self._slots.pop(slot, None)
+            if key is not None:
+                self._release(key)
+
+    def _release(self, key):
+        job = self._jobs.get(key)
+        if job is not None and not job.done and key not in self._slots.values():
+            job.cancel()
+
+    def _trim(self):
+        finished = [key for key, job in self._jobs.items() if job.done and key not in self._slots.values()]
+        for key in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[key]
+
+    def running(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.done]
+
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+def default_manager():
+    """Пул заданий процесса сервера (общий для всех сессий)."""
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = JobManager()
+        return _default_manager
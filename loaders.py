@@ -0,0 +1,292 @@
+"""Загрузка и очистка данных о продажах.
+
+Разобранный и очищенный Excel-файл кэшируется на диске в формате Parquet
+по хэшу содержимого: повторные запуски Streamlit и новые сессии с тем же
+файлом читают готовую таблицу вместо повторного парсинга openpyxl.
+
+Потоковые загрузчики (stream_csv, stream_excel) читают источник блоками
+фиксированного размера и сразу сворачивают каждый блок в агрегат
+(Magazin, Segment) -> Sum, поэтому пиковая память не зависит от размера файла.
+"""
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype, is_bool_dtype, is_numeric_dtype
+
+from profiling import profiled, stage
+
+REQUIRED_COLS = ['Magazin', 'Segment', 'Sum']
+KEY_COLS = ['Magazin', 'Segment']
+
+DEFAULT_CACHE_DIR = os.environ.get('KLASTER_CACHE_DIR', '.klaster_cache')
+DEFAULT_CACHE_MAX_MB = int(os.environ.get('KLASTER_CACHE_MAX_MB', '2048'))
+STREAM_CHUNK_ROWS = 200_000
+
+
+def content_hash(data):
+    """Хэш содержимого файла — ключ кэша."""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def frame_hash(df):
+    """Хэш содержимого DataFrame (для источников без исходных байтов)."""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return content_hash(row_hashes.tobytes())
+
+
+def check_columns(df):
+    """Проверяет наличие обязательных колонок, иначе ValueError."""
+    missing = [col for col in REQUIRED_COLS if col not in df.columns]
+    if missing:
+        raise ValueError(
+            f"Таблица должна содержать колонки: {REQUIRED_COLS}. "
+            f"Найденные колонки: {', '.join(map(str, df.columns))}"
+        )
+
+
+def _to_numeric_sum(values):
+    """Sum -> float64. Строковая очистка ("1 234,5") — только для нечисловых значений.
+
+    Excel обычно отдает числа, и тогда строки не создаются вовсе; CSV из
+    Google Sheets приходит строками, и нормализация применяется лишь к тем
+    из них, что не разобрались как число напрямую.
+    """
+    if is_numeric_dtype(values) and not is_bool_dtype(values):
+        return values.astype('float64')
+    if infer_dtype(values, skipna=True) == 'string':
+        # Только строки: неудачная попытка to_numeric на каждой строке дороже самой очистки
+        numeric = pd.to_numeric(_normalize_number(values), errors='coerce')
+    else:
+        # Числа вперемешку со строками (Excel): очищаются только неразобранные значения
+        numeric = pd.to_numeric(values, errors='coerce')
+        pending = numeric.isna() & values.notna()
+        if pending.any():
+            numeric = numeric.astype('float64')
+            numeric[pending] = pd.to_numeric(_normalize_number(values[pending]), errors='coerce')
+    return pd.Series(numeric.to_numpy(dtype='float64', na_value=np.nan), index=values.index)
+
+
+def _normalize_number(values):
+    return values.astype(str).str.replace(',', '.').str.replace(' ', '')
+
+
+def _as_category(col):
+    """Ключ -> category со строковыми категориями.
+
+    Готовые категории (например, из CSV с явными типами) не разворачиваются
+    в строки: в str переводятся только уникальные значения.
+    """
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        # Через строковый (Arrow) dtype категории строятся быстрее, чем из object напрямую
+        return col.astype(str).astype('category')
+    col = col.cat.remove_unused_categories()
+    categories = col.cat.categories.astype(str)
+    if not categories.is_unique:
+        # Разные значения с одинаковой записью (например, 1 и "1") сливаются, как раньше
+        return col.astype(str).astype('category')
+    return col.cat.rename_categories(categories)
+
+
+def _drop_invalid(df):
+    """Sum -> число; удаляет строки с пустыми ключами и неположительной суммой."""
+    df = df.assign(Sum=_to_numeric_sum(df['Sum']))
+    # Одна выборка строк вместо dropna + фильтра
+    valid = df[REQUIRED_COLS].notna().all(axis=1) & (df['Sum'] > 0)  # Убираем нулевые и отрицательные суммы
+    return df[valid]
+
+
+@profiled('clean_sales')
+def clean_sales(df):
+    """Приводит Sum к числу, удаляет некорректные строки, ключи -> category.
+
+    Возвращает (очищенный DataFrame, количество удаленных строк).
+    """
+    check_columns(df)
+    initial_rows = len(df)
+    df = _drop_invalid(df)
+
+    # Категории строятся после фильтрации, чтобы не было "пустых" магазинов/сегментов
+    for col in KEY_COLS:
+        df[col] = _as_category(df[col])
+
+    return df.reset_index(drop=True), initial_rows - len(df)
+
+
+class ParquetCache:
+    """Дисковый кэш очищенных таблиц с ограничением размера (LRU).
+
+    Каждая запись — пара файлов `<key>.parquet` и `<key>.json` (метаданные).
+    Время последнего обращения хранится в mtime parquet-файла: при чтении
+    файл "трогается", при превышении лимита удаляются самые старые записи.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 ** 2):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, key):
+        return self.cache_dir / f"{key}.parquet", self.cache_dir / f"{key}.json"
+
+    def get(self, key):
+        """Возвращает (DataFrame, meta) или None, если записи нет."""
+        data_path, meta_path = self._paths(key)
+        if not data_path.exists() or not meta_path.exists():
+            return None
+        try:
+            df = pd.read_parquet(data_path)
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            # Поврежденная запись (например, прерванная запись на диск)
+            self.remove(key)
+            return None
+        now = time.time()
+        os.utime(data_path, (now, now))
+        return df, meta
+
+    def put(self, key, df, meta=None):
+        data_path, meta_path = self._paths(key)
+        tmp_path = data_path.with_suffix('.parquet.tmp')
+        df = df.copy()
+        # Смешанные object-колонки (например, Art из чисел и строк) Parquet не принимает
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].astype('string')
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, data_path)
+        meta_path.write_text(json.dumps(meta or {}, ensure_ascii=False), encoding='utf-8')
+        self.evict()
+
+    def remove(self, key):
+        for path in self._paths(key):
+            path.unlink(missing_ok=True)
+
+    def size(self):
+        return sum(p.stat().st_size for p in self.cache_dir.glob('*.parquet'))
+
+    def evict(self):
+        """Удаляет наименее недавно использованные записи сверх лимита."""
+        entries = sorted(self.cache_dir.glob('*.parquet'), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        # Самую свежую запись не удаляем, даже если она одна больше лимита
+        for path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            self.remove(path.stem)
+
+
+def load_excel_cached(data, cache=None, streaming=False):
+    """Читает Excel из байтов с кэшированием очищенной таблицы по хэшу.
+
+    streaming=True — потоковое чтение .xlsx (stream_excel): в кэш попадает
+    только агрегат (Magazin, Segment) -> Sum.
+
+    Возвращает (DataFrame, meta), где meta содержит `key` (хэш файла),
+    `rows_raw`, `rows_dropped` и `from_cache`.
+    """
+    cache = cache or ParquetCache()
+    key = content_hash(data) + ('-agg' if streaming else '')
+
+    cached = cache.get(key)
+    if cached is not None:
+        df, meta = cached
+        return df, {**meta, 'key': key, 'from_cache': True}
+
+    if streaming:
+        df, meta = stream_excel(BytesIO(data))
+    else:
+        with stage('read_excel'):
+            raw = pd.read_excel(BytesIO(data))
+        df, dropped = clean_sales(raw)
+        meta = {'rows_raw': len(raw), 'rows_dropped': dropped}
+    cache.put(key, df, meta)
+    return df, {**meta, 'key': key, 'from_cache': False}
+
+
+class SalesAccumulator:
+    """Накопительный агрегат keys -> Sum с учетом прочитанных и отброшенных строк."""
+
+    def __init__(self, keys=KEY_COLS):
+        self.keys = list(keys)
+        self.totals = None
+        self.rows_read = 0
+        self.rows_dropped = 0
+        self.started = time.perf_counter()
+
+    def add(self, chunk):
+        check_columns(chunk)
+        self.rows_read += len(chunk)
+        valid = _drop_invalid(chunk[self.keys + ['Sum']])
+        self.rows_dropped += len(chunk) - len(valid)
+        if valid.empty:
+            return
+        for col in self.keys:
+            valid[col] = valid[col].astype(str)
+        part = valid.groupby(self.keys, sort=False)['Sum'].sum()
+        # Размер агрегата ограничен числом пар ключей, а не числом строк
+        self.totals = part if self.totals is None else self.totals.add(part, fill_value=0)
+
+    def result(self):
+        """Возвращает (DataFrame в формате clean_sales, meta со статистикой загрузки)."""
+        if self.totals is None:
+            df = pd.DataFrame({col: pd.Series(dtype='category') for col in self.keys})
+            df['Sum'] = pd.Series(dtype='float64')
+        else:
+            df = self.totals.rename('Sum').reset_index()
+            for col in self.keys:
+                df[col] = df[col].astype('category')
+        elapsed = time.perf_counter() - self.started
+        meta = {
+            'rows_raw': self.rows_read,
+            'rows_dropped': self.rows_dropped,
+            'seconds': elapsed,
+            'rows_per_second': self.rows_read / elapsed if elapsed > 0 else float('inf'),
+        }
+        return df, meta
+
+
+@profiled('stream_csv')
+def stream_csv(source, chunk_rows=STREAM_CHUNK_ROWS, keys=KEY_COLS, **read_kwargs):
+    """Читает CSV (путь, URL или файловый объект) блоками и агрегирует по keys."""
+    usecols = set(keys) | {'Sum'}
+    read_kwargs.setdefault('dtype', str)
+    reader = pd.read_csv(source, chunksize=chunk_rows, usecols=lambda col: col in usecols,
+                         on_bad_lines='skip', **read_kwargs)
+    acc = SalesAccumulator(keys)
+    with reader:
+        for chunk in reader:
+            acc.add(chunk)
+    return acc.result()
+
+
+@profiled('stream_excel')
+def stream_excel(source, chunk_rows=STREAM_CHUNK_ROWS, keys=KEY_COLS):
+    """Читает первый лист .xlsx построчно (openpyxl read-only) и агрегирует по keys."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError("Файл пустой")
+        header = [str(col) if col is not None else '' for col in header]
+
+        acc = SalesAccumulator(keys)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                acc.add(pd.DataFrame(batch, columns=header))
+                batch = []
+        if batch or acc.rows_read == 0:
+            acc.add(pd.DataFrame(batch, columns=header))
+    finally:
+        workbook.close()
+    return acc.result()
@@ -0,0 +1,223 @@
+"""Сохраняемая модель кластеров и назначение новых магазинов.
+
+Модель — это результат итоговой кластеризации (блок 4): статистики
+стандартизации, центры кластеров в стандартизованном пространстве, порядок
+сегментов и метаданные. Новые или изменившиеся магазины относятся к
+ближайшему центру одним векторизованным проходом, номера кластеров при
+этом не меняются. Метрики дрейфа показывают, когда нужна полная
+перекластеризация.
+
+Модель может хранить проекцию на плоскость PC1–PC2 (projection.Projection)
+в пространстве долей сегментов: новые магазины получают координаты в тех же
+осях, что и обучающие, без повторного PCA.
+
+Файл модели — .npz без pickle: массивы и JSON с метаданными.
+"""
+import json
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import pairwise_distances
+from sklearn.preprocessing import StandardScaler
+
+from projection import Projection
+
+MODEL_FORMAT_VERSION = 1
+
+# Пороги, выше которых рекомендуется полная перекластеризация
+DRIFT_THRESHOLDS = {
+    'distance_ratio': 1.5,      # средняя дистанция до центра / такая же на обучении
+    'outlier_share': 0.15,      # доля магазинов дальше 95-го перцентиля обучения
+    'unseen_share': 5.0,        # средняя доля оборота в новых сегментах, %
+    'mean_shift': 0.5,          # макс. сдвиг среднего сегмента, в стандартных отклонениях
+}
+
+
+class ClusterModel:
+    """Центры кластеров и все, что нужно для отнесения к ним новых магазинов."""
+
+    def __init__(self, segments, mean, scale, centroids, metric, meta, labels=None, projection=None):
+        self.segments = pd.Index(segments, name='Segment').astype(str)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.metric = metric
+        self.meta = meta
+        # Кластеры обучающих магазинов (Series магазин -> кластер) — для матрицы миграции
+        self.labels = labels
+        # Проекция долей сегментов (в порядке segments) на PC1–PC2
+        self.projection = projection
+
+    @property
+    def n_clusters(self):
+        return len(self.centroids)
+
+    @classmethod
+    def from_fit(cls, pivot_pct, clusters, metric='euclidean', projection=None, **meta):
+        """Модель по долям сегментов обучающей выборки и меткам кластеров.
+
+        Центр кластера — среднее его магазинов в стандартизованном
+        пространстве (для KMeans совпадает с центром модели, для
+        иерархической кластеризации задает ближайший центр). projection —
+        проекция, обученная на стандартизованных долях (pipeline.project_2d).
+        """
+        scaler = StandardScaler().fit(pivot_pct)
+        X_scaled = scaler.transform(pivot_pct)
+        clusters = np.asarray(clusters)
+        n_clusters = clusters.max() + 1
+        counts = np.bincount(clusters, minlength=n_clusters)
+        centroids = np.zeros((n_clusters, X_scaled.shape[1]))
+        np.add.at(centroids, clusters, X_scaled)
+        centroids /= np.maximum(counts, 1)[:, None]
+
+        model = cls(pivot_pct.columns, scaler.mean_, scaler.scale_, centroids, metric, {},
+                    labels=pd.Series(clusters, index=pivot_pct.index.astype(str), name='Кластер'),
+                    projection=projection.unscaled(scaler.mean_, scaler.scale_) if projection is not None else None)
+        distances = model._distances(X_scaled)[np.arange(len(clusters)), clusters]
+        model.meta = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'n_stores': int(len(clusters)),
+            'cluster_sizes': counts.tolist(),
+            'distance_mean': float(distances.mean()),
+            'distance_p95': float(np.percentile(distances, 95)),
+            **meta,
+        }
+        return model
+
+    def _distances(self, X_scaled):
+        return pairwise_distances(X_scaled, self.centroids,
+                                  metric='cityblock' if self.metric == 'manhattan' else 'euclidean')
+
+    def align(self, pivot_pct):
+        """Доли сегментов в порядке модели и доля оборота в неизвестных модели сегментах.
+
+        Отсутствующие у магазина сегменты — нулевая доля; новые сегменты в
+        признаки не попадают.
+        """
+        columns = pivot_pct.columns.astype(str)
+        values = pivot_pct.set_axis(columns, axis=1)
+        unseen = columns.difference(self.segments)
+        unseen_share = values[unseen].sum(axis=1).to_numpy() if len(unseen) else np.zeros(len(values))
+        return values.reindex(columns=self.segments, fill_value=0).to_numpy(dtype=np.float64), unseen_share, unseen
+
+    def transform(self, pivot_pct):
+        """Стандартизованные признаки магазинов (статистики обучения)."""
+        aligned, _, _ = self.align(pivot_pct)
+        return (aligned - self.mean) / self.scale
+
+    def projection_for(self, segments):
+        """Проекция модели для другого набора сегментов (None, если проекции нет).
+
+        Новым сегментам соответствуют нулевые веса: их доля на координаты
+        не влияет, оси остаются прежними. Сегменты модели, которых нет в
+        segments, считаются нулевой долей (как в align): их вклад в сдвиг
+        переносится на среднее оставшихся сегментов.
+        """
+        if self.projection is None:
+            return None
+        segments = pd.Index(segments).astype(str)
+        components = pd.DataFrame(self.projection.components, columns=self.segments)
+        mean = pd.Series(self.projection.mean, index=self.segments)
+        kept = components.reindex(columns=segments, fill_value=0).to_numpy()
+        new_mean = mean.reindex(segments, fill_value=0).to_numpy()
+        missing = self.segments.difference(segments)
+        if len(missing):
+            offset = components[missing].to_numpy() @ mean[missing].to_numpy()
+            new_mean = new_mean + np.linalg.lstsq(kept, offset, rcond=None)[0]
+        return Projection(new_mean, kept, self.projection.explained_variance_ratio, self.projection.method)
+
+    def assign(self, pivot_pct):
+        """Кластер для каждого магазина pivot_pct (доли сегментов, %).
+
+        Возвращает DataFrame: кластер, расстояние до его центра, доля оборота
+        в новых сегментах, признак "вне модели" (дальше 95-го перцентиля
+        расстояний обучающей выборки) и, если в модели есть проекция,
+        координаты PC1, PC2.
+        """
+        aligned, unseen_share, _ = self.align(pivot_pct)
+        distances = self._distances((aligned - self.mean) / self.scale)
+        labels = distances.argmin(axis=1)
+        nearest = distances[np.arange(len(labels)), labels]
+        assigned = pd.DataFrame({
+            'Магазин': pivot_pct.index.astype(str),
+            'Кластер': labels,
+            'Расстояние': nearest,
+            'Доля_новых_сегментов': unseen_share,
+            'Вне_модели': nearest > self.meta['distance_p95'],
+        })
+        if self.projection is not None:
+            assigned[['PC1', 'PC2']] = self.projection.transform(aligned)
+        return assigned
+
+    def drift(self, pivot_pct, assigned=None):
+        """Метрики дрейфа новых данных относительно обучающей выборки.
+
+        refit_recommended — хотя бы одна метрика выше DRIFT_THRESHOLDS.
+        """
+        if assigned is None:
+            assigned = self.assign(pivot_pct)
+        X_scaled = self.transform(pivot_pct)
+        _, _, unseen = self.align(pivot_pct)
+        sizes = np.bincount(assigned['Кластер'], minlength=self.n_clusters)
+        train_sizes = np.asarray(self.meta['cluster_sizes'])
+        metrics = {
+            'distance_ratio': float(assigned['Расстояние'].mean() / max(self.meta['distance_mean'], 1e-12)),
+            'outlier_share': float(assigned['Вне_модели'].mean()),
+            'unseen_share': float(assigned['Доля_новых_сегментов'].mean()),
+            'mean_shift': float(np.abs(X_scaled.mean(axis=0)).max()) if X_scaled.size else 0.0,
+            # Полусумма модулей разностей долей кластеров (0 — та же структура сети)
+            'cluster_share_shift': float(np.abs(sizes / max(sizes.sum(), 1) -
+                                                train_sizes / train_sizes.sum()).sum() / 2),
+            'unseen_segments': unseen.tolist(),
+        }
+        metrics['refit_recommended'] = any(metrics[name] > limit for name, limit in DRIFT_THRESHOLDS.items())
+        return metrics
+
+    def to_bytes(self):
+        output = BytesIO()
+        arrays = {}
+        if self.labels is not None:
+            arrays = {'stores': np.asarray(self.labels.index, dtype=str),
+                      'labels': self.labels.to_numpy(dtype=np.int64)}
+        if self.projection is not None:
+            arrays.update(pca_mean=self.projection.mean, pca_components=self.projection.components,
+                          pca_explained=self.projection.explained_variance_ratio,
+                          pca_method=np.array(self.projection.method))
+        np.savez_compressed(
+            output,
+            segments=np.asarray(self.segments, dtype=str),
+            mean=self.mean, scale=self.scale, centroids=self.centroids,
+            meta=np.array(json.dumps({**self.meta, 'metric': self.metric}, ensure_ascii=False)),
+            **arrays
+        )
+        return output.getvalue()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, source):
+        """Модель из пути, файлового объекта или байтов."""
+        if isinstance(source, (bytes, bytearray)):
+            source = BytesIO(source)
+        with np.load(source, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            version = meta.get('format_version')
+            if version != MODEL_FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемая версия модели: {version} "
+                                 f"(ожидается {MODEL_FORMAT_VERSION})")
+            metric = meta.pop('metric')
+            labels = None
+            if 'labels' in data:
+                labels = pd.Series(data['labels'], index=pd.Index(data['stores'], name='Magazin'),
+                                   name='Кластер')
+            projection = None
+            if 'pca_components' in data:
+                projection = Projection(data['pca_mean'], data['pca_components'], data['pca_explained'],
+                                        str(data['pca_method']))
+            return cls(data['segments'], data['mean'], data['scale'], data['centroids'], metric, meta,
+                       labels=labels, projection=projection)
@@ -0,0 +1,79 @@
+"""Индекс ближайших соседей для поиска похожих магазинов.
+
+Строится один раз на прогон кластеризации: профили нормируются по L2,
+после чего косинусная схожесть — это скалярное произведение, а топ-k
+выбирается через argpartition без полной сортировки.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+from profiling import profiled
+
+BLOCK_ROWS = 1024
+
+
+class NeighborIndex:
+    """Косинусный поиск похожих магазинов по матрице профилей (плотной или CSR)."""
+
+    def __init__(self, features, stores, clusters):
+        if sp.issparse(features):
+            self.matrix = normalize(sp.csr_matrix(features, dtype=np.float32))
+        else:
+            self.matrix = normalize(np.asarray(features, dtype=np.float32))
+        self.stores = pd.Index(stores)
+        self.clusters = np.asarray(clusters)
+
+    def _similarities(self, rows):
+        sims = self.matrix[rows] @ self.matrix.T
+        return sims.toarray() if sp.issparse(sims) else np.asarray(sims)
+
+    def _mask(self, sims, rows, same_cluster):
+        # Сам магазин (и, при same_cluster, магазины других кластеров) не участвуют в топе
+        sims[np.arange(len(rows)), rows] = -np.inf
+        if same_cluster:
+            sims[self.clusters[rows][:, None] != self.clusters[None, :]] = -np.inf
+        return sims
+
+    @staticmethod
+    def _top(sims, top_n):
+        top_n = min(top_n, sims.shape[1] - 1)
+        part = np.argpartition(-sims, top_n - 1, axis=1)[:, :top_n]
+        order = np.argsort(-np.take_along_axis(sims, part, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(part, order, axis=1)
+
+    def query(self, store, top_n=5, same_cluster=False):
+        """Топ-N похожих на store: DataFrame (Магазин, Схожесть, Кластер)."""
+        row = np.array([self.stores.get_loc(store)])
+        sims = self._mask(self._similarities(row), row, same_cluster)
+        top = self._top(sims, top_n)[0]
+        top = top[np.isfinite(sims[0, top])]
+        return pd.DataFrame({
+            'Магазин': self.stores[top],
+            'Схожесть': sims[0, top],
+            'Кластер': self.clusters[top],
+        })
+
+    @profiled('neighbors_batch')
+    def batch(self, top_n=5, same_cluster=False, block_rows=BLOCK_ROWS):
+        """Топ-N соседей для каждого магазина (длинная таблица для подбора A/B-пар)."""
+        n = len(self.stores)
+        parts = []
+        for start in range(0, n, block_rows):
+            rows = np.arange(start, min(start + block_rows, n))
+            sims = self._mask(self._similarities(rows), rows, same_cluster)
+            top = self._top(sims, top_n)
+            top_sims = np.take_along_axis(sims, top, axis=1)
+            valid = np.isfinite(top_sims)
+            source = np.repeat(rows, top.shape[1]).reshape(top.shape)
+            rank = np.broadcast_to(np.arange(1, top.shape[1] + 1), top.shape)
+            parts.append(pd.DataFrame({
+                'Магазин': self.stores[source[valid]],
+                'Кластер': self.clusters[source[valid]],
+                'Ранг': rank[valid],
+                'Похожий магазин': self.stores[top[valid]],
+                'Кластер похожего': self.clusters[top[valid]],
+                'Схожесть': top_sims[valid],
+            }))
+        return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,72 @@
+"""Пул процессов и общая память для тяжелых численных задач.
+
+Матрица признаков публикуется один раз в multiprocessing.shared_memory,
+а в задачи передается только ее описание (имя блока, форма, тип) —
+без сериализации данных в каждую задачу.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Ниже этого числа строк накладные расходы на запуск процессов больше выигрыша
+MIN_PARALLEL_ROWS = 500
+
+
+def default_n_jobs():
+    return os.cpu_count() or 1
+
+
+def effective_n_jobs(n_jobs, n_tasks, n_rows):
+    """Сколько процессов реально запускать (1 = последовательно)."""
+    if n_jobs is None or n_jobs <= 0:
+        n_jobs = default_n_jobs()
+    if n_rows < MIN_PARALLEL_ROWS:
+        return 1
+    return max(1, min(n_jobs, n_tasks))
+
+
+@contextmanager
+def shared_array(X):
+    """Копирует X в общую память; отдает spec для attach_array()."""
+    X = np.ascontiguousarray(X)
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    try:
+        view = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+        view[...] = X
+        yield {'name': shm.name, 'shape': X.shape, 'dtype': X.dtype.str}
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# Блоки общей памяти, открытые в процессе-воркере (живут до его завершения)
+_attached = {}
+
+
+def attach_array(spec):
+    """Представление общей матрицы в воркере (только для чтения)."""
+    name = spec['name']
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    X = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=_attached[name].buf)
+    X.flags.writeable = False
+    return X
+
+
+def _init_worker():
+    # Один поток BLAS/OpenMP на процесс, иначе воркеры конкурируют за ядра
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+
+
+def process_pool(n_jobs):
+    """Пул процессов. spawn безопасен при запуске из многопоточного Streamlit."""
+    return ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+    )
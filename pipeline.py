@@ -0,0 +1,469 @@
+"""Этапы расчета: pivot -> scale -> sweep -> fit -> PCA -> profiles -> export.
+
+Поиск похожих магазинов — отдельный индекс (neighbors.NeighborIndex).
+
+Каждый этап — чистая функция от результатов предыдущих этапов и своих
+параметров. Мемоизация выполняется в app.py (st.cache_data) по хэшу данных
+и параметрам, которые этап действительно читает, поэтому изменение виджета
+пересчитывает только зависимые от него этапы.
+"""
+import time
+from concurrent.futures import as_completed
+from contextlib import ExitStack
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score
+from sklearn.preprocessing import StandardScaler
+
+from distances import silhouette
+from features import SVD_COMPONENTS, reduce_svd, row_shares, sparse_matrix
+from hierarchy import cut_tree, linkage_tree, within_cluster_sse
+from parallel import attach_array, effective_n_jobs, process_pool, shared_array
+from profiling import profiled
+from projection import fit_projection, from_svd
+
+
+@profiled('pivot')
+def build_pivot(df, dtype=np.float64):
+    """Матрица магазин × сегмент: обороты и доли сегментов (%).
+
+    dtype=np.float32 вдвое уменьшает доли и все производные матрицы
+    (X_scaled, центры KMeans); обороты остаются в float64.
+    """
+    # Sum накапливается по кодам категорий сразу в CSR; плотной становится только итоговая матрица
+    matrix, stores, segments = sparse_matrix(df, 'Segment')
+    pivot_table = pd.DataFrame(matrix.toarray(), index=stores, columns=segments)
+
+    # Вычисляем доли сегментов для каждого магазина
+    pivot_pct = (pivot_table.div(pivot_table.sum(axis=1), axis=0) * 100).astype(dtype)
+    return pivot_table, pivot_pct
+
+
+@profiled('sparse_features')
+def build_sparse_features(df, feature_col, store_index, n_components=SVD_COMPONENTS, random_state=42):
+    """Разреженные доли по feature_col (например, Art) и их SVD-представление.
+
+    Строки выравниваются по store_index (индекс pivot_pct). Возвращает
+    (доли CSR, embedding для кластеризации и PCA, сводка для интерфейса).
+    Доли не центрируются и не стандартизуются — это уплотнило бы матрицу;
+    масштаб задают компоненты SVD.
+    """
+    matrix, stores, features = sparse_matrix(df, feature_col)
+    shares = row_shares(matrix)[stores.get_indexer(store_index)]
+    embedding, explained = reduce_svd(shares, n_components, random_state)
+    info = {
+        'n_features': len(features),
+        'density': shares.nnz / max(shares.shape[0] * shares.shape[1], 1),
+        'n_components': embedding.shape[1],
+        'explained_variance': explained,
+    }
+    return shares, embedding, info
+
+
+@profiled('scale')
+def scale_features(pivot_pct):
+    """Стандартизация долей (используется во всех последующих этапах); тип float сохраняется."""
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(pivot_pct)
+    return X_scaled, scaler
+
+
+SWEEP_METRICS = ['silhouette', 'davies_bouldin', 'calinski_harabasz', 'inertia']
+SWEEP_MODES = ['exhaustive', 'adaptive', 'warm', 'hierarchical']
+
+# Число перезапусков для warm-режима: старт и разбиение кластера дешевле полного k-means++
+WARM_N_INIT = 3
+# Адаптивный перебор: точек грубой сетки k и прирост лучшего силуэта за раунд
+# уточнения, ниже которого (при неизменных пиках и локте) поиск останавливается
+ADAPTIVE_COARSE_POINTS = 8
+ADAPTIVE_TOL = 0.005
+ADAPTIVE_PATIENCE = 2
+# Верхняя граница k в интерфейсе (полный перебор до нее слишком дорог)
+MAX_K_ADAPTIVE = 100
+
+
+def _score_labels(X_scaled, labels, inertia, D=None, silhouette_sample=None):
+    return {
+        'silhouette': silhouette(X_scaled, labels, D, silhouette_sample)[0],
+        'davies_bouldin': davies_bouldin_score(X_scaled, labels),
+        'calinski_harabasz': calinski_harabasz_score(X_scaled, labels),
+        'inertia': inertia,
+    }
+
+
+@profiled('evaluate_k')
+def evaluate_k(X_scaled, k, init_method, random_state=42, D=None, silhouette_sample=None):
+    """KMeans для одного k и его метрики качества.
+
+    D — готовая евклидова матрица расстояний для силуэта; без нее при
+    заданном silhouette_sample силуэт оценивается по выборке.
+    """
+    kmeans_temp = KMeans(n_clusters=k, random_state=random_state, init=init_method, n_init=10)
+    labels_temp = kmeans_temp.fit_predict(X_scaled)
+    return _score_labels(X_scaled, labels_temp, kmeans_temp.inertia_, D, silhouette_sample)
+
+
+def _split_worst_cluster(X_scaled, kmeans, init_method, random_state):
+    """Центры для k+1: кластер с наибольшей SSE делится надвое (как в bisecting k-means)."""
+    labels, centers = kmeans.labels_, kmeans.cluster_centers_
+    sse = np.bincount(labels, weights=((X_scaled - centers[labels]) ** 2).sum(axis=1),
+                      minlength=len(centers))
+    # Кластер из одной точки разделить нельзя
+    sse[np.bincount(labels, minlength=len(centers)) < 2] = -1
+    worst = int(np.argmax(sse))
+
+    halves = KMeans(n_clusters=2, random_state=random_state, init=init_method,
+                    n_init=WARM_N_INIT).fit(X_scaled[labels == worst])
+    return np.vstack([np.delete(centers, worst, axis=0), halves.cluster_centers_])
+
+
+def _warm_sweep(X_scaled, k_range, init_method, progress, random_state, D, silhouette_sample):
+    """Инкрементальный перебор: решение для k+1 стартует из сошедшегося решения для k."""
+    by_k = {}
+    kmeans = None
+    for k in k_range:
+        if kmeans is None:
+            kmeans = KMeans(n_clusters=k, random_state=random_state, init=init_method,
+                            n_init=WARM_N_INIT).fit(X_scaled)
+        else:
+            init = _split_worst_cluster(X_scaled, kmeans, init_method, random_state)
+            kmeans = KMeans(n_clusters=k, random_state=random_state, init=init, n_init=1).fit(X_scaled)
+        by_k[k] = _score_labels(X_scaled, kmeans.labels_, kmeans.inertia_, D, silhouette_sample)
+        if progress is not None:
+            progress(len(by_k), k, by_k[k])
+    return by_k
+
+
+def _evaluate_k_shared(spec, d_spec, k, init_method, random_state, silhouette_sample):
+    # Выполняется в воркере: матрицы берутся из общей памяти, а не из pickle
+    D = attach_array(d_spec) if d_spec is not None else None
+    return k, evaluate_k(attach_array(spec), k, init_method, random_state, D, silhouette_sample)
+
+
+def _hierarchical_sweep(X_scaled, k_range, Z, progress, D, silhouette_sample):
+    """Метки для каждого k — разрезы одного дерева; inertia — внутрикластерная SSE."""
+    by_k = {}
+    for k in k_range:
+        labels = cut_tree(Z, k)
+        by_k[k] = _score_labels(X_scaled, labels, within_cluster_sse(X_scaled, labels), D, silhouette_sample)
+        if progress is not None:
+            progress(len(by_k), k, by_k[k])
+    return by_k
+
+
+def geometric_k_grid(min_k, max_k, n_points=ADAPTIVE_COARSE_POINTS):
+    """Грубая сетка k: геометрическая прогрессия от min_k до max_k (концы включены)."""
+    grid = np.unique(np.round(np.geomspace(min_k, max_k, n_points)).astype(int))
+    return [int(k) for k in grid]
+
+
+def elbow_k(ks, inertias):
+    """Локоть: k перед наибольшим падением inertia на единицу k (сетка может быть неравномерной).
+
+    На сетке из одной-двух точек — последняя из первых двух посчитанных k.
+    """
+    ks = list(ks)
+    if len(inertias) <= 2:
+        return ks[min(1, len(ks) - 1)]
+    slopes = np.abs(np.diff(inertias) / np.diff(ks))
+    return ks[int(np.argmax(slopes))]
+
+
+def _adaptive_targets(by_k):
+    """k, вокруг которых уточняется поиск: пики силуэта и Calinski-Harabasz, локоть."""
+    ks = sorted(by_k)
+    metric = {name: [by_k[k][name] for k in ks] for name in ('silhouette', 'calinski_harabasz', 'inertia')}
+    return {ks[int(np.argmax(metric['silhouette']))], ks[int(np.argmax(metric['calinski_harabasz']))],
+            elbow_k(ks, metric['inertia'])}
+
+
+def _refinement(by_k, targets):
+    """Середины интервалов между каждым k из targets и его соседями по уже посчитанным k."""
+    ks = sorted(by_k)
+    candidates = set()
+    for k in targets:
+        if k not in by_k:
+            continue
+        i = ks.index(k)
+        for neighbour in ks[max(i - 1, 0):i] + ks[i + 1:i + 2]:
+            if abs(neighbour - k) > 1:
+                candidates.add((k + neighbour) // 2)
+    return sorted(candidates - set(by_k))
+
+
+class _KEvaluator:
+    """evaluate_k для наборов k: из k_cache или расчетом (в пуле процессов при n_workers > 1).
+
+    Пул и общая память создаются при первом расчете и живут до закрытия
+    stack — между раундами адаптивного перебора они не пересоздаются.
+    """
+
+    def __init__(self, stack, X_scaled, init_method, random_state, D, silhouette_sample, n_workers,
+                 k_cache=None, progress=None):
+        self.stack = stack
+        self.X_scaled = X_scaled
+        self.args = (init_method, random_state)
+        self.D = D
+        self.silhouette_sample = silhouette_sample
+        self.n_workers = n_workers
+        self.k_cache = k_cache
+        self.progress = progress
+        self.by_k = {}
+        self._pool = None
+
+    def _done(self, k, metrics):
+        self.by_k[k] = metrics
+        if self.k_cache is not None:
+            self.k_cache[k] = metrics
+        if self.progress is not None:
+            self.progress(len(self.by_k), k, metrics)
+
+    def __call__(self, ks):
+        todo = []
+        for k in ks:
+            if k in self.by_k:
+                continue
+            if self.k_cache is not None and k in self.k_cache:
+                self._done(k, self.k_cache[k])
+            else:
+                todo.append(k)
+        if self.n_workers == 1:
+            for k in todo:
+                self._done(k, evaluate_k(self.X_scaled, k, *self.args, self.D, self.silhouette_sample))
+            return
+        if self._pool is None and todo:
+            self._spec = self.stack.enter_context(shared_array(self.X_scaled))
+            self._d_spec = self.stack.enter_context(shared_array(self.D)) if self.D is not None else None
+            self._pool = self.stack.enter_context(process_pool(self.n_workers))
+        futures = [self._pool.submit(_evaluate_k_shared, self._spec, self._d_spec, k, *self.args,
+                                     self.silhouette_sample)
+                   for k in todo]
+        try:
+            for future in as_completed(futures):
+                self._done(*future.result())
+        except BaseException:
+            # Исключение из progress (например, отмена фонового задания):
+            # не дожидаемся k, которые еще не начали считаться
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _adaptive_sweep(evaluate, min_k, max_k, tol):
+    """Грубая геометрическая сетка, затем деление интервалов вокруг пиков и локтя.
+
+    Поиск останавливается, когда уточнять больше нечего (соседние k уже
+    посчитаны) или когда ADAPTIVE_PATIENCE раундов подряд не сдвинули ни
+    одну целевую точку и подняли лучший силуэт меньше чем на tol.
+    """
+    grid = geometric_k_grid(min_k, max_k)
+    evaluate(grid)
+    if len(grid) == 1:
+        # min_k == max_k: уточнять нечего
+        return evaluate.by_k
+    targets = _adaptive_targets(evaluate.by_k)
+    best = max(metrics['silhouette'] for metrics in evaluate.by_k.values())
+    stalled = 0
+    while stalled < ADAPTIVE_PATIENCE:
+        candidates = _refinement(evaluate.by_k, targets)
+        if not candidates:
+            break
+        evaluate(candidates)
+        new_targets = _adaptive_targets(evaluate.by_k)
+        new_best = max(metrics['silhouette'] for metrics in evaluate.by_k.values())
+        stalled = stalled + 1 if new_targets == targets and new_best - best < tol else 0
+        targets, best = new_targets, new_best
+    return evaluate.by_k
+
+
+@profiled('sweep_k')
+def sweep_k(X_scaled, k_range, init_method, progress=None, n_jobs=1, random_state=42,
+            D=None, silhouette_sample=None, mode='exhaustive', tree=None, k_cache=None, tol=ADAPTIVE_TOL):
+    """Метрики качества KMeans для k из диапазона.
+
+    mode='exhaustive' — независимый KMeans (n_init=10) для каждого k;
+    mode='adaptive' — те же KMeans, но только для части k: грубая
+    геометрическая сетка и уточнение вокруг пиков силуэта и
+    Calinski-Harabasz и локтя с ранней остановкой (см. _adaptive_sweep);
+    mode='warm' — последовательное разбиение кластера с наибольшей SSE и
+    дообучение с этих центров (WARM_N_INIT перезапусков только на старте и
+    при разбиении); mode='hierarchical' — разрезы готового дерева tree
+    (linkage matrix). В результате 'k' — посчитанные k по возрастанию (для
+    adaptive — не весь диапазон); время расчета — в ключе 'elapsed'.
+
+    При n_jobs != 1 полный и адаптивный переборы распределяют k по пулу
+    процессов. Каждое k считается целиком в одном воркере с тем же
+    random_state, поэтому результат совпадает с последовательным расчетом.
+    k_cache — изменяемый словарь k -> метрики этих двух режимов (для тех
+    же данных, init_method и silhouette_sample): посчитанные k берутся из
+    него, новые в него записываются. progress(done, k, metrics) вызывается
+    по мере готовности очередного k; исключение из него прерывает перебор.
+    D и silhouette_sample — см. evaluate_k().
+    """
+    k_range = list(k_range)
+    started = time.perf_counter()
+
+    if mode == 'hierarchical':
+        by_k = _hierarchical_sweep(X_scaled, k_range, tree, progress, D, silhouette_sample)
+    elif mode == 'warm':
+        by_k = _warm_sweep(X_scaled, k_range, init_method, progress, random_state, D, silhouette_sample)
+    else:
+        n_workers = effective_n_jobs(n_jobs, len(k_range), len(X_scaled))
+        with ExitStack() as stack:
+            evaluate = _KEvaluator(stack, X_scaled, init_method, random_state, D, silhouette_sample,
+                                   n_workers, k_cache, progress)
+            if mode == 'adaptive':
+                by_k = _adaptive_sweep(evaluate, k_range[0], k_range[-1], tol)
+            else:
+                evaluate(k_range)
+                by_k = evaluate.by_k
+
+    ks = sorted(by_k)
+    result = {'k': ks, 'mode': mode, 'elapsed': time.perf_counter() - started}
+    for name in SWEEP_METRICS:
+        result[name] = [by_k[k][name] for k in ks]
+    return result
+
+
+ENGINES = ['kmeans', 'minibatch']
+MINIBATCH_EPOCHS = 10
+
+
+def chunk_bounds(n_rows, chunk_rows, min_rows=1):
+    """Границы блоков строк; последний блок короче min_rows присоединяется к предыдущему."""
+    starts = list(range(0, n_rows, chunk_rows))
+    if len(starts) > 1 and n_rows - starts[-1] < min_rows:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n_rows]))
+
+
+def iter_chunks(X, chunk_rows, order=None, min_rows=1):
+    """Блоки строк матрицы (X может быть np.memmap — читается по частям)."""
+    bounds = chunk_bounds(len(X), chunk_rows, min_rows)
+    if order is not None:
+        bounds = [bounds[i] for i in order]
+    for start, stop in bounds:
+        yield X[start:stop]
+
+
+def fit_minibatch(X_scaled, n_clusters, random_state=42, init_method='k-means++',
+                  batch_size=1024, n_epochs=MINIBATCH_EPOCHS):
+    """MiniBatchKMeans по блокам строк через partial_fit (без загрузки всей матрицы в модель).
+
+    Порядок блоков перемешивается на каждой эпохе. Возвращает (метки, inertia).
+    """
+    # Первый блок инициализирует центры, поэтому в нем должно быть не меньше n_clusters строк;
+    # блоки перемешиваются, и короткий хвост присоединяется к предыдущему блоку
+    batch_size = max(batch_size, n_clusters)
+    n_chunks = len(chunk_bounds(len(X_scaled), batch_size, n_clusters))
+    rng = np.random.default_rng(random_state)
+
+    model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state,
+                            init=init_method, batch_size=batch_size, n_init=3)
+    for _ in range(n_epochs):
+        for chunk in iter_chunks(X_scaled, batch_size, rng.permutation(n_chunks), min_rows=n_clusters):
+            model.partial_fit(chunk)
+
+    labels, inertia = [], 0.0
+    for chunk in iter_chunks(X_scaled, batch_size):
+        labels.append(model.predict(chunk))
+        inertia -= model.score(chunk)
+    return np.concatenate(labels), inertia
+
+
+@profiled('fit_clusters')
+def fit_clusters(X_scaled, n_clusters, distance_metric, random_state=42,
+                 init_method='k-means++', max_iter=300, tree=None,
+                 engine='kmeans', batch_size=1024):
+    """Итоговая кластеризация. Возвращает (метки, inertia или None).
+
+    Для евклидова расстояния engine выбирает KMeans или MiniBatchKMeans
+    (блоками по batch_size строк). Для манхэттенского — иерархическая
+    кластеризация (average linkage): разрез дерева tree, которое иначе
+    строится здесь же.
+    """
+    if distance_metric == 'euclidean' and engine == 'minibatch':
+        return fit_minibatch(X_scaled, n_clusters, random_state, init_method, batch_size)
+
+    if distance_metric == 'euclidean':
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state,
+                        init=init_method, n_init=10, max_iter=max_iter)
+        clusters = kmeans.fit_predict(X_scaled)
+        return clusters, kmeans.inertia_
+
+    # Для Manhattan используем иерархическую кластеризацию
+    if tree is None:
+        tree = linkage_tree(X_scaled, 'average', 'manhattan')
+    return cut_tree(tree, n_clusters), None
+
+
+@profiled('quality_metrics')
+def quality_metrics(X_scaled, clusters, D=None, silhouette_sample=None):
+    """Silhouette, Davies-Bouldin и Calinski-Harabasz для разбиения.
+
+    silhouette_ci — полуширина 95% ДИ силуэта (0 при точном расчете).
+    """
+    score, ci = silhouette(X_scaled, clusters, D, silhouette_sample)
+    return {
+        'silhouette': score,
+        'silhouette_ci': ci,
+        'davies_bouldin': davies_bouldin_score(X_scaled, clusters),
+        'calinski_harabasz': calinski_harabasz_score(X_scaled, clusters),
+    }
+
+
+@profiled('pca')
+def project_2d(X_scaled, method='auto', svd_explained=None):
+    """PCA в 2D для визуализации. Возвращает (projection.Projection, координаты).
+
+    svd_explained задан — X_scaled это embedding TruncatedSVD
+    (build_sparse_features), и проекция строится по нему.
+    """
+    if svd_explained is not None:
+        fitted = from_svd(X_scaled, svd_explained)
+    else:
+        fitted = fit_projection(X_scaled, method)
+    return fitted, fitted.transform(X_scaled)
+
+
+@profiled('cluster_profiles')
+def cluster_profiles(pivot_pct, clusters):
+    """Средние доли сегментов по кластерам."""
+    return pivot_pct.groupby(clusters).mean().rename_axis('Кластер')
+
+
+@profiled('excel_report')
+def build_excel_report(result_df, profiles, metrics, forecast=None):
+    """Excel-отчет с листами кластеров, профилей и метрик.
+
+    forecast — таблица прогноза оборота (forecast.forecast_sheet); если
+    передана, добавляется лист "Прогноз".
+    """
+    silhouette, davies_bouldin, calinski_harabasz = metrics
+
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        result_df.to_excel(writer, sheet_name='Кластеры', index=False)
+
+        # Профили кластеров
+        profiles.to_excel(writer, sheet_name='Профили_кластеров')
+
+        # Метрики
+        metrics_summary = pd.DataFrame({
+            'Метрика': ['Silhouette Score', 'Davies-Bouldin Index', 'Calinski-Harabasz Score'],
+            'Значение': [silhouette, davies_bouldin, calinski_harabasz],
+            'Интерпретация': [
+                '>0.5: хорошо, >0.7: отлично',
+                '<1.0: отлично',
+                'Чем больше, тем лучше'
+            ]
+        })
+        metrics_summary.to_excel(writer, sheet_name='Метрики', index=False)
+
+        if forecast is not None:
+            forecast.to_excel(writer, sheet_name='Прогноз', index=False)
+
+    return output.getvalue()
@@ -0,0 +1,287 @@
+"""Замеры ресурсов процесса для диагностики.
+
+measure() — замер одного блока кода (бенчмарк, разовые замеры). Profiler —
+замеры одного прогона приложения: нумерованные блоки, вложенные в них этапы
+(функции, отмеченные @profiled) и попадания в кэш этапов
+(@profiled_cache). Активный профайлер хранится в потоке: каждая сессия
+Streamlit выполняется в своем потоке, а без активного профайлера
+декораторы ничего не замеряют. Результаты прогона можно дописывать
+строками JSON в лог (KLASTER_PROFILE_LOG) для анализа по всем пользователям.
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Файл JSON lines для замеров прогонов приложения (не задан — лог не пишется)
+PROFILE_LOG = os.environ.get('KLASTER_PROFILE_LOG')
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+# tracemalloc включается на весь процесс: замеры разных сессий (потоков)
+# включают его по счетчику, выключает последний из них
+_trace_lock = threading.Lock()
+_trace_users = 0
+_trace_started = False
+
+
+def peak_rss_mb():
+    """Пиковый объем резидентной памяти процесса, МБ (None, если недоступно)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _start_tracing():
+    global _trace_users, _trace_started
+    with _trace_lock:
+        if _trace_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _trace_started = True
+        _trace_users += 1
+
+
+def _stop_tracing():
+    global _trace_users, _trace_started
+    with _trace_lock:
+        _trace_users -= 1
+        # Трассировку, включенную не нами (python -X tracemalloc), не трогаем
+        if _trace_users == 0 and _trace_started:
+            tracemalloc.stop()
+            _trace_started = False
+
+
+def _peak_stack():
+    if not hasattr(_local, 'peaks'):
+        _local.peaks = []
+    return _local.peaks
+
+
+@contextmanager
+def measure(trace_memory=False):
+    """Замер блока кода; отдает dict, который заполняется при выходе из блока.
+
+    seconds — время по часам, cpu_seconds — процессорное время этого процесса
+    (без дочерних процессов пула), peak_rss_mb — пиковая память процесса после
+    блока, rss_growth_mb — на сколько блок поднял этот пик. trace_memory=True
+    добавляет peak_alloc_mb — пик выделений внутри блока по tracemalloc
+    (точнее, но заметно замедляет код на чистом Python). Пик tracemalloc
+    общий для процесса: при одновременных замерах в нескольких потоках
+    peak_alloc_mb включает и их выделения.
+    """
+    stats = {}
+    if trace_memory:
+        _start_tracing()
+        # Вложенный замер сбрасывает пик tracemalloc, поэтому пик внешнего
+        # замера до этого момента сохраняется в стеке
+        peaks = _peak_stack()
+        traced_before, traced_peak = tracemalloc.get_traced_memory()
+        if peaks:
+            peaks[-1] = max(peaks[-1], traced_peak)
+        tracemalloc.reset_peak()
+        peaks.append(traced_before)
+    rss_before = peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield stats
+    finally:
+        stats['seconds'] = time.perf_counter() - wall
+        stats['cpu_seconds'] = time.process_time() - cpu
+        if trace_memory:
+            peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+            stats['peak_alloc_mb'] = (peak - traced_before) / 1024 ** 2
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+            _stop_tracing()
+        stats['peak_rss_mb'] = peak_rss_mb()
+        if rss_before is not None and stats['peak_rss_mb'] is not None:
+            stats['rss_growth_mb'] = stats['peak_rss_mb'] - rss_before
+
+
+class Profiler:
+    """Замеры одного прогона: блоки, вложенные этапы и попадания в кэш.
+
+    Повторные вызовы этапа с тем же путем (блок / этап / ...) суммируются в
+    одну запись: calls, seconds, cpu_seconds; память — максимум по вызовам.
+    """
+
+    def __init__(self, trace_memory=False, **context):
+        self.trace_memory = trace_memory
+        self.context = context
+        self.records = {}
+        self._stack = []
+        self._block = None
+        self._started = time.perf_counter()
+        self.total_seconds = None
+
+    @contextmanager
+    def stage(self, name, cached=False):
+        """Этап внутри текущего открытого этапа (или блока).
+
+        cached=True — вызов функции под кэшем Streamlit: если за время этапа
+        не был вызван mark_miss(), он считается попаданием в кэш.
+        """
+        path = (*self._stack[-1]['path'], name) if self._stack else (name,)
+        frame = {'path': path, 'miss': False}
+        self._stack.append(frame)
+        try:
+            with measure(self.trace_memory) as stats:
+                yield stats
+        finally:
+            self._stack.pop()
+            hits, misses = (0, 1) if frame['miss'] else (1, 0)
+            self._add(path, {**stats, 'calls': 1, 'hits': hits if cached else 0, 'misses': misses if cached else 0})
+
+    def _add(self, path, stats):
+        """Суммирует замер в запись этапа path (память — максимум)."""
+        record = self.records.get(path)
+        if record is None:
+            record = self.records[path] = {'path': path, 'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                           'hits': 0, 'misses': 0}
+        for key in ('calls', 'seconds', 'cpu_seconds', 'hits', 'misses'):
+            record[key] += stats[key]
+        for key in ('rss_growth_mb', 'peak_alloc_mb'):
+            if key in stats:
+                record[key] = max(record.get(key, 0.0), stats[key])
+
+    def merge(self, other, name):
+        """Замеры другого прогона (фонового задания) как этап name внутри текущего.
+
+        other должен быть закрыт finish(); его этапы становятся дочерними
+        для name, время name — общее время other.
+        """
+        prefix = (*self._stack[-1]['path'], name) if self._stack else (name,)
+        top = [record for record in other.records.values() if len(record['path']) == 1]
+        self._add(prefix, {'calls': 1, 'seconds': other.total_seconds, 'hits': 0, 'misses': 0,
+                           'cpu_seconds': sum(record['cpu_seconds'] for record in top)})
+        for record in other.records.values():
+            self._add((*prefix, *record['path']), record)
+
+    def mark_miss(self):
+        """Текущий кэшируемый этап действительно вычислялся (промах кэша)."""
+        if self._stack:
+            self._stack[-1]['miss'] = True
+
+    def block(self, name):
+        """Закрывает предыдущий блок и открывает новый верхнего уровня.
+
+        Нумерованные блоки app.py идут подряд на верхнем уровне скрипта,
+        поэтому вместо with-блока достаточно отметки начала следующего.
+        """
+        self.end_block()
+        self._block = self.stage(name)
+        self._block.__enter__()
+
+    def end_block(self):
+        if self._block is not None:
+            block, self._block = self._block, None
+            block.__exit__(None, None, None)
+
+    def finish(self, log_path=PROFILE_LOG):
+        """Закрывает последний блок и (если задан log_path) пишет записи в лог.
+
+        Повторный вызов ничего не делает.
+        """
+        if self.total_seconds is not None:
+            return
+        self.end_block()
+        self.total_seconds = time.perf_counter() - self._started
+        if log_path:
+            self.write_log(log_path)
+
+    def rows(self):
+        """Записи в порядке первого входа в этап: name, depth и метрики."""
+        # Этап записывается при выходе, поэтому родитель оказывается после детей;
+        # сортировка по пути с учетом порядка первых появлений восстанавливает дерево
+        order = {}
+        for path in self.records:
+            for depth in range(1, len(path) + 1):
+                order.setdefault(path[:depth], len(order))
+        ranked = sorted(self.records, key=lambda path: [order[path[:depth]] for depth in range(1, len(path) + 1)])
+        return [{'name': path[-1], 'depth': len(path) - 1, **self.records[path]} for path in ranked]
+
+    def write_log(self, path):
+        """Дописывает по строке JSON на этап (общие поля — время прогона и context)."""
+        common = {'ts': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                  'total_seconds': self.total_seconds, **self.context}
+        lines = [json.dumps({**common, **record, 'path': list(record['path']), 'stage': ' / '.join(record['path'])},
+                            ensure_ascii=False, default=str)
+                 for record in self.records.values()]
+        with _log_lock, open(path, 'a', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+
+def activate(profiler):
+    """Делает profiler активным в текущем потоке (None — отключить замеры)."""
+    _local.profiler = profiler
+    _local.peaks = []
+
+
+def current():
+    return getattr(_local, 'profiler', None)
+
+
+@contextmanager
+def stage(name):
+    """Этап активного профайлера; без профайлера — пустой контекст."""
+    profiler = current()
+    if profiler is None:
+        yield None
+        return
+    with profiler.stage(name) as stats:
+        yield stats
+
+
+def profiled(name):
+    """Декоратор: каждый вызов функции — этап активного профайлера."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = current()
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def profiled_cache(cache_decorator, name=None):
+    """Кэшируемая функция с замером вызова и учетом попаданий в кэш.
+
+    cache_decorator — например, st.cache_data(max_entries=8); name — имя
+    этапа (по умолчанию имя функции). Тело функции выполняется только при
+    промахе кэша и отмечает это в профайлере; ключ кэша Streamlit строится
+    по исходной функции (functools.wraps).
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def compute(*args, **kwargs):
+            profiler = current()
+            if profiler is not None:
+                profiler.mark_miss()
+            return func(*args, **kwargs)
+
+        cached_func = cache_decorator(compute)
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            profiler = current()
+            if profiler is None:
+                return cached_func(*args, **kwargs)
+            with profiler.stage(name or func.__name__, cached=True):
+                return cached_func(*args, **kwargs)
+
+        call.clear = cached_func.clear
+        return call
+    return decorate
@@ -0,0 +1,107 @@
+"""Проекция магазинов на плоскость двух главных компонент.
+
+Для графика нужны только две компоненты, поэтому полное разложение
+не выполняется:
+
+- небольшая матрица — точный PCA (полное SVD);
+- большая — рандомизированный SVD (Halko и др.): несколько проходов
+  по матрице вместо разложения целиком;
+- np.memmap — IncrementalPCA по блокам строк, матрица в память не
+  загружается;
+- если признаки уже сжаты TruncatedSVD (режим по артикулам), PCA
+  строится по готовому embedding, а доли дисперсии пересчитываются
+  относительно исходных долей.
+
+Обученная проекция — это среднее, две компоненты и доли дисперсии.
+Новые и изменившиеся магазины проецируются теми же компонентами без
+повторного обучения, поэтому точки остаются в прежних осях.
+"""
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+
+PROJECTION_METHODS = ['auto', 'exact', 'randomized', 'incremental']
+# До стольких ячеек (магазины × признаки) точный PCA быстрее рандомизированного
+EXACT_MAX_CELLS = 2_000_000
+PROJECTION_CHUNK_ROWS = 8192
+N_COMPONENTS = 2
+PROJECTION_LABELS = {
+    'exact': "точный PCA",
+    'randomized': "рандомизированный SVD",
+    'incremental': "IncrementalPCA по блокам",
+    'svd': "PCA по компонентам SVD артикулов",
+}
+
+
+class Projection:
+    """Обученная линейная проекция: (X - mean) @ components.T."""
+
+    def __init__(self, mean, components, explained_variance_ratio, method):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        self.explained_variance_ratio = np.asarray(explained_variance_ratio, dtype=np.float64)
+        self.method = method
+
+    @classmethod
+    def from_pca(cls, pca, method, explained_scale=1.0):
+        return cls(pca.mean_, pca.components_, pca.explained_variance_ratio_ * explained_scale, method)
+
+    def transform(self, X, chunk_rows=PROJECTION_CHUNK_ROWS):
+        """Координаты строк X (np.memmap читается блоками)."""
+        coords = np.empty((len(X), len(self.components)))
+        for start in range(0, len(X), chunk_rows):
+            block = np.asarray(X[start:start + chunk_rows], dtype=np.float64)
+            coords[start:start + chunk_rows] = (block - self.mean) @ self.components.T
+        return coords
+
+    def unscaled(self, mean, scale):
+        """Та же проекция для нестандартизованных признаков.
+
+        Проекция обучена на (X - mean) / scale; возвращаемая применяется к
+        самим X, так что ее можно хранить отдельно от стандартизации.
+        """
+        mean = np.asarray(mean, dtype=np.float64)
+        scale = np.asarray(scale, dtype=np.float64)
+        return Projection(mean + scale * self.mean, self.components / scale,
+                          self.explained_variance_ratio, self.method)
+
+
+def choose_method(X, method='auto'):
+    if method != 'auto':
+        return method
+    if isinstance(X, np.memmap):
+        return 'incremental'
+    return 'exact' if X.shape[0] * X.shape[1] <= EXACT_MAX_CELLS else 'randomized'
+
+
+def fit_projection(X, method='auto', chunk_rows=PROJECTION_CHUNK_ROWS, random_state=42):
+    """Проекция X на две главные компоненты. method — из PROJECTION_METHODS."""
+    method = choose_method(X, method)
+    if method == 'incremental':
+        pca = IncrementalPCA(n_components=N_COMPONENTS)
+        starts = list(range(0, len(X), chunk_rows))
+        # В каждом блоке partial_fit должно быть не меньше строк, чем компонент:
+        # короткий последний блок присоединяется к предыдущему
+        if len(starts) > 1 and len(X) - starts[-1] < N_COMPONENTS:
+            starts.pop()
+        for i, start in enumerate(starts):
+            stop = starts[i + 1] if i + 1 < len(starts) else len(X)
+            pca.partial_fit(np.asarray(X[start:stop], dtype=np.float64))
+    elif method == 'randomized':
+        pca = PCA(n_components=N_COMPONENTS, svd_solver='randomized', random_state=random_state).fit(X)
+    elif method == 'exact':
+        pca = PCA(n_components=N_COMPONENTS, svd_solver='full').fit(X)
+    else:
+        raise ValueError(f"Неизвестный метод проекции: {method}")
+    return Projection.from_pca(pca, method)
+
+
+def from_svd(embedding, svd_explained):
+    """Проекция по готовому embedding TruncatedSVD.
+
+    embedding уже сжат до десятков компонент, поэтому точный PCA по нему
+    дешев. svd_explained — доля дисперсии исходной матрицы, сохраненная
+    SVD: доли дисперсии главных компонент умножаются на нее и считаются
+    от исходных признаков, а не от embedding.
+    """
+    pca = PCA(n_components=N_COMPONENTS, svd_solver='full').fit(embedding)
+    return Projection.from_pca(pca, 'svd', svd_explained)
@@ -0,0 +1,197 @@
+"""Загрузка таблиц из Google Sheets с локальным кэшем.
+
+Скачанный CSV каждого листа хранится на диске вместе с ETag/Last-Modified.
+В пределах TTL лист берется из кэша без запроса; после TTL выполняется
+условный запрос (If-None-Match / If-Modified-Since), и ответ 304 не
+скачивает данные повторно; если сервер недоступен или отвечает ошибкой,
+отдается старая копия. Несколько листов (gid) загружаются параллельно в
+ограниченном пуле потоков. CSV листа разбирается блоками
+(loaders.stream_csv) с явными типами колонок в агрегат (Magazin, Segment,
+[Art, Date]) -> Sum, один раз на набор листов: агрегат кэшируется в
+loaders.ParquetCache по хэшу содержимого всех листов.
+
+Адрес сервера настраивается (KLASTER_SHEETS_BASE_URL), поэтому загрузчик
+можно проверять на локальном HTTP-сервере.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+
+from loaders import DEFAULT_CACHE_DIR, KEY_COLS, ParquetCache, content_hash, stream_csv
+from profiling import profiled
+
+SHEETS_BASE_URL = os.environ.get('KLASTER_SHEETS_BASE_URL', 'https://docs.google.com')
+SHEETS_TTL_SECONDS = int(os.environ.get('KLASTER_SHEETS_TTL', '300'))
+MAX_WORKERS = 4
+TIMEOUT_SECONDS = 60
+
+# Ключи сразу читаются как категории, артикулы — как строки (не числа)
+SHEET_DTYPES = {'Magazin': 'category', 'Segment': 'category', 'Art': 'string', 'Sum': 'string', 'Date': 'string'}
+# Необязательные колонки, которые сохраняются в агрегате листов
+OPTIONAL_KEYS = ['Art', 'Date']
+
+
+def parse_sheets_url(url):
+    """ID таблицы и gid листа из ссылки Google Sheets; ValueError, если ID нет."""
+    spreadsheet_match = re.search(r'/d/([a-zA-Z0-9-_]+)', url)
+    if not spreadsheet_match:
+        raise ValueError("Неправильная ссылка. Убедитесь, что это ссылка на Google Sheets")
+    gid_match = re.search(r'gid=([0-9]+)', url)
+    return spreadsheet_match.group(1), gid_match.group(1) if gid_match else '0'
+
+
+def parse_gids(text):
+    """Список gid из строки вида "0, 123456; 789"."""
+    return re.findall(r'[0-9]+', text or '')
+
+
+def export_url(spreadsheet_id, gid, base_url=None):
+    base_url = (base_url or SHEETS_BASE_URL).rstrip('/')
+    return f"{base_url}/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={gid}"
+
+
+class SheetCache:
+    """Дисковый кэш скачанных CSV с валидаторами HTTP (ETag, Last-Modified)."""
+
+    def __init__(self, cache_dir=None, ttl=SHEETS_TTL_SECONDS, timeout=TIMEOUT_SECONDS):
+        self.cache_dir = Path(cache_dir or Path(DEFAULT_CACHE_DIR) / 'sheets')
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def _paths(self, url):
+        key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        return self.cache_dir / f"{key}.csv", self.cache_dir / f"{key}.json"
+
+    def _store_meta(self, meta_path, meta):
+        tmp_path = meta_path.with_suffix('.json.tmp')
+        tmp_path.write_text(json.dumps(meta, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def _load_meta(meta_path):
+        """Метаданные копии или None (поврежденная запись считается промахом кэша)."""
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        return meta if isinstance(meta, dict) and 'fetched_at' in meta else None
+
+    def fetch(self, url, force=False):
+        """Байты CSV и информация о загрузке.
+
+        status: 'fresh' (из кэша в пределах TTL), 'not_modified' (304),
+        'downloaded' или 'stale' (сеть или сервер недоступны — отдана старая
+        копия, причина в info['error']).
+        """
+        started = time.perf_counter()
+        data_path, meta_path = self._paths(url)
+        meta = None
+        if data_path.exists() and meta_path.exists():
+            meta = self._load_meta(meta_path)
+
+        if meta is not None and not force and time.time() - meta['fetched_at'] < self.ttl:
+            return data_path.read_bytes(), self._info(url, 'fresh', data_path, started)
+
+        request = urllib.request.Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                meta['fetched_at'] = time.time()
+                self._store_meta(meta_path, meta)
+                return data_path.read_bytes(), self._info(url, 'not_modified', data_path, started)
+            if meta is None:
+                raise
+            return data_path.read_bytes(), self._info(url, 'stale', data_path, started, f"HTTP {e.code}")
+        except urllib.error.URLError as e:
+            if meta is None:
+                raise
+            return data_path.read_bytes(), self._info(url, 'stale', data_path, started, str(e.reason))
+
+        tmp_path = data_path.with_suffix('.csv.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, data_path)
+        self._store_meta(meta_path, {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        })
+        return data, self._info(url, 'downloaded', data_path, started)
+
+    @staticmethod
+    def _info(url, status, data_path, started, error=None):
+        info = {'url': url, 'status': status, 'bytes': data_path.stat().st_size,
+                'seconds': time.perf_counter() - started}
+        if error is not None:
+            info['error'] = error
+        return info
+
+
+@profiled('fetch_sheets')
+def fetch_all(urls, cache=None, force=False, max_workers=MAX_WORKERS):
+    """Параллельная загрузка листов. Возвращает [(байты, info)] в порядке urls."""
+    cache = cache or SheetCache()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as pool:
+        return list(pool.map(lambda url: cache.fetch(url, force), urls))
+
+
+def read_sheet_csv(data, keys):
+    """Потоковый разбор CSV листа с явными типами колонок в агрегат keys -> Sum."""
+    return stream_csv(BytesIO(data), keys=keys, dtype=SHEET_DTYPES)
+
+
+def sheet_columns(data):
+    """Колонки листа (только строка заголовка)."""
+    return set(pd.read_csv(BytesIO(data), nrows=0).columns)
+
+
+def load_sheets(spreadsheet_id, gids, cache=None, table_cache=None, force=False, base_url=None):
+    """Загружает и очищает один или несколько листов таблицы (строки листов объединяются).
+
+    Возвращает (DataFrame, meta): `key` (хэш содержимого всех листов),
+    `rows_raw`, `rows_dropped`, `from_cache` (таблица не разбиралась заново)
+    и `sheets` — статус загрузки каждого листа.
+    """
+    urls = [export_url(spreadsheet_id, gid, base_url) for gid in gids]
+    fetched = fetch_all(urls, cache, force)
+    key = 'sheets-' + content_hash(b''.join(content_hash(data).encode() for data, _ in fetched))
+    sheets = [{**info, 'gid': gid} for gid, (_, info) in zip(gids, fetched)]
+
+    table_cache = table_cache or ParquetCache()
+    cached = table_cache.get(key)
+    if cached is not None:
+        df, meta = cached
+        return df, {**meta, 'key': key, 'from_cache': True, 'sheets': sheets}
+
+    # Каждый лист агрегируется блоками (память ограничена числом ключей, а не
+    # строк); Art и Date остаются ключами агрегата, если они есть во всех листах
+    keys = list(KEY_COLS) + [col for col in OPTIONAL_KEYS
+                             if all(col in sheet_columns(data) for data, _ in fetched)]
+    parts = [read_sheet_csv(data, keys) for data, _ in fetched]
+    df = pd.concat([part for part, _ in parts], ignore_index=True)
+    if len(parts) > 1:
+        df = df.groupby(keys, observed=True, sort=False)['Sum'].sum().reset_index()
+    for col in keys:
+        df[col] = df[col].astype(str).astype('category')
+    meta = {'rows_raw': sum(part_meta['rows_raw'] for _, part_meta in parts),
+            'rows_dropped': sum(part_meta['rows_dropped'] for _, part_meta in parts)}
+    table_cache.put(key, df, meta)
+    return df, {**meta, 'key': key, 'from_cache': False, 'sheets': sheets}
@@ -0,0 +1,256 @@
+"""Устойчивость кластеров на повторных выборках магазинов.
+
+Итоговая конфигурация (k, метрика, параметры KMeans) заново обучается на
+многих подвыборках (по умолчанию 80% магазинов без возвращения) или
+bootstrap-выборках X_scaled. Обучения идут в пуле процессов; матрица
+признаков публикуется в общей памяти один раз, в задачу передается только
+seed. Результаты накапливаются по мере готовности, векторы меток не
+хранятся:
+
+- консенсусная матрица: сколько раз пара магазинов попала в один кластер
+  и сколько раз обе были в выборке (uint16, если помещается в бюджет памяти);
+- устойчивость магазина — средняя доля его "соседей по кластеру" из
+  исходного разбиения, оставшихся с ним в одном кластере;
+- устойчивость кластера — средний максимальный индекс Жаккара с кластерами
+  повторного обучения (как в clusterboot: >0.75 — устойчивый,
+  <0.5 — распадается);
+- распределение ARI между исходными и новыми метками.
+
+Расчет останавливается раньше n_resamples, когда оценки сходятся: стандартная
+ошибка среднего ARI и изменение средних Жаккара за последнюю порцию из
+CHECK_EVERY выборок меньше tol.
+"""
+from collections import deque
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from distances import matrix_fits
+from parallel import attach_array, effective_n_jobs, process_pool, shared_array
+from pipeline import fit_clusters
+
+RESAMPLE_MODES = ['subsample', 'bootstrap']
+DEFAULT_RESAMPLES = 100
+MIN_RESAMPLES = 20
+SUBSAMPLE_FRACTION = 0.8
+TOLERANCE = 0.01
+# Сходимость проверяется каждые CHECK_EVERY выборок (не зависит от числа воркеров)
+CHECK_EVERY = 10
+# Пороги индекса Жаккара (Hennig, clusterboot)
+STABLE_JACCARD = 0.75
+DISSOLVED_JACCARD = 0.5
+# Счетчики консенсусной матрицы — uint16
+MAX_CONSENSUS_RESAMPLES = np.iinfo(np.uint16).max
+
+
+def resample_indices(n, mode='subsample', fraction=SUBSAMPLE_FRACTION, seed=0):
+    """Индексы строк повторной выборки (для bootstrap — с повторами)."""
+    rng = np.random.default_rng(seed)
+    if mode == 'bootstrap':
+        return np.sort(rng.integers(0, n, n))
+    return np.sort(rng.choice(n, max(2, int(round(fraction * n))), replace=False))
+
+
+def refit(X_scaled, idx, n_clusters, distance_metric='euclidean', fit_params=(), seed=0):
+    """Повторное обучение на строках idx. Возвращает (уникальные idx, их метки).
+
+    random_state из fit_params заменяется на seed выборки, иначе все
+    повторы KMeans стартовали бы из одной точки.
+    """
+    params = dict(fit_params)
+    if 'random_state' in params:
+        params['random_state'] = int(seed)
+    labels, _ = fit_clusters(X_scaled[idx], n_clusters, distance_metric, **params)
+    # Повторы строки в bootstrap — одна и та же точка, метка у них общая
+    stores, first = np.unique(idx, return_index=True)
+    return stores.astype(np.int32), np.asarray(labels)[first].astype(np.int32)
+
+
+def _refit_shared(spec, mode, fraction, n_clusters, distance_metric, fit_params, seed):
+    # Выполняется в воркере: X берется из общей памяти, индексы строятся по seed
+    X_scaled = attach_array(spec)
+    idx = resample_indices(len(X_scaled), mode, fraction, seed)
+    return refit(X_scaled, idx, n_clusters, distance_metric, fit_params, seed)
+
+
+class StabilityAccumulator:
+    """Накопленные по выборкам оценки устойчивости относительно исходных меток."""
+
+    def __init__(self, reference, consensus=True):
+        self.reference = np.asarray(reference)
+        n = len(self.reference)
+        self.n_clusters = int(self.reference.max()) + 1
+        self.store_sum = np.zeros(n)
+        self.store_count = np.zeros(n, dtype=np.int64)
+        self.jaccard_sum = np.zeros(self.n_clusters)
+        self.jaccard_count = np.zeros(self.n_clusters, dtype=np.int64)
+        self.ari = []
+        self.coassigned = np.zeros((n, n), dtype=np.uint16) if consensus else None
+        self.cosampled = np.zeros((n, n), dtype=np.uint16) if consensus else None
+
+    @property
+    def n_resamples(self):
+        return len(self.ari)
+
+    def add(self, stores, labels):
+        """Учитывает одну выборку: stores — индексы магазинов, labels — их новые метки."""
+        ref = self.reference[stores]
+        table = np.zeros((self.n_clusters, int(labels.max()) + 1))
+        np.add.at(table, (ref, labels), 1)
+        rows, cols = table.sum(axis=1), table.sum(axis=0)
+
+        # Доля исходных соседей по кластеру, оставшихся с магазином вместе
+        mates = rows[ref] - 1
+        counted = mates > 0
+        self.store_sum[stores[counted]] += (table[ref, labels] - 1)[counted] / mates[counted]
+        self.store_count[stores[counted]] += 1
+
+        union = rows[:, None] + cols[None, :] - table
+        jaccard = np.divide(table, union, out=np.zeros_like(table), where=union > 0).max(axis=1)
+        present = rows > 0
+        self.jaccard_sum[present] += jaccard[present]
+        self.jaccard_count[present] += 1
+
+        self.ari.append(adjusted_rand_score(ref, labels))
+
+        if self.coassigned is not None:
+            self.cosampled[np.ix_(stores, stores)] += 1
+            for label in np.unique(labels):
+                members = stores[labels == label]
+                self.coassigned[np.ix_(members, members)] += 1
+
+    def cluster_jaccard(self):
+        return self.jaccard_sum / np.maximum(self.jaccard_count, 1)
+
+    def store_stability(self):
+        # Магазин, ни разу не попавший в выборку вместе с соседями, — NaN
+        return np.where(self.store_count > 0, self.store_sum / np.maximum(self.store_count, 1), np.nan)
+
+    def consensus(self):
+        """Доля выборок, в которых пара была в одном кластере (среди выборок с обоими)."""
+        if self.coassigned is None:
+            return None
+        return np.divide(self.coassigned, self.cosampled, out=np.zeros(self.coassigned.shape, dtype=np.float32),
+                         where=self.cosampled > 0)
+
+    def ari_standard_error(self):
+        if self.n_resamples < 2:
+            return np.inf
+        return float(np.std(self.ari, ddof=1) / np.sqrt(self.n_resamples))
+
+
+def stability_status(jaccard):
+    if jaccard >= STABLE_JACCARD:
+        return 'устойчивый'
+    if jaccard >= DISSOLVED_JACCARD:
+        return 'частично устойчивый'
+    return 'распадается'
+
+
+def summarize(accumulator, stores, converged):
+    """Итоговые таблицы по накопленным оценкам."""
+    reference = accumulator.reference
+    jaccard = accumulator.cluster_jaccard()
+    clusters = pd.DataFrame({
+        'Кластер': np.arange(accumulator.n_clusters),
+        'Магазинов': np.bincount(reference, minlength=accumulator.n_clusters),
+        'Жаккар': jaccard,
+        'Устойчивость_магазинов': pd.Series(accumulator.store_stability()).groupby(reference).mean()
+                                    .reindex(range(accumulator.n_clusters)).to_numpy(),
+        'Статус': [stability_status(value) for value in jaccard],
+    })
+    store_table = pd.DataFrame({
+        'Магазин': pd.Index(stores).astype(str),
+        'Кластер': reference,
+        'Устойчивость': accumulator.store_stability(),
+    })
+    consensus = accumulator.consensus()
+    if consensus is not None:
+        # Средний консенсус магазина с каждым исходным кластером: куда магазин "тянет"
+        onehot = np.eye(accumulator.n_clusters, dtype=np.float32)[reference]
+        affinity = consensus @ onehot / np.maximum(onehot.sum(axis=0), 1)
+        affinity[np.arange(len(reference)), reference] = -1
+        store_table['Ближайший_другой_кластер'] = affinity.argmax(axis=1)
+        store_table['Консенсус_с_ним'] = affinity.max(axis=1)
+    ari = np.asarray(accumulator.ari)
+    return {
+        'n_resamples': accumulator.n_resamples,
+        'converged': converged,
+        'ari': ari,
+        'ari_mean': float(ari.mean()),
+        'ari_interval': (float(np.percentile(ari, 2.5)), float(np.percentile(ari, 97.5))),
+        'clusters': clusters,
+        'stores': store_table.sort_values('Устойчивость', kind='stable').reset_index(drop=True),
+        'consensus': consensus,
+    }
+
+
+def bootstrap_stability(X_scaled, reference, n_clusters, distance_metric='euclidean', fit_params=(),
+                        stores=None, n_resamples=DEFAULT_RESAMPLES, mode='subsample',
+                        fraction=SUBSAMPLE_FRACTION, min_resamples=MIN_RESAMPLES, tol=TOLERANCE,
+                        n_jobs=1, random_state=0, consensus=None, progress=None):
+    """Устойчивость разбиения reference на повторных выборках X_scaled.
+
+    fit_params — как в engine.fit_params_for(). consensus=None — хранить
+    консенсусную матрицу, только если она помещается в бюджет памяти
+    (distances.matrix_fits). progress(done, total) вызывается после каждой
+    выборки. Выборки учитываются в порядке seed; после каждой порции из
+    CHECK_EVERY выборок (но не раньше min_resamples) проверяется
+    сходимость, поэтому результат не зависит от n_jobs.
+
+    Возвращает dict: n_resamples, converged, ari (массив), ari_mean,
+    ari_interval (95%), clusters и stores (DataFrame), consensus (матрица
+    или None).
+    """
+    X_scaled = np.asarray(X_scaled)
+    n = len(X_scaled)
+    stores = pd.RangeIndex(n) if stores is None else stores
+    if consensus is None:
+        consensus = matrix_fits(n)
+    if consensus:
+        n_resamples = min(n_resamples, MAX_CONSENSUS_RESAMPLES)
+    accumulator = StabilityAccumulator(reference, consensus)
+    seeds = np.random.SeedSequence(random_state).generate_state(n_resamples)
+    n_workers = effective_n_jobs(n_jobs, n_resamples, n)
+
+    converged = False
+    previous_jaccard = None
+    with ExitStack() as stack:
+        if n_workers > 1:
+            spec = stack.enter_context(shared_array(X_scaled))
+            pool = stack.enter_context(process_pool(n_workers))
+            # Вперед отправляется больше выборок, чем в одной порции, чтобы
+            # воркеры не простаивали на проверке сходимости; результаты
+            # учитываются в порядке seed
+            pending = deque()
+            ahead = max(2 * n_workers, CHECK_EVERY)
+        try:
+            for i, seed in enumerate(seeds):
+                if n_workers > 1:
+                    while len(pending) < ahead and i + len(pending) < n_resamples:
+                        pending.append(pool.submit(_refit_shared, spec, mode, fraction, n_clusters,
+                                                   distance_metric, fit_params, seeds[i + len(pending)]))
+                    sample_stores, labels = pending.popleft().result()
+                else:
+                    sample_stores, labels = refit(X_scaled, resample_indices(n, mode, fraction, seed),
+                                                  n_clusters, distance_metric, fit_params, seed)
+                accumulator.add(sample_stores, labels)
+                if progress is not None:
+                    progress(accumulator.n_resamples, n_resamples)
+                if accumulator.n_resamples % CHECK_EVERY and accumulator.n_resamples < n_resamples:
+                    continue
+
+                jaccard = accumulator.cluster_jaccard()
+                if accumulator.n_resamples >= min_resamples and previous_jaccard is not None:
+                    if (accumulator.ari_standard_error() < tol
+                            and np.abs(jaccard - previous_jaccard).max() < tol):
+                        converged = True
+                        break
+                previous_jaccard = jaccard
+        finally:
+            if n_workers > 1:
+                for future in pending:
+                    future.cancel()
+    return summarize(accumulator, stores, converged)
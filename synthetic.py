@@ -0,0 +1,79 @@
+"""Синтетические таблицы продаж в формате приложения (Magazin, Segment, Art, Sum).
+
+Магазины разбиты на скрытые кластеры: у каждого кластера свой профиль долей
+сегментов (распределение Дирихле), доли магазина — зашумленный профиль его
+кластера. Строки продаж распределяются по магазинам неравномерно (магазины
+разного размера), сегмент строки выбирается по долям магазина, артикул —
+среди артикулов этого сегмента. Генератор детерминирован при заданном seed
+и нужен для бенчмарков (benchmark.py) и проверки качества кластеризации:
+истинные метки возвращаются вместе с таблицей.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def make_sales(n_stores=500, n_segments=20, n_articles=1000, n_rows=200_000, n_clusters=5,
+               concentration=50.0, text_sums=False, seed=0):
+    """Таблица продаж и истинные кластеры магазинов.
+
+    concentration — насколько магазины похожи на профиль своего кластера
+    (больше — четче кластеры). text_sums=True записывает Sum строками с
+    десятичной запятой, как в выгрузках Google Sheets.
+
+    Возвращает (DataFrame, Series магазин -> номер скрытого кластера).
+    """
+    if n_articles < n_segments:
+        raise ValueError("Артикулов должно быть не меньше, чем сегментов")
+    rng = np.random.default_rng(seed)
+
+    profiles = rng.dirichlet(np.full(n_segments, 0.5), size=n_clusters)
+    true_clusters = rng.integers(0, n_clusters, n_stores)
+    # Дирихле по строкам через гамма-распределение (векторно для всех магазинов)
+    shares = rng.gamma(concentration * profiles[true_clusters] + 1e-3)
+    shares /= shares.sum(axis=1, keepdims=True)
+
+    store_weights = rng.lognormal(0.0, 0.5, n_stores)
+    stores = rng.choice(n_stores, n_rows, p=store_weights / store_weights.sum())
+
+    # Сегмент строки: поиск u в накопленных долях "своего" магазина; строки
+    # накопленных долей сдвинуты на номер магазина и склеены в один массив
+    cumulative = shares.cumsum(axis=1)
+    cumulative[:, -1] = 1.0
+    flat = (cumulative + np.arange(n_stores)[:, None]).ravel()
+    segments = np.searchsorted(flat, stores + rng.random(n_rows), side='right') - stores * n_segments
+    segments = np.minimum(segments, n_segments - 1)
+
+    # Артикулы упорядочены по сегментам: сегмент s владеет [start[s], start[s] + count[s])
+    counts = np.bincount(np.arange(n_articles) % n_segments, minlength=n_segments)
+    starts = np.concatenate([[0], counts.cumsum()[:-1]])
+    articles = starts[segments] + (rng.random(n_rows) * counts[segments]).astype(np.int64)
+
+    store_names = np.array([f"Магазин {i + 1:05d}" for i in range(n_stores)], dtype=object)
+    segment_names = np.array([f"Сегмент {i + 1:03d}" for i in range(n_segments)], dtype=object)
+    article_names = np.array([f"ART{i + 1:07d}" for i in range(n_articles)], dtype=object)
+
+    sums = rng.gamma(2.0, 500.0, n_rows).round(2)
+    df = pd.DataFrame({
+        'Magazin': store_names[stores],
+        'Segment': segment_names[segments],
+        'Art': article_names[articles],
+        'Sum': sums,
+    })
+    if text_sums:
+        df['Sum'] = pd.Series(sums).map('{:.2f}'.format).str.replace('.', ',', regex=False)
+    labels = pd.Series(true_clusters, index=pd.Index(store_names, name='Magazin'), name='Кластер')
+    return df, labels
+
+
+def write_sales(df, path):
+    """Сохраняет таблицу в .csv или .xlsx (по расширению path)."""
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        df.to_csv(path, index=False)
+    elif path.suffix.lower() == '.xlsx':
+        df.to_excel(path, index=False)
+    else:
+        raise ValueError(f"Неподдерживаемый формат файла: {path.name}")
+    return path
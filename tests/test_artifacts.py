@@ -0,0 +1,116 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import artifacts
+from artifacts import ArtifactCache, shared_cache
+
+MB = 1024 ** 2
+
+
+def _array(mb):
+    return np.zeros(mb * MB, dtype=np.uint8)
+
+
+def test_lru_eviction_under_byte_budget():
+    cache = ArtifactCache(max_bytes=3 * MB)
+    for key in ('a', 'b', 'c'):
+        cache.get_or_compute(key, lambda: _array(1))
+    # Обращение к a делает самой старой запись b
+    cache.get_or_compute('a', pytest.fail)
+    cache.get_or_compute('d', lambda: _array(1))
+    assert set(cache._entries) == {'a', 'c', 'd'}
+    assert cache.size_bytes == 3 * MB
+    assert cache.stats['evictions'] == 1
+    # Значение больше всего бюджета в памяти не хранится
+    cache.get_or_compute('huge', lambda: _array(4))
+    assert 'huge' not in cache._entries
+
+
+def test_values_are_read_only():
+    cache = ArtifactCache()
+    value = cache.get_or_compute('a', lambda: {'x': np.arange(3)})
+    with pytest.raises(ValueError):
+        value['x'][0] = 1
+
+
+def test_single_flight_compute():
+    cache = ArtifactCache()
+    started = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+               for _ in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 4
+    assert len(calls) == 1
+    assert cache.stats['misses'] == 1
+    assert cache.stats['waits'] == 3
+
+
+def test_failed_compute_is_not_cached():
+    cache = ArtifactCache()
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute('k', lambda: (_ for _ in ()).throw(RuntimeError()))
+    assert cache.get_or_compute('k', lambda: 1) == 1
+
+
+def test_disk_tier_survives_new_process_cache(tmp_path):
+    first = ArtifactCache(disk_dir=tmp_path)
+    first.get_or_compute('k', lambda: np.arange(5))
+    # Новый кэш (например, после перезапуска сервера) читает запись с диска
+    second = ArtifactCache(disk_dir=tmp_path)
+    value = second.get_or_compute('k', pytest.fail)
+    assert list(value) == [0, 1, 2, 3, 4]
+    assert not value.flags.writeable
+    assert second.stats['disk_hits'] == 1
+
+    # Поврежденный файл считается промахом
+    (tmp_path / 'k.pkl').write_bytes(b'broken')
+    assert ArtifactCache(disk_dir=tmp_path).get_or_compute('k', lambda: 'recomputed') == 'recomputed'
+
+
+def test_disk_eviction_keeps_budget(tmp_path):
+    cache = ArtifactCache(disk_dir=tmp_path, disk_max_bytes=int(2.5 * MB))
+    for key in ('a', 'b', 'c'):
+        cache.get_or_compute(key, lambda: _array(1))
+        # mtime задает порядок LRU на диске
+        time.sleep(0.01)
+    assert sorted(path.stem for path in tmp_path.glob('*.pkl')) == ['b', 'c']
+
+
+def test_shared_cache_key_and_code_version(monkeypatch):
+    cache = ArtifactCache()
+    calls = []
+
+    @shared_cache(cache)
+    def square(x, _log=None):
+        calls.append(x)
+        return x * x
+
+    assert square(3, _log='a') == 9
+    # Аргументы с "_" в ключ не входят
+    assert square(3, _log='b') == 9
+    assert square(x=3) == 9
+    assert calls == [3]
+    # Другая версия исходного кода — другой ключ
+    monkeypatch.setattr(artifacts, 'CODE_VERSION', 'changed')
+    assert square(3) == 9
+    assert calls == [3, 3]
+
+    square.clear()
+    assert len(cache) == 0
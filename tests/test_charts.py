@@ -0,0 +1,17 @@
+import numpy as np
+
+from charts import stratified_sample
+
+
+def test_stratified_sample_respects_budget_with_many_small_clusters():
+    # Один большой кластер и 50 кластеров по 2 точки: минимум в 1 точку превышал бюджет
+    labels = np.concatenate([np.zeros(1000, dtype=int), np.repeat(np.arange(1, 51), 2)])
+    sample = stratified_sample(labels, 100)
+    assert len(sample) == 100
+    assert len(np.unique(sample)) == len(sample)
+    assert len(np.unique(labels[sample])) == 51
+
+
+def test_stratified_sample_more_clusters_than_budget():
+    labels = np.arange(30)
+    assert len(stratified_sample(labels, 10)) == 10
@@ -0,0 +1,15 @@
+import cli
+from synthetic import make_sales, write_sales
+
+
+def test_features_art_on_csv(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    df, _ = make_sales(n_stores=40, n_segments=5, n_articles=60, n_rows=2000, n_clusters=3)
+    write_sales(df, input_dir / 'sales.csv')
+
+    code = cli.main([str(input_dir), '-o', str(tmp_path / 'out'), '-j', '1', '--features', 'Art',
+                     '--svd-components', '5', '--max-k', '4'])
+    assert code == 0
+    assert list((tmp_path / 'out').glob('sales*'))
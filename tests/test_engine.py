@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import engine
+import pipeline
+from synthetic import make_sales
+
+
+def _sales():
+    df, _ = make_sales(n_stores=60, n_segments=6, n_articles=40, n_rows=6000, n_clusters=3, seed=0)
+    return df
+
+
+def test_run_clustering_matches_stages():
+    df = _sales()
+    result = engine.run_clustering(df, neighbors_top_n=3)
+    _, pivot_pct = pipeline.build_pivot(df)
+    X_scaled, similarity_features, info = engine.compute_features(df, pivot_pct)
+    assert similarity_features is None and info is None
+    np.testing.assert_allclose(result['X_scaled'], X_scaled)
+    clusters, _, quality = engine.compute_fit(X_scaled, result['n_clusters'], 'euclidean',
+                                              engine.fit_params_for(result['params']))
+    np.testing.assert_array_equal(result['clusters'], clusters)
+    assert result['quality']['silhouette'] == pytest.approx(quality['silhouette'])
+    neighbors = engine.compute_neighbors(pivot_pct, clusters).batch(3, same_cluster=True)
+    assert result['neighbors'].equals(neighbors)
+
+
+def test_compute_sweep_uses_k_cache_only_for_kmeans_modes():
+    X_scaled, _ = pipeline.scale_features(pipeline.build_pivot(_sales())[1])
+    k_cache = {}
+    engine.compute_sweep(X_scaled, range(2, 5), 'k-means++', 'warm', k_cache=k_cache)
+    assert k_cache == {}
+    engine.compute_sweep(X_scaled, range(2, 5), 'k-means++', 'exhaustive', k_cache=k_cache)
+    assert sorted(k_cache) == [2, 3, 4]
+
+
+def test_check_stores():
+    _, pivot_pct = pipeline.build_pivot(_sales())
+    engine.check_stores(pivot_pct)
+    with pytest.raises(ValueError):
+        engine.check_stores(pivot_pct.iloc[:2])
+    assert list(engine.k_range_for(2, 10, 5)) == [2, 3, 4]
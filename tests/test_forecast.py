@@ -0,0 +1,21 @@
+import os
+
+from forecast import evict_models
+
+
+def test_evict_models_keeps_recently_used(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"model{i}.json"
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+    # Старейшая модель недавно использовалась (mtime обновлен при чтении)
+    os.utime(tmp_path / 'model0.json', (2000, 2000))
+
+    evict_models(tmp_path, max_bytes=250)
+    assert sorted(path.name for path in tmp_path.glob('*.json')) == ['model0.json', 'model4.json']
+
+
+def test_evict_models_keeps_newest_even_over_limit(tmp_path):
+    (tmp_path / 'big.json').write_bytes(b'x' * 1000)
+    evict_models(tmp_path, max_bytes=10)
+    assert (tmp_path / 'big.json').exists()
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+import pipeline
+from incremental import CLOSED_STORE, NEW_STORE, migration_matrix, warm_recluster
+from model import ClusterModel
+from synthetic import make_sales
+
+
+def test_migration_matrix_natural_order():
+    prev = pd.Series(np.arange(12), index=[f"s{i}" for i in range(12)])
+    new = pd.Series(np.arange(12), index=[f"s{i}" for i in range(1, 13)])
+    matrix = migration_matrix(prev, new)
+    assert list(matrix.index) == [str(k) for k in range(12)] + [NEW_STORE]
+    assert list(matrix.columns) == [str(k) for k in range(12)] + [CLOSED_STORE]
+    assert matrix.loc['10', '9'] == 1
+    assert matrix.loc[NEW_STORE, '11'] == 1
+    assert matrix.loc['0', CLOSED_STORE] == 1
+
+
+def test_warm_recluster_keeps_manhattan_metric():
+    df, _ = make_sales(n_stores=60, n_segments=6, n_articles=30, n_rows=3000, n_clusters=3)
+    _, pivot_pct = pipeline.build_pivot(df)
+    X_scaled, _ = pipeline.scale_features(pivot_pct)
+    clusters, _ = pipeline.fit_clusters(X_scaled, 3, 'manhattan')
+    model = ClusterModel.from_fit(pivot_pct, clusters, 'manhattan')
+
+    result = warm_recluster(df, model)
+    assert not result['warm_start']
+    assert result['model'].metric == 'manhattan'
+    assert result['moved'].empty
@@ -0,0 +1,128 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import parallel
+import pipeline
+from jobs import Cancelled, JobManager
+from profiling import profiled
+
+TIMEOUT = 10
+
+
+def _blocking(job, release):
+    # Ждет сигнала, проверяя отмену, как длинный расчет между k
+    while not release.wait(0.01):
+        job.check()
+    return job.key
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_workers=4, keep_finished=2)
+    yield manager
+    manager._executor.shutdown(cancel_futures=True)
+
+
+def test_same_key_returns_same_job(manager):
+    release = threading.Event()
+    first = manager.submit('a', 'k1', _blocking, release)
+    assert manager.submit('b', 'k1', _blocking, release) is first
+    release.set()
+    assert first.wait(TIMEOUT) and first.result() == 'k1'
+
+
+def test_slot_replacement_cancels_only_unwatched_job(manager):
+    release = threading.Event()
+    shared = manager.submit('a', 'k1', _blocking, release)
+    manager.submit('b', 'k1', _blocking, release)
+    # Слот a ушел к другому ключу, но k1 еще ждет слот b
+    manager.submit('a', 'k2', _blocking, release)
+    assert not shared.cancelled
+    manager.submit('b', 'k3', _blocking, release)
+    assert shared.cancelled
+    assert shared.wait(TIMEOUT) and shared.failed
+    with pytest.raises(Cancelled):
+        shared.result()
+    release.set()
+
+
+def test_cancelled_job_is_resubmitted(manager):
+    release = threading.Event()
+    job = manager.submit('a', 'k1', _blocking, release)
+    manager.cancel('a')
+    job.wait(TIMEOUT)
+    release.set()
+    again = manager.submit('a', 'k1', _blocking, release)
+    assert again is not job
+    assert again.wait(TIMEOUT) and again.result() == 'k1'
+
+
+def test_report_and_check_raise_after_cancel(manager):
+    reported = threading.Event()
+    release = threading.Event()
+
+    def func(job):
+        for i in range(3):
+            job.report(i)
+        reported.set()
+        release.wait(TIMEOUT)
+        job.report(3)
+
+    job = manager.submit('a', 'k1', func)
+    assert reported.wait(TIMEOUT)
+    assert job.partial == [0, 1, 2]
+    job.cancel()
+    with pytest.raises(Cancelled):
+        job.check()
+    release.set()
+    job.wait(TIMEOUT)
+    with pytest.raises(Cancelled):
+        job.result()
+    assert job.partial == [0, 1, 2]
+
+
+def test_finished_jobs_are_bounded(manager):
+    for i in range(6):
+        job = manager.submit('a', f'k{i}', lambda job: job.key)
+        assert job.wait(TIMEOUT)
+    # keep_finished завершенных плюс задание, которое ждет слот
+    assert len(manager._jobs) == manager.keep_finished + 1
+    assert list(manager._jobs) == ['k3', 'k4', 'k5']
+
+
+def test_progress_exception_cancels_queued_ks(monkeypatch):
+    rng = np.random.default_rng(0)
+    X = np.vstack([center + rng.normal(size=(30, 2)) for center in rng.normal(scale=5, size=(3, 2))])
+    evaluated = []
+
+    def evaluate(spec, d_spec, k, init_method, random_state, silhouette_sample):
+        evaluated.append(k)
+        return k, pipeline.evaluate_k(X, k, init_method, random_state, None, silhouette_sample)
+
+    # Пул потоков из одного воркера вместо процессов: k считаются по очереди
+    monkeypatch.setattr(parallel, 'MIN_PARALLEL_ROWS', 0)
+    monkeypatch.setattr(pipeline, 'process_pool', lambda n_jobs: ThreadPoolExecutor(1))
+    monkeypatch.setattr(pipeline, '_evaluate_k_shared', evaluate)
+
+    def progress(done, k, metrics):
+        raise Cancelled(k)
+
+    k_range = range(2, 12)
+    with pytest.raises(Cancelled):
+        pipeline.sweep_k(X, k_range, 'k-means++', progress=progress, n_jobs=2)
+    # Первое готовое k прервало перебор; не начатые k не считались
+    assert len(evaluated) <= 2 < len(k_range)
+
+
+def test_job_stages_are_profiled_in_worker(manager):
+    @profiled('stage')
+    def work():
+        return 1
+
+    job = manager.submit('a', 'k1', lambda job: work())
+    assert job.wait(TIMEOUT) and job.result() == 1
+    assert job.profiler.total_seconds is not None
+    assert [row['name'] for row in job.profiler.rows()] == ['stage']
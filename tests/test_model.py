@@ -0,0 +1,116 @@
+import json
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline
+from model import MODEL_FORMAT_VERSION, ClusterModel
+
+
+def _pivot_pct(n_per_cluster=20, seed=0):
+    # Три кластера магазинов с разной структурой оборота по сегментам, доли в %
+    rng = np.random.default_rng(seed)
+    profiles = np.array([[60, 20, 10, 10], [10, 60, 20, 10], [10, 10, 30, 50]], dtype=float)
+    shares = np.vstack([profile + rng.normal(scale=2, size=(n_per_cluster, 4)) for profile in profiles])
+    shares = np.clip(shares, 0, None)
+    shares = shares / shares.sum(axis=1, keepdims=True) * 100
+    stores = pd.Index([f"M{i}" for i in range(len(shares))], name='Magazin')
+    labels = np.repeat(np.arange(3), n_per_cluster)
+    return pd.DataFrame(shares, index=stores, columns=pd.Index(['S1', 'S2', 'S3', 'S4'], name='Segment')), labels
+
+
+def _model(with_projection=True):
+    pivot_pct, labels = _pivot_pct()
+    projection = None
+    if with_projection:
+        X_scaled, _ = pipeline.scale_features(pivot_pct)
+        projection, _ = pipeline.project_2d(X_scaled)
+    return ClusterModel.from_fit(pivot_pct, labels, 'euclidean', projection=projection, k=3), pivot_pct, labels
+
+
+def test_assign_reproduces_training_clusters():
+    model, pivot_pct, labels = _model()
+    assigned = model.assign(pivot_pct)
+    assert (assigned['Кластер'].to_numpy() == labels).all()
+    assert (assigned['Доля_новых_сегментов'] == 0).all()
+    assert assigned['Вне_модели'].mean() <= 0.1
+    # Координаты обучающих магазинов совпадают с проекцией обучения
+    X_scaled, _ = pipeline.scale_features(pivot_pct)
+    _, coords = pipeline.project_2d(X_scaled)
+    assert assigned[['PC1', 'PC2']].to_numpy() == pytest.approx(coords, abs=1e-8)
+
+
+def test_roundtrip_keeps_model(tmp_path):
+    model, pivot_pct, _ = _model()
+    model.save(tmp_path / 'model.npz')
+    loaded = ClusterModel.load(tmp_path / 'model.npz')
+    assert list(loaded.segments) == list(model.segments)
+    assert loaded.metric == model.metric
+    assert loaded.meta == model.meta
+    assert loaded.centroids == pytest.approx(model.centroids)
+    assert loaded.labels.equals(model.labels.rename_axis('Magazin'))
+    assert loaded.projection.method == model.projection.method
+    pd.testing.assert_frame_equal(loaded.assign(pivot_pct), model.assign(pivot_pct))
+
+
+def test_load_file_without_projection_and_labels():
+    model, pivot_pct, _ = _model()
+    # Файл старого формата: только центры, стандартизация и метаданные
+    output = BytesIO()
+    np.savez_compressed(output, segments=np.asarray(model.segments, dtype=str), mean=model.mean,
+                        scale=model.scale, centroids=model.centroids,
+                        meta=np.array(json.dumps({**model.meta, 'metric': model.metric})))
+    loaded = ClusterModel.load(output.getvalue())
+    assert loaded.projection is None
+    assert loaded.labels is None
+    assert loaded.projection_for(['S1']) is None
+    assigned = loaded.assign(pivot_pct)
+    assert 'PC1' not in assigned.columns
+    assert (assigned['Кластер'] == model.assign(pivot_pct)['Кластер']).all()
+
+
+def test_load_rejects_other_format_version():
+    model, _, _ = _model(with_projection=False)
+    model.meta['format_version'] = MODEL_FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        ClusterModel.load(model.to_bytes())
+
+
+def test_assign_missing_and_unknown_segments():
+    model, pivot_pct, labels = _model()
+    # S4 у магазинов больше нет, зато появился сегмент S5 с 4% оборота
+    new = pivot_pct.drop(columns='S4')
+    new = new / new.sum(axis=1).to_numpy()[:, None] * 96
+    new['S5'] = 4.0
+    assigned = model.assign(new)
+    assert assigned['Доля_новых_сегментов'].to_numpy() == pytest.approx(np.full(len(new), 4.0))
+    aligned, unseen_share, unseen = model.align(new)
+    assert list(unseen) == ['S5']
+    assert (aligned[:, model.segments.get_loc('S4')] == 0).all()
+    # Проекция для набора сегментов новых данных: S5 не влияет на координаты
+    projection = model.projection_for(new.columns)
+    assert projection.transform(new.to_numpy()) == pytest.approx(assigned[['PC1', 'PC2']].to_numpy())
+
+
+def test_drift_thresholds():
+    model, pivot_pct, _ = _model()
+    same = model.drift(pivot_pct)
+    assert not same['refit_recommended']
+    assert same['cluster_share_shift'] == pytest.approx(0)
+
+    # Большая доля оборота в новом сегменте
+    shifted = pivot_pct * 0.9
+    shifted['S5'] = 10.0
+    drift = model.drift(shifted)
+    assert drift['unseen_share'] == pytest.approx(10.0)
+    assert drift['unseen_segments'] == ['S5']
+    assert drift['refit_recommended']
+
+    # Все магазины из одного кластера: структура сети изменилась, магазины далеко от центров
+    one_cluster = pd.concat([pivot_pct.iloc[:20]] * 3).set_axis([f"N{i}" for i in range(60)])
+    drift = model.drift(one_cluster)
+    assert drift['cluster_share_shift'] == pytest.approx(2 / 3)
+    assert drift['mean_shift'] > 0.5
+    assert drift['refit_recommended']
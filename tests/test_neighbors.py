@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.metrics.pairwise import cosine_similarity
+
+from neighbors import NeighborIndex
+
+TOP_N = 4
+
+
+def _features(sparse):
+    if sparse:
+        return sp.random(40, 30, density=0.3, format='csr', random_state=1)
+    return np.random.default_rng(0).random((40, 12))
+
+
+def _brute_force(features, clusters=None):
+    sims = cosine_similarity(features)
+    np.fill_diagonal(sims, -np.inf)
+    if clusters is not None:
+        sims[clusters[:, None] != clusters[None, :]] = -np.inf
+    top = np.argsort(-sims, axis=1, kind='stable')[:, :TOP_N]
+    return top, np.take_along_axis(sims, top, axis=1)
+
+
+def _index(features, clusters):
+    return NeighborIndex(features, [f"M{i}" for i in range(features.shape[0])], clusters)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_query_matches_brute_force(sparse):
+    features = _features(sparse)
+    index = _index(features, np.zeros(features.shape[0], dtype=int))
+    top, sims = _brute_force(features)
+    for row in (0, 17, 39):
+        result = index.query(f"M{row}", TOP_N)
+        assert list(result['Магазин']) == [f"M{i}" for i in top[row]]
+        assert result['Схожесть'].to_numpy() == pytest.approx(sims[row], abs=1e-5)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('same_cluster', [False, True])
+def test_batch_matches_brute_force(sparse, same_cluster):
+    features = _features(sparse)
+    clusters = np.arange(features.shape[0]) % 3
+    index = _index(features, clusters)
+    top, sims = _brute_force(features, clusters if same_cluster else None)
+    # Несколько блоков строк, последний неполный
+    result = index.batch(TOP_N, same_cluster=same_cluster, block_rows=16)
+    assert len(result) == features.shape[0] * TOP_N
+    expected = [f"M{i}" for i in top.ravel()]
+    assert list(result['Похожий магазин']) == expected
+    assert result['Схожесть'].to_numpy() == pytest.approx(sims.ravel(), abs=1e-5)
+    assert list(result['Ранг'][:TOP_N]) == list(range(1, TOP_N + 1))
+    if same_cluster:
+        assert (result['Кластер'] == result['Кластер похожего']).all()
+
+
+def test_same_cluster_drops_missing_neighbors():
+    features = _features(False)[:6]
+    # В кластере 1 всего два магазина: у каждого только один сосед
+    clusters = np.array([0, 0, 0, 0, 1, 1])
+    index = _index(features, clusters)
+    result = index.query('M4', TOP_N, same_cluster=True)
+    assert list(result['Магазин']) == ['M5']
+    assert list(result['Кластер']) == [1]
+    batch = index.batch(TOP_N, same_cluster=True)
+    assert batch.groupby('Магазин')['Ранг'].max().to_dict() == {
+        'M0': 3, 'M1': 3, 'M2': 3, 'M3': 3, 'M4': 1, 'M5': 1}
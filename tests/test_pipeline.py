@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import pipeline
+
+
+def test_fit_minibatch_short_tail_chunk():
+    # 1030 строк при batch_size=1024: хвост из 6 строк меньше k=10
+    X = np.random.default_rng(0).normal(size=(1030, 4))
+    labels, inertia = pipeline.fit_minibatch(X, 10, batch_size=1024)
+    assert len(labels) == len(X)
+    assert inertia > 0
+
+
+def test_chunk_bounds_merges_short_tail():
+    assert pipeline.chunk_bounds(1030, 1024, 10) == [(0, 1030)]
+    assert pipeline.chunk_bounds(1030, 1024) == [(0, 1024), (1024, 1030)]
+
+
+def _sweep_data():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(scale=5, size=(4, 3))
+    return np.vstack([center + rng.normal(size=(30, 3)) for center in centers])
+
+
+@pytest.mark.parametrize('mode', ['exhaustive', 'adaptive'])
+@pytest.mark.parametrize('k_range', [range(3, 4), range(3, 5)])
+def test_sweep_k_short_ranges(mode, k_range):
+    sweep = pipeline.sweep_k(_sweep_data(), k_range, 'k-means++', mode=mode)
+    assert sweep['k'] == list(k_range)
+
+
+def test_elbow_k_stays_on_grid():
+    assert pipeline.elbow_k([5], [10.0]) == 5
+    assert pipeline.elbow_k([5, 6], [10.0, 8.0]) == 6
+    assert pipeline.elbow_k([2, 4, 8], [100.0, 20.0, 15.0]) == 2
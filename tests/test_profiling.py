@@ -0,0 +1,68 @@
+import threading
+import tracemalloc
+
+import profiling
+from profiling import Profiler, measure
+
+
+def test_tracing_is_shared_between_threads():
+    inner_entered = threading.Event()
+    outer_done = threading.Event()
+
+    def inner():
+        with measure(trace_memory=True):
+            inner_entered.set()
+            # Замер в другом потоке закончился раньше, трассировка должна остаться
+            outer_done.wait(5)
+            assert tracemalloc.is_tracing()
+
+    with measure(trace_memory=True):
+        thread = threading.Thread(target=inner)
+        thread.start()
+        assert inner_entered.wait(5)
+    outer_done.set()
+    thread.join(5)
+    assert not tracemalloc.is_tracing()
+
+
+def test_measure_without_rss_after_block(monkeypatch):
+    values = iter([100.0, None])
+    monkeypatch.setattr(profiling, 'peak_rss_mb', lambda: next(values))
+    with measure() as stats:
+        pass
+    assert stats['peak_rss_mb'] is None
+    assert 'rss_growth_mb' not in stats
+
+
+def test_finish_closes_block_once(tmp_path):
+    profiler = Profiler(trace_memory=True)
+    profiler.block("Блок 1")
+    with profiler.stage('этап'):
+        pass
+    log = tmp_path / 'profile.jsonl'
+    profiler.finish(log)
+    profiler.finish(log)
+    assert not tracemalloc.is_tracing()
+    assert [row['name'] for row in profiler.rows()] == ["Блок 1", 'этап']
+    assert len(log.read_text(encoding='utf-8').splitlines()) == 2
+
+
+def test_merge_nests_other_run_under_current_block():
+    job = Profiler()
+    with job.stage('cached_sweep', cached=True):
+        job.mark_miss()
+        with job.stage('sweep_k'):
+            pass
+    job.finish(log_path=None)
+
+    profiler = Profiler()
+    profiler.block("Блок 3")
+    profiler.merge(job, "задание")
+    profiler.merge(job, "задание")
+    profiler.finish(log_path=None)
+    rows = {row['name']: row for row in profiler.rows()}
+    assert [(row['name'], row['depth']) for row in profiler.rows()] == [
+        ("Блок 3", 0), ("задание", 1), ('cached_sweep', 2), ('sweep_k', 3)]
+    assert rows['задание']['calls'] == 2
+    assert rows['задание']['seconds'] == 2 * job.total_seconds
+    assert rows['cached_sweep']['misses'] == 2
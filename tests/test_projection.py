@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+
+from projection import fit_projection
+
+
+def _data(n_rows=600):
+    # Две выраженные главные оси и шум в остальных признаках
+    rng = np.random.default_rng(0)
+    basis = np.linalg.qr(rng.normal(size=(8, 8)))[0][:2]
+    return rng.normal(size=(n_rows, 2)) * [10, 4] @ basis + rng.normal(scale=0.3, size=(n_rows, 8)) + 3
+
+
+def _align(coords, reference):
+    # Главные компоненты определены с точностью до знака
+    signs = np.sign((coords * reference).sum(axis=0))
+    return coords * signs
+
+
+@pytest.mark.parametrize('method', ['randomized', 'incremental'])
+def test_methods_agree_with_exact_pca(method):
+    X = _data()
+    exact = fit_projection(X, 'exact')
+    fitted = fit_projection(X, method, chunk_rows=128)
+    assert fitted.method == method
+    assert np.abs((fitted.components * exact.components).sum(axis=1)) == pytest.approx([1, 1], abs=1e-3)
+    assert fitted.explained_variance_ratio == pytest.approx(exact.explained_variance_ratio, rel=1e-2)
+    assert _align(fitted.transform(X), exact.transform(X)) == pytest.approx(exact.transform(X), abs=0.05)
+
+
+def test_incremental_reads_memmap_in_chunks(tmp_path):
+    X = _data(1030)
+    mm = np.lib.format.open_memmap(tmp_path / 'X.npy', mode='w+', dtype=np.float64, shape=X.shape)
+    mm[:] = X
+    # Последний блок из одной строки присоединяется к предыдущему
+    fitted = fit_projection(mm, chunk_rows=1029)
+    assert fitted.method == 'incremental'
+    exact = fit_projection(X, 'exact')
+    assert _align(fitted.transform(mm, chunk_rows=100), exact.transform(X)) == pytest.approx(
+        exact.transform(X), abs=0.05)
+
+
+def test_new_rows_use_training_axes():
+    X = _data()
+    train, new = X[:500], X[500:]
+    fitted = fit_projection(train, 'exact')
+    reference = PCA(n_components=2, svd_solver='full').fit(train)
+    assert _align(fitted.transform(new), reference.transform(new)) == pytest.approx(
+        reference.transform(new), abs=1e-8)
+
+
+def test_unscaled_projection_matches_scaled_input():
+    X = _data()
+    mean, scale = X.mean(axis=0), X.std(axis=0)
+    fitted = fit_projection((X - mean) / scale, 'exact')
+    raw = X[:50] * 1.1
+    assert fitted.unscaled(mean, scale).transform(raw) == pytest.approx(
+        fitted.transform((raw - mean) / scale), abs=1e-8)
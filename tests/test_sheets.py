@@ -0,0 +1,74 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from loaders import ParquetCache
+from sheets import SheetCache, load_sheets
+
+SHEETS = {
+    '0': "Magazin,Segment,Art,Sum,Extra\nA,S1,a1,10,x\nA,S2,a2,5,x\nB,S1,a1,\"7,5\",x\nB,S1,a1,2.5,x\nC,S2,a3,-1,x\n",
+    '1': "Magazin,Segment,Art,Sum\nC,S1,a4,4\nA,S1,a1,1\n",
+}
+
+
+class SheetHandler(BaseHTTPRequestHandler):
+    # Код ответа сервера для всех запросов (меняется в тестах)
+    status = 200
+
+    def do_GET(self):
+        if self.status != 200:
+            self.send_error(self.status)
+            return
+        body = SHEETS[self.path.rsplit('gid=', 1)[1]].encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), SheetHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    SheetHandler.status = 200
+
+
+def test_load_sheets_streams_into_aggregate(server, tmp_path):
+    df, meta = load_sheets('doc', ['0', '1'], cache=SheetCache(tmp_path / 'sheets'),
+                           table_cache=ParquetCache(tmp_path / 'tables'), base_url=server)
+    assert meta['rows_raw'] == 7
+    assert meta['rows_dropped'] == 1
+    assert set(df.columns) == {'Magazin', 'Segment', 'Art', 'Sum'}
+    totals = df.set_index(['Magazin', 'Segment', 'Art'])['Sum']
+    assert totals[('A', 'S1', 'a1')] == 11
+    assert totals[('B', 'S1', 'a1')] == 10
+
+
+def test_server_error_falls_back_to_cached_copy(server, tmp_path):
+    cache = SheetCache(tmp_path / 'sheets', ttl=0)
+    first, _ = cache.fetch(f"{server}/export?gid=0")
+    SheetHandler.status = 500
+    data, info = cache.fetch(f"{server}/export?gid=0")
+    assert data == first
+    assert info['status'] == 'stale'
+    assert info['error'] == 'HTTP 500'
+
+
+def test_corrupt_meta_is_a_cache_miss(server, tmp_path):
+    cache = SheetCache(tmp_path / 'sheets')
+    url = f"{server}/export?gid=0"
+    first, _ = cache.fetch(url)
+    _, meta_path = cache._paths(url)
+    meta_path.write_text('{"fetched_at": 1', encoding='utf-8')
+    data, info = cache.fetch(url)
+    assert data == first
+    assert info['status'] == 'downloaded'
+    assert 'fetched_at' in cache._load_meta(meta_path)
+    assert not list(meta_path.parent.glob('*.tmp'))
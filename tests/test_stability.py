@@ -0,0 +1,19 @@
+import numpy as np
+
+import parallel
+from pipeline import fit_clusters
+from stability import bootstrap_stability
+
+
+def test_result_does_not_depend_on_workers(monkeypatch):
+    # Небольшая матрица, но параллельный путь все равно нужен
+    monkeypatch.setattr(parallel, 'MIN_PARALLEL_ROWS', 0)
+    rng = np.random.default_rng(0)
+    X = np.vstack([center + rng.normal(scale=2, size=(40, 3)) for center in rng.normal(scale=3, size=(3, 3))])
+    reference, _ = fit_clusters(X, 3, 'euclidean', random_state=0)
+    fit_params = (('random_state', 0),)
+    runs = [bootstrap_stability(X, reference, 3, fit_params=fit_params, n_resamples=40, min_resamples=20,
+                                n_jobs=n_jobs, consensus=False)
+            for n_jobs in (1, 3)]
+    assert runs[0]['n_resamples'] == runs[1]['n_resamples']
+    np.testing.assert_array_equal(runs[0]['ari'], runs[1]['ari'])